@@ -36,9 +36,52 @@ CREATE TABLE IF NOT EXISTS stationevents (
     PRIMARY KEY (tst, vehicle_id)
 );
 
+-- Typed tables for the most common msg types, used if enabled by POSTGRES_TYPED_MESSAGE_TABLES.
+CREATE TABLE IF NOT EXISTS udp_messages (
+    tst TIMESTAMPTZ NOT NULL,
+    ntp_timestamp TIMESTAMPTZ NOT NULL,
+    eke_timestamp TIMESTAMP NOT NULL,
+    mqtt_timestamp TIMESTAMPTZ NOT NULL,
+    tst_source TEXT NOT NULL,
+    vehicle_id INT NOT NULL,
+    packet_no INT NOT NULL,
+    speed DOUBLE PRECISION NOT NULL,
+    odo INT NOT NULL,
+    loc_x DOUBLE PRECISION NOT NULL,
+    loc_y DOUBLE PRECISION NOT NULL,
+    doors_open BOOLEAN NOT NULL,
+    standstill INT NOT NULL,
+    train_no INT NOT NULL,
+    PRIMARY KEY (tst, vehicle_id)
+);
+
+CREATE TABLE IF NOT EXISTS beacon_messages (
+    tst TIMESTAMPTZ NOT NULL,
+    ntp_timestamp TIMESTAMPTZ NOT NULL,
+    eke_timestamp TIMESTAMP NOT NULL,
+    mqtt_timestamp TIMESTAMPTZ NOT NULL,
+    tst_source TEXT NOT NULL,
+    vehicle_id INT NOT NULL,
+    balise_id INT,
+    balise_id_next INT,
+    balise_msg_type TEXT,
+    direction INT,
+    incomplete BOOLEAN NOT NULL,
+    PRIMARY KEY (tst, vehicle_id)
+);
+
 -- Data will be copied to staging, and then inserted into main tables.
 CREATE SCHEMA staging;
 
+-- Completed date ranges of the backfill mode (POSTGRES_WRITE_MODE=backfill)
+CREATE TABLE IF NOT EXISTS staging.backfill_progress (
+    target TEXT,
+    range_start DATE,
+    range_end DATE,
+    completed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (target, range_start, range_end)
+);
+
 SELECT
     create_hypertable('messages', 'tst');
 
@@ -46,4 +89,10 @@ SELECT
     create_hypertable('events', 'tst');
 
 SELECT
-    create_hypertable('stationevents', 'tst');
\ No newline at end of file
+    create_hypertable('stationevents', 'tst');
+
+SELECT
+    create_hypertable('udp_messages', 'tst');
+
+SELECT
+    create_hypertable('beacon_messages', 'tst');
\ No newline at end of file
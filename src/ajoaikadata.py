@@ -3,30 +3,41 @@ All ajoaikadata in the single dataflow
 Reads data from Azure Storage, runs the ajoaikadata pipeline and stores results to Postgres. 
 """
 
+from functools import partial
+import json
+from pathlib import Path
+
 import bytewax.operators as op
+from bytewax.connectors.files import FileSink
 from bytewax.dataflow import Dataflow
 
 from .connectors.azure_storage import AzureStorageInput
-from .connectors.postgres import PostgresOutput, PostgresClient
+from .connectors.parquet import ParquetOutput
+from .connectors.postgres import PostgresOutput, PostgresClient, TYPED_MESSAGE_TABLES, is_message_for
 
 from .ekeparser.schemas.jkv_beacon import JKVBeaconDataSchema
 
 from .operations.common import filter_none
-from .operations.balisedirection import create_directions_for_balises
-from .operations.baliseparts import combine_balise_parts
 from .operations.deduplication import deduplicate
 from .operations.events import create_events
 from .operations.stationevents import create_station_events
-from .operations.parsing import csv_to_bytewax_msg, raw_msg_to_eke
-from .operations.tstvalidator import validate_tst
-from .operations.udporder import reorder_messages
+from .operations.parsing import csv_to_bytewax_msg, is_parse_failure, raw_msg_to_eke, to_dead_letter
+from .operations.vehiclepipeline import VehiclePipelineLogic
+from .util.config import read_from_env
 
 BEACON_DATA_SCHEMA = JKVBeaconDataSchema()
 
 
-postgres_client_messages = PostgresClient("messages")
-postgres_client_events = PostgresClient("events")
-postgres_client_stationevents = PostgresClient("stationevents")
+# Msgs that fail to parse are written to this file as json lines. If not given, they are only counted and logged.
+(DEAD_LETTER_FILE,) = read_from_env(("DEAD_LETTER_FILE",), required=False)
+# If given, results are written to Parquet files under this directory instead of Postgres
+(PARQUET_OUTPUT_DIR,) = read_from_env(("PARQUET_OUTPUT_DIR",), required=False)
+
+
+def create_output(target: str) -> ParquetOutput | PostgresOutput:
+    if PARQUET_OUTPUT_DIR:
+        return ParquetOutput(target, Path(PARQUET_OUTPUT_DIR))
+    return PostgresOutput(PostgresClient(target))
 
 
 flow = Dataflow("readerparser")
@@ -39,26 +50,32 @@ stream = op.map("csv_to_bytewax_msg", stream, csv_to_bytewax_msg)
 #     op.filter_map, "filter_none_deduplicate", filter_none
 # )
 
-stream = op.map("raw_msg_to_eke", stream, raw_msg_to_eke).then(op.filter_map, "filter_none_raw_msg_to_eke", filter_none)
+stream = op.map("raw_msg_to_eke", stream, raw_msg_to_eke)
 
-stream = op.stateful_map("validate_tst", stream, validate_tst) # TODO: Does not work reliable
+if DEAD_LETTER_FILE:
+    parse_results = op.branch("split_parse_failures", stream, is_parse_failure)
+    dead_letters = op.map("to_dead_letter", parse_results.trues, to_dead_letter)
+    dead_letters = op.map_value("dead_letter_to_json", dead_letters, lambda msg: json.dumps(msg["data"]))
+    op.output("dead_letter_out", dead_letters, FileSink(Path(DEAD_LETTER_FILE)))
+    stream = parse_results.falses
 
-stream = op.stateful_map("reorder_upd", stream, reorder_messages).then(
-    # Remove batches coming from reordering
-    op.flat_map_value,
-    "flatten_reorder_upd",
-    lambda x: x,
-)
+stream = op.filter_map("filter_none_raw_msg_to_eke", stream, filter_none)
 
-stream = op.stateful_map("combine_balises", stream, combine_balise_parts).then(
-    op.filter_map, "filter_none_combine_balises", filter_none
+# Timestamp validation (TODO: Does not work reliable), udp ordering and balise combining, per vehicle in one step.
+# Stored data is replayed, so the caches are released by the event time only, and the rest at the end of the input.
+stream = op.unary("vehicle_pipeline", stream, partial(VehiclePipelineLogic, idle_advance=False)).then(
+    op.filter_map, "filter_none_vehicle_pipeline", filter_none
 )
 
-stream = op.stateful_map("balise_direction", stream, create_directions_for_balises).then(
-    op.filter_map, "filter_none_balise_direction", filter_none
-)
+if TYPED_MESSAGE_TABLES:
+    # Msg types with a typed table are stored there, the rest as json to the messages table
+    for table in TYPED_MESSAGE_TABLES:
+        op.output(f"{table}_out", op.filter(f"filter_{table}", stream, is_message_for(table)), create_output(table))
+    messages_stream = op.filter("filter_messages", stream, is_message_for("messages"))
+else:
+    messages_stream = stream
 
-op.output("contentparser_out", stream, PostgresOutput(postgres_client_messages))
+op.output("contentparser_out", messages_stream, create_output("messages"))
 
 stream = op.stateful_map(
     "event_creator",
@@ -66,7 +83,7 @@ stream = op.stateful_map(
     create_events,
 ).then(op.filter_map, "filter_none_event_creator", filter_none)
 
-op.output("events_out", stream, PostgresOutput(postgres_client_events))
+op.output("events_out", stream, create_output("events"))
 
 stream = op.stateful_map(
     "station_event_creator",
@@ -74,4 +91,4 @@ stream = op.stateful_map(
     create_station_events,
 ).then(op.filter_map, "filter_none_station_event_creator", filter_none)
 
-op.output("stations_out", stream, PostgresOutput(postgres_client_stationevents))
+op.output("stations_out", stream, create_output("stationevents"))
@@ -0,0 +1,100 @@
+"""
+Simulator of out-of-order EKE traffic. Generates UDP and beacon message streams of vehicles as they would arrive
+to the reorder stage: delayed by a random network delay, with lost packets, duplicates and clock jumps.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+import random
+
+from ..util.ajoaikadatamsg import AjoaikadataMsg, AjoaikadataMsgWithKey
+
+
+@dataclass
+class TrafficConfig:
+    """
+    Configuration of the simulated traffic.
+
+    Attributes:
+    - vehicles: How many vehicles send messages. Vehicle ids start from 1.
+    - duration_secs: Length of the simulated stream in seconds.
+    - udp_interval_secs: Interval of UDP messages of a vehicle.
+    - beacon_interval_secs: Average interval of beacon messages of a vehicle. Use 0 to disable beacons.
+    - jitter_secs: Max network delay. Each message is delayed by a random amount between 0 and this.
+    - loss_rate: Probability of a message to be lost.
+    - duplicate_rate: Probability of a message to arrive twice.
+    - clock_jump_rate: Probability of the vehicle clock to jump on a UDP message.
+    - clock_jump_secs: Max size of a clock jump, forward or backward.
+    - start: Event time of the first message.
+    - seed: Seed of the random generator, to get repeatable streams.
+    """
+
+    vehicles: int = 10
+    duration_secs: int = 3600
+    udp_interval_secs: float = 1.0
+    beacon_interval_secs: float = 20.0
+    jitter_secs: float = 0.5
+    loss_rate: float = 0.01
+    duplicate_rate: float = 0.001
+    clock_jump_rate: float = 0.0
+    clock_jump_secs: float = 60.0
+    start: datetime = datetime(2024, 1, 1)
+    seed: int = 0
+
+
+# Arrival time in seconds from the start, and the message
+SimulatedMsg = tuple[float, AjoaikadataMsgWithKey]
+
+
+def _create_msg(vehicle: int, tst: datetime, msg_type: int, content: dict) -> AjoaikadataMsgWithKey:
+    msg: AjoaikadataMsg = {"data": {"tst": tst, "msg_type": msg_type, "vehicle": vehicle, "content": content}}
+    return str(vehicle), msg
+
+
+def simulate_vehicle(vehicle: int, config: TrafficConfig, rng: random.Random) -> list[SimulatedMsg]:
+    """Messages of a single vehicle in the order of arrival"""
+    sent: list[tuple[float, int, dict]] = []  # Send time, msg type and content
+
+    time = 0.0
+    packet_no = rng.randrange(255)
+    while time < config.duration_secs:
+        sent.append((time, 1, {"packet_no": packet_no}))
+        packet_no = (packet_no + 1) % 255
+        time += config.udp_interval_secs
+
+    if config.beacon_interval_secs:
+        time = rng.expovariate(1 / config.beacon_interval_secs)
+        msg_index = 1
+        while time < config.duration_secs:
+            # Balise telegrams are sent in two parts
+            for part in (0, 1):
+                sent.append((time, 5, {"msg_index": msg_index, "transponder_msg_part": part}))
+                msg_index = msg_index % 255 + 1
+            time += rng.expovariate(1 / config.beacon_interval_secs)
+
+    sent.sort(key=lambda item: item[0])
+
+    msgs: list[SimulatedMsg] = []
+    clock_offset = 0.0
+    for send_time, msg_type, content in sent:
+        if msg_type == 1 and rng.random() < config.clock_jump_rate:
+            clock_offset += rng.uniform(-config.clock_jump_secs, config.clock_jump_secs)
+        if rng.random() < config.loss_rate:
+            continue
+
+        tst = config.start + timedelta(seconds=send_time + clock_offset)
+        copies = 2 if rng.random() < config.duplicate_rate else 1
+        for _ in range(copies):
+            arrival = send_time + rng.uniform(0, config.jitter_secs)
+            msgs.append((arrival, _create_msg(vehicle, tst, msg_type, dict(content))))
+
+    msgs.sort(key=lambda item: item[0])
+    return msgs
+
+
+def simulate_traffic(config: TrafficConfig) -> list[SimulatedMsg]:
+    """Messages of all the vehicles in the order of arrival"""
+    rng = random.Random(config.seed)
+    msgs = [msg for vehicle in range(1, config.vehicles + 1) for msg in simulate_vehicle(vehicle, config, rng)]
+    msgs.sort(key=lambda item: item[0])
+    return msgs
@@ -0,0 +1,80 @@
+"""
+Benchmark of the heap of the UDP reorder cache. Keeps the heap at the cache depth and measures push and pop pairs per
+second with the plain tuple entries of udporder, compared to the earlier tuple subclass with Python comparison
+methods, which also read the packet_no through the msg dict.
+
+Usage (from the repository root):
+    python -m src.benchmarks.udpheap
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import heapq
+import random
+import time
+
+from ..operations.udporder import CACHE_MAX_SIZE
+from ..util.ajoaikadatamsg import AjoaikadataMsg
+from ..util.config import logger
+
+
+class LegacyCacheItem(tuple):
+    """Cache item of the earlier implementation"""
+
+    def __new__(cls, item: tuple[datetime, AjoaikadataMsg]):
+        return tuple.__new__(LegacyCacheItem, item)
+
+    def __lt__(self, other):
+        return self[0] < other[0]
+
+    def __gt__(self, other):
+        return self[0] > other[0]
+
+
+def create_msgs(count: int, jitter_secs: float) -> list[tuple[datetime, AjoaikadataMsg]]:
+    """UDP messages one per second, with timestamps shuffled by the jitter"""
+    start = datetime(2024, 1, 1)
+    msgs = []
+    for i in range(count):
+        tst = start + timedelta(seconds=i + random.uniform(-jitter_secs, jitter_secs))
+        msgs.append((tst, {"data": {"tst": tst, "msg_type": 1, "content": {"packet_no": i % 255}}}))
+    return msgs
+
+
+def run_legacy(msgs: list[tuple[datetime, AjoaikadataMsg]], depth: int) -> float:
+    heap: list[LegacyCacheItem] = []
+    started = time.perf_counter()
+    for tst, msg in msgs:
+        heapq.heappush(heap, LegacyCacheItem((tst, msg)))
+        if len(heap) > depth:
+            # The earlier code checked the type and the packet_no of the head before popping
+            if heap[0][1]["data"]["msg_type"] == 1 and heap[0][1]["data"]["content"]["packet_no"] >= 0:
+                heapq.heappop(heap)
+    return len(msgs) / (time.perf_counter() - started)
+
+
+def run_tuples(msgs: list[tuple[datetime, AjoaikadataMsg]], depth: int) -> float:
+    heap: list[tuple[datetime, int, int, AjoaikadataMsg]] = []
+    started = time.perf_counter()
+    for seq, (tst, msg) in enumerate(msgs):
+        heapq.heappush(heap, (tst, seq, msg["data"]["content"]["packet_no"], msg))
+        if len(heap) > depth:
+            if heap[0][2] >= 0:
+                heapq.heappop(heap)
+    return len(msgs) / (time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the heap entries of the UDP reorder cache.")
+    parser.add_argument("-n", "--msgs", type=int, default=500_000, help="Msgs pushed through the heap")
+    parser.add_argument("-d", "--depth", type=int, default=CACHE_MAX_SIZE, help="Heap size kept during the run")
+    parser.add_argument("-j", "--jitter", type=float, default=2.0, help="Timestamp jitter in seconds")
+    args = parser.parse_args()
+
+    random.seed(0)
+    msgs = create_msgs(args.msgs, args.jitter)
+    legacy = run_legacy(msgs, args.depth)
+    tuples = run_tuples(msgs, args.depth)
+    logger.info(f"Tuple subclass entries: {legacy:.0f} msgs/s")
+    logger.info(f"Plain tuple entries: {tuples:.0f} msgs/s")
+    logger.info(f"Speedup: {tuples / legacy:.2f}x")
@@ -0,0 +1,138 @@
+"""
+Benchmark of the UDP reorder stage with simulated out-of-order traffic. Runs the messages through reorder_messages
+and reports throughput, release latency, max cache depth and discard rate. The cache depth is reported for the UDP
+and the other messages separately, and for both together.
+
+Release latency is the simulated time a message spends in the cache: the arrival time of the message that
+released it minus its own arrival time. The timer of the reorder operator is emulated with the simulated time, so that
+a vehicle with stalled event time is released when the timer would fire. Messages still cached at the end are flushed
+and left out of the latencies.
+
+Usage (from the repository root):
+    python -m src.benchmarks.udporder --loss-rate 0.02 --jitter 2
+    UDP_REORDER_MAX_LATENESS_SECS=10 python -m src.benchmarks.udporder
+"""
+
+import argparse
+from datetime import timedelta
+import time
+
+from ..operations.udporder import (
+    MAX_LATENESS,
+    UDPMsgCache,
+    get_time_to_release,
+    reorder_messages,
+    release_udp_cache,
+)
+from ..util.ajoaikadatamsg import AjoaikadataMsg
+from ..util.config import logger
+from .trafficsim import SimulatedMsg, TrafficConfig, simulate_traffic
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run_benchmark(msgs: list[SimulatedMsg]) -> dict[str, float]:
+    caches: dict[str, UDPMsgCache | None] = {}
+    # Simulated time when the event time of the vehicle was last advanced
+    advanced_at: dict[str, float] = {}
+    arrivals: dict[int, float] = {}
+    latencies: list[float] = []
+    max_udp_depth = 0
+    max_other_depth = 0
+    max_depth = 0
+    discarded = 0
+    released = 0
+
+    def release(released_msgs: list[AjoaikadataMsg], now: float) -> None:
+        nonlocal discarded, released
+        for released_msg in released_msgs:
+            latencies.append(now - arrivals.pop(id(released_msg)))
+            discarded += bool(released_msg["data"].get("discard"))
+        released += len(released_msgs)
+
+    started = time.perf_counter()
+    for arrival, (key, msg) in msgs:
+        cache = caches.get(key)
+        if cache:
+            # The timer of the operator
+            time_to_release = get_time_to_release(cache)
+            if time_to_release is not None:
+                notify_at = advanced_at[key] + time_to_release.total_seconds()
+                if notify_at <= arrival:
+                    idle_time = timedelta(seconds=notify_at - advanced_at[key])
+                    release(release_udp_cache(cache, cache["max_tst"] + idle_time), notify_at)
+            max_tst = cache["max_tst"]
+
+        arrivals[id(msg)] = arrival
+        cache, released_msgs = reorder_messages(cache, msg)
+        caches[key] = cache
+        if key not in advanced_at or cache["max_tst"] > max_tst:
+            advanced_at[key] = arrival
+        max_udp_depth = max(max_udp_depth, len(cache["msgs"]))
+        max_other_depth = max(max_other_depth, len(cache["others"]))
+        max_depth = max(max_depth, len(cache["msgs"]) + len(cache["others"]))
+        release(released_msgs, arrival)
+    for cache in caches.values():
+        if cache:
+            released += len(release_udp_cache(cache, None))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "msgs_per_sec": len(msgs) / elapsed,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": latencies[-1] if latencies else 0.0,
+        "max_udp_cache_depth": max_udp_depth,
+        "max_other_cache_depth": max_other_depth,
+        "max_cache_depth": max_depth,
+        "discard_rate": discarded / len(msgs),
+        "released": released,
+    }
+
+
+if __name__ == "__main__":
+    defaults = TrafficConfig()
+    parser = argparse.ArgumentParser(description="Benchmark the UDP reorder stage with simulated traffic.")
+    parser.add_argument("--vehicles", type=int, default=defaults.vehicles)
+    parser.add_argument("--duration", type=int, default=defaults.duration_secs, help="Simulated seconds")
+    parser.add_argument("--beacon-interval", type=float, default=defaults.beacon_interval_secs)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter_secs, help="Max network delay in seconds")
+    parser.add_argument("--loss-rate", type=float, default=defaults.loss_rate)
+    parser.add_argument("--duplicate-rate", type=float, default=defaults.duplicate_rate)
+    parser.add_argument("--clock-jump-rate", type=float, default=defaults.clock_jump_rate)
+    parser.add_argument("--clock-jump-secs", type=float, default=defaults.clock_jump_secs)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+
+    config = TrafficConfig(
+        vehicles=args.vehicles,
+        duration_secs=args.duration,
+        beacon_interval_secs=args.beacon_interval,
+        jitter_secs=args.jitter,
+        loss_rate=args.loss_rate,
+        duplicate_rate=args.duplicate_rate,
+        clock_jump_rate=args.clock_jump_rate,
+        clock_jump_secs=args.clock_jump_secs,
+        seed=args.seed,
+    )
+    msgs = simulate_traffic(config)
+    result = run_benchmark(msgs)
+
+    logger.info(f"{len(msgs)} msgs, max lateness {MAX_LATENESS.total_seconds()}s")
+    logger.info(f"Throughput: {result['msgs_per_sec']:.0f} msgs/s")
+    logger.info(
+        "Release latency (s): "
+        f"p50 {result['latency_p50']:.2f}, p95 {result['latency_p95']:.2f}, "
+        f"p99 {result['latency_p99']:.2f}, max {result['latency_max']:.2f}"
+    )
+    logger.info(
+        f"Max cache depth: {result['max_cache_depth']} "
+        f"(udp {result['max_udp_cache_depth']}, other {result['max_other_cache_depth']})"
+    )
+    logger.info(f"Discard rate: {result['discard_rate']:.4%}")
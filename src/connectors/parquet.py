@@ -0,0 +1,187 @@
+"""
+Output connection code for writing data to Parquet files. The tables are the same as in Postgres,
+and rows are created with the mappers of the Postgres connector.
+
+Files are partitioned by date, vehicle and msg type (if the table has it):
+    <base path>/<table>/date=2024-01-10/vehicle_id=53/msg_type=1/part-<run>-<partition>-<seq>.parquet
+
+Rows are buffered and written as row groups to an open file. The file is finished when the sink takes
+a snapshot or is closed. It is written to a temporary name first and renamed when completed, so readers
+never see partial files. Each run has its own id in the file names, so runs can write to the same directory.
+On resume, the files of the run written after the snapshot are removed, because their rows are processed again.
+"""
+
+from datetime import date, datetime, timezone
+import os
+from pathlib import Path
+import re
+from typing import Any, Callable, List
+import uuid
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bytewax.outputs import FixedPartitionedSink, StatefulSinkPartition
+
+from .postgres import PG_TARGET_TABLE, as_naive, as_utc, create_row_adapter, dumps_json
+from ..util.ajoaikadatamsg import AjoaikadataMsg
+
+from ..util.config import logger, read_from_env
+
+(PARQUET_PARTITIONS, PARQUET_ROW_GROUP_ROWS) = read_from_env(
+    ("PARQUET_PARTITIONS", "PARQUET_ROW_GROUP_ROWS"), defaults=("8", "100000")
+)
+PARQUET_PARTITIONS = int(PARQUET_PARTITIONS)
+PARQUET_ROW_GROUP_ROWS = int(PARQUET_ROW_GROUP_ROWS)
+
+ARROW_TYPES = {
+    "timestamptz": pa.timestamp("us", tz="UTC"),
+    "timestamp": pa.timestamp("us"),
+    "text": pa.string(),
+    "int4": pa.int32(),
+    "float8": pa.float64(),
+    "bool": pa.bool_(),
+    "jsonb": pa.string(),
+}
+
+COLUMN_ADAPTERS: dict[str, Callable[[Any], Any]] = {
+    "timestamptz": as_utc,
+    "timestamp": as_naive,
+    "jsonb": dumps_json,
+}
+
+# Date, vehicle and msg type of the file
+FileKey = tuple[date, int, int | None]
+
+# Run id and the seq of the next file
+ParquetSinkState = tuple[str, int]
+
+
+def create_run_id() -> str:
+    return f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+
+
+class ParquetSinkPartition(StatefulSinkPartition):
+    def __init__(
+        self,
+        target: str,
+        path: Path,
+        part: str,
+        run_id: str,
+        resume_state: ParquetSinkState | None,
+        row_group_rows: int,
+    ) -> None:
+        table = PG_TARGET_TABLE[target]
+        self.target = target
+        self.path = path / target
+        self.part = part
+        self.row_group_rows = row_group_rows
+        self.columns: tuple[str, ...] = table["columns"]
+        self.schema = pa.schema(
+            [(name, ARROW_TYPES[column_type]) for name, column_type in zip(self.columns, table["types"])]
+        )
+        self.mapper: Callable[[dict], tuple] = table["mapper"]
+        self.adapt_row = create_row_adapter(table["types"], COLUMN_ADAPTERS)
+        self.vehicle_index = self.columns.index("vehicle_id")
+        self.msg_type_index = self.columns.index("msg_type") if "msg_type" in self.columns else None
+
+        # Run id and seq of the next file. Stored in the snapshots.
+        self.run_id, self.seq = resume_state or (run_id, 0)
+        if resume_state is not None:
+            self._remove_files_after(self.seq)
+
+        self.buffers: dict[FileKey, List[tuple]] = {}
+        self.writers: dict[FileKey, tuple[pq.ParquetWriter, Path]] = {}
+
+    def _remove_files_after(self, seq: int) -> None:
+        """Remove files of this run and partition not included in the snapshot, and unfinished files."""
+        prefix = f"part-{self.run_id}-{self.part}-"
+        file_regex = re.compile(rf"{re.escape(prefix)}(\d+)\.parquet(\.tmp)?$")
+        for file in self.path.glob(f"**/{prefix}*"):
+            match = file_regex.search(file.name)
+            if match and (match.group(2) or int(match.group(1)) >= seq):
+                logger.info(f"Removing parquet file not included in the snapshot: {file}")
+                file.unlink()
+
+    def _file_key(self, row: tuple) -> FileKey:
+        return (
+            row[0].date(),
+            row[self.vehicle_index],
+            row[self.msg_type_index] if self.msg_type_index is not None else None,
+        )
+
+    def _file_dir(self, key: FileKey) -> Path:
+        file_date, vehicle, msg_type = key
+        file_dir = self.path / f"date={file_date.isoformat()}" / f"vehicle_id={vehicle}"
+        if msg_type is not None:
+            file_dir = file_dir / f"msg_type={msg_type}"
+        return file_dir
+
+    def _write_row_group(self, key: FileKey) -> None:
+        rows = self.buffers.pop(key, None)
+        if not rows:
+            return
+
+        if key not in self.writers:
+            file_dir = self._file_dir(key)
+            file_dir.mkdir(parents=True, exist_ok=True)
+            file = file_dir / f"part-{self.run_id}-{self.part}-{self.seq:08d}.parquet"
+            self.seq += 1
+            tmp_file = file.with_name(file.name + ".tmp")
+            self.writers[key] = (pq.ParquetWriter(tmp_file, self.schema), file)
+
+        writer, _ = self.writers[key]
+        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def _finish_files(self) -> None:
+        """Write the buffered rows and complete the open files."""
+        for key in list(self.buffers):
+            self._write_row_group(key)
+        for writer, file in self.writers.values():
+            writer.close()
+            os.replace(file.with_name(file.name + ".tmp"), file)
+        self.writers = {}
+
+    def write_batch(self, values: List[AjoaikadataMsg]) -> None:
+        for msg in values:
+            row = self.adapt_row(self.mapper(msg["data"]))
+            key = self._file_key(row)
+            buffer = self.buffers.setdefault(key, [])
+            buffer.append(row)
+            if len(buffer) >= self.row_group_rows:
+                self._write_row_group(key)
+
+    def snapshot(self) -> ParquetSinkState:
+        # Files are rotated on snapshot, so that the snapshot includes only completed files
+        self._finish_files()
+        return self.run_id, self.seq
+
+    def close(self) -> None:
+        self._finish_files()
+
+
+class ParquetOutput(FixedPartitionedSink):
+    """
+    Write the messages of the target table to Parquet files under the path.
+    The path must be shared by all the workers.
+    """
+
+    def __init__(
+        self,
+        target: str,
+        path: Path,
+        partitions: int = PARQUET_PARTITIONS,
+        row_group_rows: int = PARQUET_ROW_GROUP_ROWS,
+    ) -> None:
+        self.target = target
+        self.path = path
+        self.partitions = partitions
+        self.row_group_rows = row_group_rows
+        # Id of the files of this run. A resumed partition continues with the id of its snapshot.
+        self.run_id = create_run_id()
+
+    def list_parts(self) -> List[str]:
+        return [str(i) for i in range(self.partitions)]
+
+    def build_part(self, step_id: str, for_part: str, resume_state: ParquetSinkState | None) -> ParquetSinkPartition:
+        return ParquetSinkPartition(self.target, self.path, for_part, self.run_id, resume_state, self.row_group_rows)
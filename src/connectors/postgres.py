@@ -2,36 +2,130 @@
 Output connection code for sending data to Postgres.
 """
 
+import atexit
+from contextlib import contextmanager
+from datetime import datetime, timezone
 import json
-from typing import Callable, List
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator, List
 
 from bytewax.outputs import DynamicSink, StatelessSinkPartition
+from prometheus_client import Counter, Gauge, Histogram
+import psycopg
+from psycopg.copy import LibpqWriter
 from psycopg.sql import SQL, Identifier
+from psycopg.types.json import Jsonb
 import psycopg_pool
 
 from ..util.ajoaikadatamsg import AjoaikadataMsgWithKey
 
 from ..util.config import logger, read_from_env
 
-(POSTGRES_CONN_STR,) = read_from_env(("POSTGRES_CONN_STR",))
+if TYPE_CHECKING:
+    from .pulsar import PulsarClient
 
+# Required by the Postgres clients only, so that the table definitions can be used without a database
+(POSTGRES_CONN_STR,) = read_from_env(("POSTGRES_CONN_STR",), required=False)
+# Format of the COPY to the staging tables, binary or text
+(POSTGRES_COPY_FORMAT,) = read_from_env(("POSTGRES_COPY_FORMAT",), defaults=("binary",))
+# How many batches per sink can wait for the background writer. 0 writes synchronously in the worker.
+(POSTGRES_WRITE_QUEUE_SIZE,) = read_from_env(("POSTGRES_WRITE_QUEUE_SIZE",), defaults=("2",))
+POSTGRES_WRITE_QUEUE_SIZE = int(POSTGRES_WRITE_QUEUE_SIZE)
+# The background writer combines batches until it has this many rows, or the oldest row has waited this long
+(POSTGRES_BATCH_ROWS, POSTGRES_BATCH_MAX_LATENCY_MS) = read_from_env(
+    ("POSTGRES_BATCH_ROWS", "POSTGRES_BATCH_MAX_LATENCY_MS"), defaults=("5000", "1000")
+)
+POSTGRES_BATCH_ROWS = int(POSTGRES_BATCH_ROWS)
+POSTGRES_BATCH_MAX_LATENCY_MS = int(POSTGRES_BATCH_MAX_LATENCY_MS)
+# Chunk interval of the hypertables. Rows of a batch are inserted one chunk at a time. Timescale default is 7 days.
+(POSTGRES_CHUNK_INTERVAL_HOURS,) = read_from_env(("POSTGRES_CHUNK_INTERVAL_HOURS",), defaults=("168",))
+POSTGRES_CHUNK_INTERVAL_SECS = float(POSTGRES_CHUNK_INTERVAL_HOURS) * 3600
+# streaming: each batch is merged to the main table. backfill: batches are only copied to the staging tables,
+# and merged to the main table once, when the whole date range has been processed.
+(POSTGRES_WRITE_MODE,) = read_from_env(("POSTGRES_WRITE_MODE",), defaults=("streaming",))
+# Date range of the backfill, the same as the range of the input
+(START_DATE, END_DATE) = read_from_env(("START_DATE", "END_DATE"), required=POSTGRES_WRITE_MODE == "backfill")
+# Max connections of the process, shared by all the Postgres outputs
+(POSTGRES_POOL_MAX_SIZE,) = read_from_env(("POSTGRES_POOL_MAX_SIZE",), defaults=("20",))
+POSTGRES_POOL_MAX_SIZE = int(POSTGRES_POOL_MAX_SIZE)
 
-# Key is the name of the postgres table.
+ROWS_WRITTEN = Counter("postgres_rows_written_total", "Rows copied to the staging tables", ["target"])
+BYTES_WRITTEN = Counter("postgres_copy_bytes_total", "Bytes sent to Postgres by COPY", ["target"])
+CONFLICT_ROWS = Counter("postgres_conflict_rows_total", "Rows skipped by ON CONFLICT DO NOTHING", ["target"])
+COPY_DURATION = Histogram("postgres_copy_duration_seconds", "Duration of a COPY to the staging table", ["target"])
+MERGE_DURATION = Histogram(
+    "postgres_merge_duration_seconds", "Duration of the merge from the staging to the main table", ["target"]
+)
+POOL_WAIT = Histogram("postgres_pool_wait_seconds", "Time waiting for a connection from the pool", ["target"])
+CONNECTIONS_IN_USE = Gauge("postgres_connections_in_use", "Connections taken from the pool", ["target"])
+
+COPY_OPTIONS = {
+    "binary": SQL("(FORMAT BINARY)"),
+    "text": SQL(""),
+}
+
+
+def dumps_json(obj: Any) -> str:
+    return json.dumps(obj, default=str)
+
+
+def as_utc(value: datetime) -> datetime:
+    """Naive timestamps are in UTC. Binary copy needs the tz for timestamptz columns."""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+def as_naive(value: datetime) -> datetime:
+    """Postgres ignores the tz when a timestamp column is parsed from text. Binary copy needs a naive value."""
+    return value.replace(tzinfo=None) if value.tzinfo else value
+
+
+# Adapters to convert the values returned by the mapper to the column types, per copy format.
+# Columns without an adapter are copied as they are.
+COLUMN_ADAPTERS: dict[str, dict[str, Callable[[Any], Any]]] = {
+    "binary": {
+        "timestamptz": as_utc,
+        "timestamp": as_naive,
+        "jsonb": lambda obj: Jsonb(obj, dumps=dumps_json),
+    },
+    "text": {
+        "jsonb": dumps_json,
+    },
+}
+
+
+# Key is the name of the postgres table. The first column is the time column of the hypertable.
 # query is the copy command to the staging table
 # post_query is the command to move data from the staging table to the main table
+# primary_key is used to deduplicate the rows of the backfill
+# columns and types are the names and the postgres types of the copied columns, in the order of the mapper.
+# Types are needed by the binary copy.
 # mapper is the function to modify message data object to the database table schema
 PG_TARGET_TABLE = {
     "messages": {
+        "primary_key": ("tst", "msg_type", "vehicle_id"),
         "query": SQL(
-            "COPY staging.{staging} (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, msg_type, vehicle_id, message) FROM STDIN;"
+            "COPY staging.{staging} (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, msg_type, vehicle_id, message) FROM STDIN {options};"
         ),
         "post_query": SQL(
             """
             INSERT INTO messages (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, msg_type, vehicle_id, message)
             SELECT tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, msg_type, vehicle_id, message FROM staging.{staging} ON CONFLICT DO NOTHING;
-            DELETE FROM staging.{staging};
+            TRUNCATE staging.{staging};
             """
         ),
+        "columns": (
+            "tst",
+            "ntp_timestamp",
+            "eke_timestamp",
+            "mqtt_timestamp",
+            "tst_source",
+            "msg_type",
+            "vehicle_id",
+            "message",
+        ),
+        "types": ("timestamptz", "timestamptz", "timestamp", "timestamptz", "text", "int4", "int4", "jsonb"),
         "mapper": lambda data_obj: (
             data_obj["tst"],
             data_obj["ntp_timestamp"],
@@ -40,20 +134,43 @@ PG_TARGET_TABLE = {
             data_obj["tst_source"],
             data_obj["msg_type"],
             data_obj["vehicle"],
-            json.dumps(data_obj, default=str),
+            data_obj,
         ),
     },
     "events": {
+        "primary_key": ("tst", "event_type", "vehicle_id"),
         "query": SQL(
-            "COPY staging.{staging} (tst, tst_corrected, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, event_type, vehicle_id, data) FROM STDIN;"
+            "COPY staging.{staging} (tst, tst_corrected, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, event_type, vehicle_id, data) FROM STDIN {options};"
         ),
         "post_query": SQL(
             """
             INSERT INTO events (tst, tst_corrected, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, event_type, vehicle_id, data)
             SELECT tst, tst_corrected, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, event_type, vehicle_id, data FROM staging.{staging} ON CONFLICT DO NOTHING;
-            DELETE FROM staging.{staging};
+            TRUNCATE staging.{staging};
             """
         ),
+        "columns": (
+            "tst",
+            "tst_corrected",
+            "ntp_timestamp",
+            "eke_timestamp",
+            "mqtt_timestamp",
+            "tst_source",
+            "event_type",
+            "vehicle_id",
+            "data",
+        ),
+        "types": (
+            "timestamp",
+            "timestamptz",
+            "timestamptz",
+            "timestamp",
+            "timestamptz",
+            "text",
+            "text",
+            "int4",
+            "jsonb",
+        ),
         "mapper": lambda data_obj: (
             data_obj["tst"],
             data_obj["tst_corrected"],
@@ -63,20 +180,33 @@ PG_TARGET_TABLE = {
             data_obj["tst_source"],
             data_obj["event_type"],
             data_obj["vehicle"],
-            json.dumps(data_obj["data"], default=str),
+            data_obj["data"],
         ),
     },
     "stationevents": {
+        "primary_key": ("tst", "vehicle_id"),
         "query": SQL(
-            "COPY staging.{staging} (tst, ntp_timestamp, eke_timestamp, tst_source, vehicle_id, station, track, direction, data) FROM STDIN;"
+            "COPY staging.{staging} (tst, ntp_timestamp, eke_timestamp, tst_source, vehicle_id, station, track, direction, data) FROM STDIN {options};"
         ),
         "post_query": SQL(
             """
             INSERT INTO stationevents (tst, ntp_timestamp, eke_timestamp, tst_source, vehicle_id, station, track, direction, data)
             SELECT tst, ntp_timestamp, eke_timestamp, tst_source, vehicle_id, station, track, direction, data FROM staging.{staging} ON CONFLICT DO NOTHING;
-            DELETE FROM staging.{staging};
+            TRUNCATE staging.{staging};
             """
         ),
+        "columns": (
+            "tst",
+            "ntp_timestamp",
+            "eke_timestamp",
+            "tst_source",
+            "vehicle_id",
+            "station",
+            "track",
+            "direction",
+            "data",
+        ),
+        "types": ("timestamptz", "timestamptz", "timestamp", "text", "int4", "text", "text", "text", "jsonb"),
         "mapper": lambda data_obj: (
             data_obj["tst"],
             data_obj["ntp_timestamp"],
@@ -86,82 +216,628 @@ PG_TARGET_TABLE = {
             data_obj["station"],
             data_obj["track"],
             data_obj["direction"],
-            json.dumps(data_obj["data"], default=str),
+            data_obj["data"],
+        ),
+    },
+    "udp_messages": {
+        "primary_key": ("tst", "vehicle_id"),
+        "msg_types": (1,),
+        "query": SQL(
+            "COPY staging.{staging} (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, vehicle_id, packet_no, speed, odo, loc_x, loc_y, doors_open, standstill, train_no) FROM STDIN {options};"
+        ),
+        "post_query": SQL(
+            """
+            INSERT INTO udp_messages (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, vehicle_id, packet_no, speed, odo, loc_x, loc_y, doors_open, standstill, train_no)
+            SELECT tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, vehicle_id, packet_no, speed, odo, loc_x, loc_y, doors_open, standstill, train_no FROM staging.{staging} ON CONFLICT DO NOTHING;
+            TRUNCATE staging.{staging};
+            """
+        ),
+        "columns": (
+            "tst",
+            "ntp_timestamp",
+            "eke_timestamp",
+            "mqtt_timestamp",
+            "tst_source",
+            "vehicle_id",
+            "packet_no",
+            "speed",
+            "odo",
+            "loc_x",
+            "loc_y",
+            "doors_open",
+            "standstill",
+            "train_no",
+        ),
+        "types": (
+            "timestamptz",
+            "timestamptz",
+            "timestamp",
+            "timestamptz",
+            "text",
+            "int4",
+            "int4",
+            "float8",
+            "int4",
+            "float8",
+            "float8",
+            "bool",
+            "int4",
+            "int4",
+        ),
+        "mapper": lambda data_obj: (
+            data_obj["tst"],
+            data_obj["ntp_timestamp"],
+            data_obj["eke_timestamp"],
+            data_obj["mqtt_timestamp"],
+            data_obj["tst_source"],
+            data_obj["vehicle"],
+            data_obj["content"]["packet_no"],
+            data_obj["content"]["speed"],
+            data_obj["content"]["odo"],
+            data_obj["content"]["loc_x"],
+            data_obj["content"]["loc_y"],
+            data_obj["content"]["doors_open"],
+            data_obj["content"]["standstill"],
+            data_obj["content"]["train_no"],
         ),
     },
+    "beacon_messages": {
+        "primary_key": ("tst", "vehicle_id"),
+        "msg_types": (5,),
+        "query": SQL(
+            "COPY staging.{staging} (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, vehicle_id, balise_id, balise_id_next, balise_msg_type, direction, incomplete) FROM STDIN {options};"
+        ),
+        "post_query": SQL(
+            """
+            INSERT INTO beacon_messages (tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, vehicle_id, balise_id, balise_id_next, balise_msg_type, direction, incomplete)
+            SELECT tst, ntp_timestamp, eke_timestamp, mqtt_timestamp, tst_source, vehicle_id, balise_id, balise_id_next, balise_msg_type, direction, incomplete FROM staging.{staging} ON CONFLICT DO NOTHING;
+            TRUNCATE staging.{staging};
+            """
+        ),
+        "columns": (
+            "tst",
+            "ntp_timestamp",
+            "eke_timestamp",
+            "mqtt_timestamp",
+            "tst_source",
+            "vehicle_id",
+            "balise_id",
+            "balise_id_next",
+            "balise_msg_type",
+            "direction",
+            "incomplete",
+        ),
+        "types": (
+            "timestamptz",
+            "timestamptz",
+            "timestamp",
+            "timestamptz",
+            "text",
+            "int4",
+            "int4",
+            "int4",
+            "text",
+            "int4",
+            "bool",
+        ),
+        # Incomplete messages may miss the balise fields
+        "mapper": lambda data_obj: (
+            data_obj["tst"],
+            data_obj["ntp_timestamp"],
+            data_obj["eke_timestamp"],
+            data_obj["mqtt_timestamp"],
+            data_obj["tst_source"],
+            data_obj["vehicle"],
+            data_obj["content"].get("balise_id"),
+            data_obj["content"].get("balise_id_next"),
+            data_obj["content"].get("balise_msg_type"),
+            data_obj["content"].get("direction"),
+            bool(data_obj.get("incomplete")),
+        ),
+    },
+}
+
+# Typed tables to store parsed messages of their msg types, instead of the messages table
+(POSTGRES_TYPED_MESSAGE_TABLES,) = read_from_env(("POSTGRES_TYPED_MESSAGE_TABLES",), required=False)
+TYPED_MESSAGE_TABLES = [table for table in POSTGRES_TYPED_MESSAGE_TABLES.split(",") if table]
+MESSAGE_TABLE_BY_TYPE = {
+    msg_type: table for table in TYPED_MESSAGE_TABLES for msg_type in PG_TARGET_TABLE[table]["msg_types"]
 }
 
 
+def get_message_table(data: dict) -> str:
+    """Get the table of the parsed message. Msg types without a typed table are stored in the messages table."""
+    return MESSAGE_TABLE_BY_TYPE.get(data["msg_type"], "messages")
+
+
+def is_message_for(table: str) -> Callable[[AjoaikadataMsgWithKey], bool]:
+    """Create a filter for the parsed messages to be stored in the table."""
+    return lambda msg: get_message_table(msg[1]["data"]) == table
+
+
+def split_by_chunk(rows: List[tuple], chunk_interval_secs: float) -> List[List[tuple]]:
+    """
+    Sort the rows by the time column (the first one), and split them by the hypertable chunks.
+    Naive timestamps are in UTC, as the chunks are aligned to the UTC epoch.
+    """
+    timed_rows = sorted(((as_utc(row[0]).timestamp(), row) for row in rows), key=lambda timed_row: timed_row[0])
+
+    chunks: List[List[tuple]] = []
+    current_chunk = None
+    for timestamp, row in timed_rows:
+        chunk = timestamp // chunk_interval_secs
+        if chunk != current_chunk:
+            chunks.append([])
+            current_chunk = chunk
+        chunks[-1].append(row)
+    return chunks
+
+
+def get_completed_workers(progress: List[tuple[int, str]], worker_count: int) -> set[str] | None:
+    """
+    Get the workers whose part of the backfill range has been merged, from the (worker count, worker) rows of
+    the progress. Returns None if all the workers of a run have completed it, i.e. the whole range is done.
+    Raises ValueError if the range has been partly done with another worker count, because the msgs are divided
+    between the workers by the worker count.
+    """
+    workers_by_count: dict[int, set[str]] = {}
+    for count, worker in progress:
+        workers_by_count.setdefault(count, set()).add(worker)
+
+    if any(len(workers) >= count for count, workers in workers_by_count.items()):
+        return None
+    if set(workers_by_count) - {worker_count}:
+        raise ValueError(f"Backfill range has been partly done with {set(workers_by_count)} workers, rerun with them")
+    return workers_by_count.get(worker_count, set())
+
+
+def create_row_adapter(
+    types: tuple[str, ...], column_adapters: dict[str, Callable[[Any], Any]]
+) -> Callable[[tuple], tuple]:
+    """Create a function to convert a mapped row with the adapters of the column types, e.g. of a copy format."""
+    adapters = [column_adapters.get(column_type) for column_type in types]
+    if not any(adapters):
+        return lambda row: row
+    return lambda row: tuple(adapter(value) if adapter else value for adapter, value in zip(adapters, row))
+
+
+class CountingWriter(LibpqWriter):
+    """Copy writer which counts the bytes sent to the database."""
+
+    def __init__(self, cursor: psycopg.Cursor, target: str) -> None:
+        super().__init__(cursor)
+        self.bytes_written = BYTES_WRITTEN.labels(target)
+
+    def write(self, data) -> None:
+        self.bytes_written.inc(len(data))
+        super().write(data)
+
+
+class PoolRegistry:
+    """
+    Connection pools shared by all the Postgres clients of the process, one per connection string.
+    A pool is opened when the first user acquires it, and closed when the last user releases it.
+    Each user, i.e. sink partition, writes with one connection at a time, so the pool grows by one connection
+    per user up to `max_size`. That way, the size follows the worker count and the number of outputs.
+    """
+
+    def __init__(self, max_size: int = POSTGRES_POOL_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._pools: dict[str, psycopg_pool.ConnectionPool] = {}
+        self._users: dict[str, int] = {}
+
+    def acquire(self, conn_str: str) -> psycopg_pool.ConnectionPool:
+        with self._lock:
+            pool = self._pools.get(conn_str)
+            if not pool:
+                pool = psycopg_pool.ConnectionPool(conn_str, min_size=1, max_size=1, open=True)
+                self._pools[conn_str] = pool
+                self._users[conn_str] = 0
+            self._users[conn_str] += 1
+            pool.resize(min_size=1, max_size=min(self._users[conn_str], self.max_size))
+            return pool
+
+    def release(self, conn_str: str) -> None:
+        with self._lock:
+            self._users[conn_str] -= 1
+            if self._users[conn_str] > 0:
+                return
+            pool = self._pools.pop(conn_str)
+            del self._users[conn_str]
+        pool.close()
+
+
+POOL_REGISTRY = PoolRegistry()
+
+
 class PostgresClient:
-    def __init__(self, target: str) -> None:
-        self.pool = psycopg_pool.ConnectionPool(POSTGRES_CONN_STR, min_size=1, max_size=20)
+    """
+    Writes messages to a Postgres table through per worker staging tables.
+
+    In the streaming mode, each batch is copied to the staging table and merged to the main table.
+
+    In the backfill mode, batches are copied to UNLOGGED staging tables only. When the last worker of the process
+    closes, the staged rows are deduplicated and merged to the main table in one statement. Secondary indexes of
+    the main table are dropped for the merge and built again after it. The merge and the index changes are done
+    in one transaction, and the workers of the process are stored to staging.backfill_progress as completed for
+    the date range. If a process is interrupted, the range can be run again, and only the workers which have not
+    completed it write their rows. Each process merges only its own workers, so a rerun must use the same worker
+    count, which divides the msgs between the workers.
+    Run one backfill at a time per table, because the indexes are dropped for the merge.
+    """
+
+    def __init__(
+        self,
+        target: str,
+        copy_format: str = POSTGRES_COPY_FORMAT,
+        conn_str: str = POSTGRES_CONN_STR,
+        chunk_interval_secs: float = POSTGRES_CHUNK_INTERVAL_SECS,
+        write_mode: str = POSTGRES_WRITE_MODE,
+        backfill_range: tuple[str, str] = (START_DATE, END_DATE),
+    ) -> None:
+        if not conn_str:
+            raise ValueError("Missing env POSTGRES_CONN_STR")
+        # The pool is acquired from the registry when the client is connected
+        self.conn_str = conn_str
+        self.chunk_interval_secs = chunk_interval_secs
+        self.write_mode = write_mode
+        self.backfill_range = backfill_range
+        # Workers which have already completed the backfill range, and set if all of them have
+        self.completed_workers: set[str] = set()
+        self.skip_backfill = False
+        self.worker_count = 1
+        self.pool: psycopg_pool.ConnectionPool | None = None
+        self.users = 0
+        self._lock = threading.Lock()
 
         self.target = target
+        self.copy_format = copy_format
         self.query: SQL = PG_TARGET_TABLE[target]["query"]
         self.post_query: SQL = PG_TARGET_TABLE[target]["post_query"]
+        self.primary_key: tuple[str, ...] = PG_TARGET_TABLE[target]["primary_key"]
+        self.types: tuple[str, ...] = PG_TARGET_TABLE[target]["types"]
         self.mapper: Callable[[dict], tuple] = PG_TARGET_TABLE[target]["mapper"]
+        self.adapt_row = create_row_adapter(self.types, COLUMN_ADAPTERS[copy_format])
         self.staging_tables: List[str] = []
+        # Ids of the workers of the staging tables, which are stored to the backfill progress
+        self.staging_ids: List[str] = []
+
+    def connect(self, worker_count: int = 1) -> None:
+        """
+        Start using the shared connection pool. Each call must be paired with a call of close.
+        In the backfill mode, the first user reads the progress of the range before any of the users can write.
+        """
+        with self._lock:
+            self.pool = POOL_REGISTRY.acquire(self.conn_str)
+            self.users += 1
+            if self.users == 1 and self.write_mode == "backfill":
+                self.load_backfill_progress(worker_count)
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg.Connection]:
+        """Get a connection from the pool, and record the wait time and the connections in use."""
+        started = time.monotonic()
+        with self.pool.connection() as conn:
+            POOL_WAIT.labels(self.target).observe(time.monotonic() - started)
+            CONNECTIONS_IN_USE.labels(self.target).inc()
+            try:
+                yield conn
+            finally:
+                CONNECTIONS_IN_USE.labels(self.target).dec()
+
+    def copy_rows(self, cur: psycopg.Cursor, query: SQL, rows: Iterable[tuple]) -> None:
+        started = time.monotonic()
+        row_count = 0
+        with cur.copy(query, writer=CountingWriter(cur, self.target)) as copy:
+            if self.copy_format == "binary":
+                copy.set_types(self.types)
+            for row in rows:
+                copy.write_row(self.adapt_row(row))
+                row_count += 1
+        COPY_DURATION.labels(self.target).observe(time.monotonic() - started)
+        ROWS_WRITTEN.labels(self.target).inc(row_count)
+
+    def load_backfill_progress(self, worker_count: int) -> None:
+        """Read the workers which have completed the backfill range. Call with the lock held."""
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS staging.backfill_progress "
+                "(target TEXT, range_start DATE, range_end DATE, worker_count INT, worker TEXT, "
+                "completed_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                "PRIMARY KEY (target, range_start, range_end, worker_count, worker))"
+            )
+            progress = conn.execute(
+                "SELECT worker_count, worker FROM staging.backfill_progress "
+                "WHERE target = %s AND range_start = %s AND range_end = %s",
+                (self.target, *self.backfill_range),
+            ).fetchall()
+
+        completed_workers = get_completed_workers(progress, worker_count)
+        self.skip_backfill = completed_workers is None
+        self.completed_workers = completed_workers or set()
+        self.worker_count = worker_count
+        if self.skip_backfill:
+            logger.info(f"Backfill of {self.target} for {self.backfill_range} already completed, skipping writes")
+        elif self.completed_workers:
+            logger.info(f"Backfill of {self.target} for {self.backfill_range} completed by {self.completed_workers}")
 
     def prepare_staging_table(self, for_id: str) -> None:
-        """Create a staging table where the worker using this client copies data."""
+        """
+        Create a staging table where the worker using this client copies data. Staging tables are UNLOGGED
+        and have no indexes (LIKE copies only the columns), and they are emptied with TRUNCATE, so they cause
+        no WAL traffic or dead tuples. The name is the same on every run, so a table left by a crashed run is
+        reused. Its rows are dropped, because they have not been acked and are read again from the source.
+        """
         table_name = f"{self.target}-{for_id}"
-        with self.pool.connection() as conn:
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    SQL("CREATE TABLE IF NOT EXISTS staging.{target} (LIKE {source})").format(
+                    SQL("CREATE UNLOGGED TABLE IF NOT EXISTS staging.{target} (LIKE {source})").format(
                         target=Identifier(table_name), source=Identifier(self.target)
                     )
                 )
-        # Store table name so that it could be deleted later
-        self.staging_tables.append(table_name)
+                cur.execute(SQL("TRUNCATE staging.{target}").format(target=Identifier(table_name)))
+
+        with self._lock:
+            if not self.staging_tables:
+                # Drop the tables also if the process exits without closing the sinks
+                atexit.register(self.drop_staging_tables)
+            # Store table name so that it could be deleted later
+            self.staging_tables.append(table_name)
+            self.staging_ids.append(for_id)
 
     def insert(self, data: List[AjoaikadataMsgWithKey], id: str) -> None:
-        """Copy the batch of messages into the database."""
-        with self.pool.connection() as conn:
+        """
+        Copy the batch of messages into the database. Rows are inserted in time order, one hypertable chunk
+        at a time, so that each insert touches only one chunk and its indexes.
+        """
+        if self.write_mode == "backfill":
+            self.stage(data, id)
+            return
+
+        rows = [self.mapper(content["data"]) for key, content in data]
+        staging = Identifier(f"{self.target}-{id}")
+
+        with self.connection() as conn:
             with conn.cursor() as cur:
                 # Should be empty, but just to be sure
-                cur.execute(SQL("DELETE FROM staging.{staging}").format(staging=Identifier(f"{self.target}-{id}")))
-
-                with cur.copy(self.query.format(staging=Identifier(f"{self.target}-{id}"))) as copy:
-                    for msg in data:
-                        key, content = msg
-                        msg_data = content["data"]
+                cur.execute(SQL("TRUNCATE staging.{staging}").format(staging=staging))
 
-                        copy.write_row(self.mapper(msg_data))
+                query = self.query.format(staging=staging, options=COPY_OPTIONS[self.copy_format])
+                for chunk_rows in split_by_chunk(rows, self.chunk_interval_secs):
+                    self.copy_rows(cur, query, chunk_rows)
 
-                cur.execute(self.post_query.format(staging=Identifier(f"{self.target}-{id}")))
+                    started = time.monotonic()
+                    cur.execute(self.post_query.format(staging=staging))
+                    MERGE_DURATION.labels(self.target).observe(time.monotonic() - started)
+                    # Row count is of the first statement, the insert
+                    CONFLICT_ROWS.labels(self.target).inc(len(chunk_rows) - max(cur.rowcount, 0))
 
         logger.info(f"Inserted {len(data)} rows to PG table {self.target}")
 
-    def close(self):
-        # Delete all staging tables
-        with self.pool.connection() as conn:
+    def stage(self, data: List[AjoaikadataMsgWithKey], id: str) -> None:
+        """Copy the batch of messages to the staging table to be merged at the end of the backfill."""
+        if self.skip_backfill or id in self.completed_workers:
+            return
+
+        query = self.query.format(
+            staging=Identifier(f"{self.target}-{id}"), options=COPY_OPTIONS[self.copy_format]
+        )
+        with self.connection() as conn:
             with conn.cursor() as cur:
-                for table in self.staging_tables:
-                    cur.execute(SQL("DROP TABLE IF EXISTS staging.{table}").format(table=Identifier(table)))
-        # TODO: this way the same pool is closed multiple times causing errors on exit
-        self.pool.close()
+                self.copy_rows(cur, query, (self.mapper(content["data"]) for key, content in data))
+
+        logger.debug(f"Staged {len(data)} rows to PG table {self.target}")
+
+    def finish_backfill(self, workers: List[str]) -> None:
+        """Merge the rows staged by the workers to the main table, and mark the backfill range completed for them."""
+        staged = SQL(" UNION ALL ").join(
+            SQL("SELECT * FROM staging.{table}").format(table=Identifier(f"{self.target}-{worker}"))
+            for worker in workers
+        )
+        with self.connection() as conn:
+            with conn.transaction():
+                # Secondary indexes are built again after the merge, the primary key is needed for the conflicts
+                indexes = conn.execute(
+                    "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s "
+                    "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+                    (self.target, self.target),
+                ).fetchall()
+                for index_name, _ in indexes:
+                    conn.execute(SQL("DROP INDEX {index}").format(index=Identifier(index_name)))
+
+                started = time.monotonic()
+                cur = conn.execute(
+                    SQL(
+                        "INSERT INTO {target} SELECT DISTINCT ON ({key}) * FROM ({staged}) AS staged "
+                        "ON CONFLICT DO NOTHING"
+                    ).format(
+                        target=Identifier(self.target),
+                        key=SQL(", ").join(map(Identifier, self.primary_key)),
+                        staged=staged,
+                    )
+                )
+                merged = cur.rowcount
+                MERGE_DURATION.labels(self.target).observe(time.monotonic() - started)
+
+                for _, index_def in indexes:
+                    conn.execute(index_def)
+                with conn.cursor() as progress_cur:
+                    progress_cur.executemany(
+                        "INSERT INTO staging.backfill_progress (target, range_start, range_end, worker_count, worker) "
+                        "VALUES (%s, %s, %s, %s, %s)",
+                        [(self.target, *self.backfill_range, self.worker_count, worker) for worker in workers],
+                    )
+
+        logger.info(f"Backfill of {self.target} for {self.backfill_range} completed by {workers}, merged {merged} rows")
+
+    def close(self):
+        """Stop using the connection pool. The last user finishes the backfill and deletes the staging tables."""
+        with self._lock:
+            self.users -= 1
+            last_user = self.users == 0
+
+        try:
+            if last_user and self.write_mode == "backfill" and not self.skip_backfill:
+                workers = sorted(set(self.staging_ids) - self.completed_workers)
+                if workers:
+                    self.finish_backfill(workers)
+            if last_user:
+                self.drop_staging_tables()
+        finally:
+            POOL_REGISTRY.release(self.conn_str)
+
+    def drop_staging_tables(self) -> None:
+        """Drop the staging tables. Uses an own connection, because the pool may be closed already at exit."""
+        with self._lock:
+            tables, self.staging_tables = self.staging_tables, []
+        if not tables:
+            return
+        atexit.unregister(self.drop_staging_tables)
+
+        with psycopg.connect(self.conn_str, autocommit=True) as conn:
+            for table in tables:
+                conn.execute(SQL("DROP TABLE IF EXISTS staging.{table}").format(table=Identifier(table)))
+
+
+class BackgroundWriter:
+    """
+    Writes batches to Postgres in a thread, so that the worker can process the next batch while the previous one
+    is written. At most `queue_size` batches wait for the writer. When the queue is full, the worker is blocked.
+    Small batches are combined until there are `target_rows` rows, or the oldest row has waited `max_latency_ms`,
+    so that each transaction has a reasonable amount of rows. Everything is written on close.
+    A failed write stops the writer, and the error is raised on the next batch or on close.
+    """
+
+    def __init__(
+        self,
+        client: PostgresClient,
+        id: str,
+        queue_size: int,
+        acknowledger: "PulsarClient | None" = None,
+        target_rows: int = POSTGRES_BATCH_ROWS,
+        max_latency_ms: int = POSTGRES_BATCH_MAX_LATENCY_MS,
+    ) -> None:
+        self.client = client
+        self.id = id
+        self.acknowledger = acknowledger
+        self.target_rows = target_rows
+        self.max_latency = max_latency_ms / 1000
+        self.queue: queue.Queue[List[AjoaikadataMsgWithKey] | None] = queue.Queue(maxsize=queue_size)
+        self.error: Exception | None = None
+        self.thread = threading.Thread(target=self._run, name=f"pgwriter-{client.target}-{id}", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        buffer: List[AjoaikadataMsgWithKey] = []
+        first_buffered_at = 0.0
+        closing = False
+        while not closing:
+            # With rows in the buffer, wait for more only until the oldest row is due
+            timeout = max(0.0, first_buffered_at + self.max_latency - time.monotonic()) if buffer else None
+            try:
+                items = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                items = []
+
+            if items is None:
+                closing = True
+            elif items:
+                if not buffer:
+                    first_buffered_at = time.monotonic()
+                buffer.extend(items)
+
+            if buffer and (
+                closing
+                or len(buffer) >= self.target_rows
+                or time.monotonic() - first_buffered_at >= self.max_latency
+            ):
+                self._write(buffer)
+                buffer = []
+
+    def _write(self, items: List[AjoaikadataMsgWithKey]) -> None:
+        if self.error:
+            # Drop the rest, the error is raised in the worker
+            return
+        try:
+            write_items(self.client, items, self.id, self.acknowledger)
+        except Exception as e:
+            logger.error(f"Failed to write {len(items)} rows to PG table {self.client.target}: {e}")
+            self.error = e
+
+    def raise_error(self) -> None:
+        if self.error:
+            raise RuntimeError(f"Writing to PG table {self.client.target} failed") from self.error
+
+    def put(self, items: List[AjoaikadataMsgWithKey]) -> None:
+        self.raise_error()
+        self.queue.put(items)
+
+    def close(self) -> None:
+        """Wait for the queued batches to be written."""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+
+def write_items(
+    client: PostgresClient, items: List[AjoaikadataMsgWithKey], id: str, acknowledger: "PulsarClient | None"
+) -> None:
+    client.insert(items, id)
+    if acknowledger:
+        # Source msgs can be acked only after the rows have been committed
+        for key, content in items:
+            acknowledger.ack_msgs(content.get("msgs", []))
 
 
 class PostgresSink(StatelessSinkPartition):
-    def __init__(self, client: PostgresClient, id: str) -> None:
+    def __init__(
+        self,
+        client: PostgresClient,
+        id: str,
+        acknowledger: "PulsarClient | None" = None,
+        queue_size: int = POSTGRES_WRITE_QUEUE_SIZE,
+        worker_count: int = 1,
+    ) -> None:
         self.client = client
         self.id = id
+        self.acknowledger = acknowledger
+        self.client.connect(worker_count)
         self.client.prepare_staging_table(self.id)
+        self.writer = BackgroundWriter(client, id, queue_size, acknowledger) if queue_size > 0 else None
 
     def write_batch(self, items: List[AjoaikadataMsgWithKey]):
-        self.client.insert(items, self.id)
+        if self.writer:
+            self.writer.put(items)
+        else:
+            write_items(self.client, items, self.id, self.acknowledger)
 
     def close(self):
-        self.client.close()
+        try:
+            if self.writer:
+                self.writer.close()
+        finally:
+            self.client.close()
 
 
 class PostgresOutput(DynamicSink):
-    def __init__(self, client: PostgresClient, identifier: str = "") -> None:
+    def __init__(self, client: PostgresClient, identifier: str = "", acknowledger: "PulsarClient | None" = None) -> None:
         super().__init__()
+        if acknowledger and client.write_mode == "backfill":
+            # Staged rows are committed to the main table only when the backfill finishes, and lost if the process
+            # stops before that, so the source msgs cannot be acked after the staging.
+            raise ValueError(f"Backfill mode of PG table {client.target} does not support acking the source msgs")
         self.client = client
         # Identified is used to separate outputs if there are multiple outputs for the same target
         self.identifier = identifier
+        # If given, msg refs of the written messages are acked with this client after the rows have been committed
+        self.acknowledger = acknowledger
 
     def build(self, step_id, worker_index, worker_count):
-        return PostgresSink(self.client, id=f"{self.identifier}{worker_index}")
+        return PostgresSink(
+            self.client,
+            id=f"{self.identifier}{worker_index}",
+            acknowledger=self.acknowledger,
+            worker_count=worker_count,
+        )
@@ -1,59 +1,168 @@
 from datetime import datetime
 import json
+import threading
+import time
 from typing import List
 
 from bytewax.outputs import DynamicSink, StatelessSinkPartition
 from bytewax.inputs import DynamicSource, StatelessSourcePartition
+from prometheus_client import Counter, Histogram
 
 import pulsar
 
-from ..util.ajoaikadatamsg import AjoaikadataMsgWithKey
+from . import pulsar_memory
+from ..util.ajoaikadatamsg import AjoaikadataMsgWithKey, MsgRef
 
-from ..util.config import read_from_env
+from ..util.config import logger, read_from_env
 
-PULSAR_CONN_STR, PULSAR_CLIENT_NAME = read_from_env(
-    ("PULSAR_CONN_STR", "PULSAR_CLIENT_NAME"), defaults=("pulsar://pulsar:6650",)
+(PULSAR_CONN_STR,) = read_from_env(("PULSAR_CONN_STR",), defaults=("pulsar://pulsar:6650",))
+(
+    PULSAR_COMPRESSION,
+    PULSAR_BATCHING_MAX_MESSAGES,
+    PULSAR_BATCHING_MAX_PUBLISH_DELAY_MS,
+    PULSAR_MAX_IN_FLIGHT,
+    PULSAR_MAX_UNACKED_IDS,
+) = read_from_env(
+    (
+        "PULSAR_COMPRESSION",
+        "PULSAR_BATCHING_MAX_MESSAGES",
+        "PULSAR_BATCHING_MAX_PUBLISH_DELAY_MS",
+        "PULSAR_MAX_IN_FLIGHT",
+        "PULSAR_MAX_UNACKED_IDS",
+    ),
+    defaults=("LZ4", "1000", "10", "1000", "100000"),
 )
+PULSAR_BATCHING_MAX_MESSAGES = int(PULSAR_BATCHING_MAX_MESSAGES)
+PULSAR_BATCHING_MAX_PUBLISH_DELAY_MS = int(PULSAR_BATCHING_MAX_PUBLISH_DELAY_MS)
+PULSAR_MAX_IN_FLIGHT = int(PULSAR_MAX_IN_FLIGHT)
+PULSAR_MAX_UNACKED_IDS = int(PULSAR_MAX_UNACKED_IDS)
+
+# Timestamp fields of the messages. They are sent as iso strings and converted back to datetimes when received.
+TIMESTAMP_FIELDS = (
+    "tst",
+    "tst_corrected",
+    "ntp_timestamp",
+    "eke_timestamp",
+    "mqtt_timestamp",
+    "released_mqtt_timestamp",
+)
+
+COMPRESSION_TYPES = {
+    "NONE": pulsar.CompressionType.NONE,
+    "LZ4": pulsar.CompressionType.LZ4,
+    "ZLIB": pulsar.CompressionType.ZLib,
+    "ZSTD": pulsar.CompressionType.ZSTD,
+    "SNAPPY": pulsar.CompressionType.SNAPPY,
+}
+
+SEND_LATENCY = Histogram("pulsar_send_latency_seconds", "Time from send to the broker receipt", ["topic"])
+SEND_ERRORS = Counter("pulsar_send_errors_total", "Messages the broker failed to receive", ["topic"])
+
+
+def decode_data(content: bytes) -> dict | None:
+    """Decode the JSON content of a pulsar message, including timestamps."""
+    data = json.loads(content)
+    if data:
+        for field in TIMESTAMP_FIELDS:
+            if isinstance(data.get(field), str):
+                data[field] = datetime.fromisoformat(data[field])
+    return data
+
+
+def to_msg_ref(message_id: pulsar.MessageId) -> MsgRef:
+    """Convert pulsar message id to a compact msg ref."""
+    return (message_id.ledger_id(), message_id.entry_id(), message_id.partition(), message_id.batch_index())
+
+
+def create_client(conn_str: str = PULSAR_CONN_STR) -> pulsar.Client | pulsar_memory.Client:
+    """Create the pulsar client. Use the in-memory stand-in if the connection string starts with memory://"""
+    if conn_str.startswith("memory://"):
+        return pulsar_memory.Client(conn_str)
+    return pulsar.Client(conn_str)
 
 
 class PulsarClient:
-    def __init__(self, topic_name: str) -> None:
-        self.client = pulsar.Client(PULSAR_CONN_STR)
+    def __init__(self, topic_name: str, max_unacked_ids: int = PULSAR_MAX_UNACKED_IDS) -> None:
+        self.client = create_client()
+        # Read when the client is created, so that multiple dataflows can be set up in the same process.
+        (self.client_name,) = read_from_env(("PULSAR_CLIENT_NAME",))
         self.topic_name = topic_name
-        self.producer: pulsar.Producer | None = None
+        # A consumer can subscribe to a comma separated list of topics
+        self.topic_names = topic_name.split(",")
+        self.producer: DeliveryTrackedProducer | None = None
         self.consumer: pulsar.Consumer | None = None
+        # The client is shared by the workers of the process
+        self._lock = threading.Lock()
+        # Received but not yet acked message ids. Keeping the original ids keeps the batch ack tracking of pulsar intact.
+        # Msgs which are never acked would stay here, so the oldest ids are dropped after `max_unacked_ids`.
+        # A dropped id is built again from the ref if the msg is acked later.
+        self.max_unacked_ids = max_unacked_ids
+        self.unacked: dict[MsgRef, pulsar.MessageId] = {}
 
     def get_consumer(self, worker_index: int = 0) -> pulsar.Consumer:
-        """Get the pulsar consumer. If not already initialized, subscribe the configured topic."""
-        if not self.consumer:
-            self.consumer = self.client.subscribe(
-                self.topic_name,
-                subscription_name=PULSAR_CLIENT_NAME,
-                consumer_name=f"{PULSAR_CLIENT_NAME}-{worker_index}",
-                consumer_type=pulsar.ConsumerType.KeyShared,
-            )
+        """Get the pulsar consumer. If not already initialized, subscribe the configured topics."""
+        with self._lock:
+            if not self.consumer:
+                self.consumer = self.client.subscribe(
+                    self.topic_names if len(self.topic_names) > 1 else self.topic_name,
+                    subscription_name=self.client_name,
+                    consumer_name=f"{self.client_name}-{worker_index}",
+                    consumer_type=pulsar.ConsumerType.KeyShared,
+                )
 
-        return self.consumer
-
-    def get_producer(self, worker_index: int = 0) -> pulsar.Producer:
-        """Get the pulsar producer. If not already initialized, create one for the configured topic."""
-        if not self.producer:
-            self.producer = self.client.create_producer(
-                self.topic_name,
-                producer_name=f"{PULSAR_CLIENT_NAME}-{worker_index}",
-                block_if_queue_full=True,
-                batching_enabled=True,
-                batching_max_publish_delay_ms=10,
-            )
-        return self.producer
+            return self.consumer
 
-    def ack_msgs(self, msgs: List[str]) -> None:
+    def get_producer(self, worker_index: int = 0) -> "DeliveryTrackedProducer":
+        """
+        Get the pulsar producer. If not already initialized, create one for the configured topic.
+        The producer is shared, and it is closed when all the users have closed it.
+        """
+        with self._lock:
+            if not self.producer:
+                self.producer = DeliveryTrackedProducer(
+                    self.client.create_producer(
+                        self.topic_name,
+                        producer_name=f"{self.client_name}-{worker_index}",
+                        compression_type=COMPRESSION_TYPES[PULSAR_COMPRESSION.upper()],
+                        max_pending_messages=PULSAR_MAX_IN_FLIGHT,
+                        block_if_queue_full=True,
+                        batching_enabled=True,
+                        batching_max_messages=PULSAR_BATCHING_MAX_MESSAGES,
+                        batching_max_publish_delay_ms=PULSAR_BATCHING_MAX_PUBLISH_DELAY_MS,
+                    ),
+                    self.topic_name,
+                )
+            self.producer.acquire()
+            return self.producer
+
+    def track_msg(self, msg: pulsar.Message) -> MsgRef:
+        """Store the id of the received message and return the ref to be passed with the bytewax message."""
+        message_id = msg.message_id()
+        ref = to_msg_ref(message_id)
+        with self._lock:
+            self.unacked[ref] = message_id
+            if len(self.unacked) > self.max_unacked_ids:
+                del self.unacked[next(iter(self.unacked))]
+        return ref
+
+    def ack_msgs(self, msgs: List[MsgRef]) -> None:
         """Acknowledge the pulsar msgs related to the bytewax message"""
         if not self.consumer:
             raise TypeError("Client not configured as a consumer. Cannot ack the messages")
 
-        for msg in msgs:
-            self.consumer.acknowledge(pulsar.MessageId.deserialize(msg))
+        for ref in msgs:
+            with self._lock:
+                message_id = self.unacked.pop(ref, None)
+            if message_id is None:
+                if len(self.topic_names) > 1:
+                    # The consumer of many topics needs the topic of the id, which is not in the ref.
+                    # The msg is redelivered when the consumer reconnects.
+                    logger.warning(f"Cannot ack msg {ref} of topics {self.topic_name}, its id has been dropped")
+                    continue
+                # Not received by this client, build the id from the ref
+                ledger_id, entry_id, partition, batch_index = ref
+                message_id = pulsar.MessageId(partition, ledger_id, entry_id, batch_index)
+            self.consumer.acknowledge(message_id)
 
     def ack(self, inspector, data: AjoaikadataMsgWithKey):
         """Ack all related pulsar messages from a bytewax message."""
@@ -75,6 +184,70 @@ class PulsarClient:
         self.client.close()
 
 
+class DeliveryTrackedProducer:
+    """
+    Wrapper for pulsar producer to keep track of the sent messages.
+    At most `max_in_flight` messages are waiting for the broker receipt at once. Failed sends are collected,
+    and raised on flush, so that the upstream messages are not acked before the data has been delivered.
+    """
+
+    def __init__(self, producer: pulsar.Producer, topic_name: str, max_in_flight: int = PULSAR_MAX_IN_FLIGHT) -> None:
+        self.producer = producer
+        self.topic_name = topic_name
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.errors: list[pulsar.Result] = []
+        self.users = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        """Register a new user of the producer. Each call must be paired with a call of close."""
+        with self._cond:
+            self.users += 1
+
+    def _delivered(self, sent_at: float, res: pulsar.Result, msg_id: pulsar.MessageId) -> None:
+        SEND_LATENCY.labels(self.topic_name).observe(time.monotonic() - sent_at)
+        with self._cond:
+            if res != pulsar.Result.Ok:
+                SEND_ERRORS.labels(self.topic_name).inc()
+                self.errors.append(res)
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def send(self, content: bytes, partition_key: str) -> None:
+        """Send the message asynchronously. Blocks if the in-flight window is full."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.max_in_flight)
+            self.in_flight += 1
+
+        sent_at = time.monotonic()
+        self.producer.send_async(
+            content,
+            callback=lambda res, msg_id: self._delivered(sent_at, res, msg_id),
+            partition_key=partition_key,
+        )
+
+    def flush(self) -> None:
+        """Wait until all sent messages are delivered. Raise an error if any of them failed."""
+        self.producer.flush()
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight == 0)
+            errors, self.errors = self.errors, []
+
+        if errors:
+            logger.error(f"Failed to send {len(errors)} msgs to topic {self.topic_name}: {set(errors)}")
+            raise RuntimeError(f"Pulsar delivery to topic {self.topic_name} failed")
+
+    def close(self) -> None:
+        self.flush()
+        # The producer is shared between sinks, so close it only after the last one
+        with self._cond:
+            self.users -= 1
+            last_user = self.users == 0
+        if last_user:
+            self.producer.close()
+
+
 class PulsarSource(StatelessSourcePartition):
     def __init__(self, client: PulsarClient, worker_index: int):
         self.client = client
@@ -88,7 +261,7 @@ class PulsarSource(StatelessSourcePartition):
         return [
             (
                 msg.partition_key(),
-                {"msgs": [msg.message_id().serialize()], "data": json.loads(msg.data())},
+                {"msgs": [self.client.track_msg(msg)], "data": decode_data(msg.data())},
             )
             for msg in msgs
         ]
@@ -107,25 +280,35 @@ class PulsarInput(DynamicSource):
 
 
 class PulsarSink(StatelessSinkPartition):
-    def __init__(self, client: PulsarClient, worker_index: int):
+    def __init__(self, client: PulsarClient, worker_index: int, acknowledger: PulsarClient | None = None):
         self.client = client
         self.producer = self.client.get_producer(worker_index)
+        self.acknowledger = acknowledger
 
     def write_batch(self, items: List[AjoaikadataMsgWithKey]):
         for msg in items:
             key, content = msg
             msg_data = json.dumps(content.get("data"), default=str)
-            self.producer.send_async(msg_data.encode("utf-8"), callback=None, partition_key=key)
+            self.producer.send(msg_data.encode("utf-8"), partition_key=key)
 
-    def close(self):
+        if not self.acknowledger:
+            return
+
+        # Upstream msgs can be acked only after the batch has been delivered.
         self.producer.flush()
+        for key, content in items:
+            self.acknowledger.ack_msgs(content.get("msgs", []))
+
+    def close(self):
         self.producer.close()
 
 
 class PulsarOutput(DynamicSink):
-    def __init__(self, client: PulsarClient) -> None:
+    def __init__(self, client: PulsarClient, acknowledger: PulsarClient | None = None) -> None:
         super().__init__()
         self.client = client
+        # If given, msg refs of the written messages are acked with this client after the delivery
+        self.acknowledger = acknowledger
 
     def build(self, step_id, worker_index: int, worker_count: int):
-        return PulsarSink(self.client, worker_index)
+        return PulsarSink(self.client, worker_index, self.acknowledger)
@@ -0,0 +1,354 @@
+"""
+In-memory stand-in for the Pulsar client. Used when PULSAR_CONN_STR is `memory://`, so that the dataflows
+using Pulsar can be run in one process without a broker, e.g. for local runs, CI and benchmarks.
+
+Only the parts of the pulsar client API used by the Pulsar connector are implemented:
+- Key shared subscriptions. Each key is sticky to one consumer while the consumer is connected.
+- Subscriptions to a list of topics. The msgs of each topic stay in order, but the topics are not ordered.
+- Acknowledgements and redelivery. Unacked msgs are redelivered on negative ack or when the consumer is closed.
+- End of stream. When all the producers of a topic have been closed, consumers raise StopIteration
+  after their queue is empty. That ends the bytewax input partition.
+
+Like in Pulsar, msgs are dispatched only to subscriptions existing at the time of sending.
+Use `create_subscription` to declare the subscriptions before the producers start.
+"""
+
+from collections import deque
+from itertools import count
+import threading
+import time
+from typing import Callable, Iterable
+from zlib import crc32
+
+import pulsar
+
+# How many msgs one batch_receive returns at most, and how long it waits for them
+BATCH_MAX_MSGS = 100
+BATCH_TIMEOUT_SECS = 0.1
+
+_consumer_ids = count()
+
+
+class MessageId:
+    def __init__(self, ledger_id: int, entry_id: int) -> None:
+        self._ledger_id = ledger_id
+        self._entry_id = entry_id
+
+    def ledger_id(self) -> int:
+        return self._ledger_id
+
+    def entry_id(self) -> int:
+        return self._entry_id
+
+    def partition(self) -> int:
+        return -1
+
+    def batch_index(self) -> int:
+        return -1
+
+
+class Message:
+    def __init__(self, message_id: MessageId, content: bytes, partition_key: str) -> None:
+        self._message_id = message_id
+        self._content = content
+        self._partition_key = partition_key
+        self.redelivery_count = 0
+
+    def message_id(self) -> MessageId:
+        return self._message_id
+
+    def data(self) -> bytes:
+        return self._content
+
+    def partition_key(self) -> str:
+        return self._partition_key
+
+
+class _Subscription:
+    def __init__(self, name: str, lock: threading.Condition) -> None:
+        self.name = name
+        self.lock = lock
+        self.consumers: list[str] = []
+        # Msgs waiting for a consumer, and dispatched but not yet received msgs per consumer
+        self.backlog: deque[Message] = deque()
+        self.queues: dict[str, deque[Message]] = {}
+        # Received but not acked msgs per entry id, with the consumer who received it
+        self.unacked: dict[int, tuple[str, Message]] = {}
+        # Key -> consumer. Keys stay with the same consumer to keep the order per key.
+        self.key_owners: dict[str, str] = {}
+
+    def _owner(self, key: str) -> str:
+        owner = self.key_owners.get(key)
+        if not owner:
+            owner = self.consumers[crc32(key.encode("utf-8")) % len(self.consumers)]
+            self.key_owners[key] = owner
+        return owner
+
+    def dispatch(self, msgs: Iterable[Message]) -> None:
+        """Move msgs to the queues of the consumers. Call with the lock held."""
+        if not self.consumers:
+            self.backlog.extend(msgs)
+            return
+        for msg in msgs:
+            self.queues[self._owner(msg.partition_key())].append(msg)
+        self.lock.notify_all()
+
+    def redeliver(self, msgs: list[Message]) -> None:
+        """Dispatch msgs again, in the original order. Call with the lock held."""
+        for msg in msgs:
+            msg.redelivery_count += 1
+        self.dispatch(sorted(msgs, key=lambda m: m.message_id().entry_id()))
+
+    def add_consumer(self, consumer_name: str) -> None:
+        """Call with the lock held."""
+        self.consumers.append(consumer_name)
+        self.queues[consumer_name] = deque()
+        backlog, self.backlog = list(self.backlog), deque()
+        self.dispatch(backlog)
+
+    def remove_consumer(self, consumer_name: str) -> None:
+        """Call with the lock held. Msgs of the consumer are redelivered to the others."""
+        self.consumers.remove(consumer_name)
+        self.key_owners = {key: owner for key, owner in self.key_owners.items() if owner != consumer_name}
+        not_received = list(self.queues.pop(consumer_name))
+        not_acked = [msg for entry_id, (owner, msg) in self.unacked.items() if owner == consumer_name]
+        for msg in not_acked:
+            del self.unacked[msg.message_id().entry_id()]
+        self.redeliver(not_acked + not_received)
+
+
+class _Topic:
+    def __init__(self, name: str, ledger_id: int) -> None:
+        self.name = name
+        self.ledger_id = ledger_id
+        self.lock = threading.Condition()
+        self.next_entry_id = 0
+        self.subscriptions: dict[str, _Subscription] = {}
+        self.open_producers = 0
+        self.had_producers = False
+
+    @property
+    def sealed(self) -> bool:
+        """All producers of the topic are closed, no more msgs will come."""
+        return self.had_producers and self.open_producers == 0
+
+    def subscription(self, name: str) -> _Subscription:
+        """Get or create a subscription. Call with the lock held."""
+        if name not in self.subscriptions:
+            self.subscriptions[name] = _Subscription(name, self.lock)
+        return self.subscriptions[name]
+
+    def publish(self, content: bytes, partition_key: str) -> MessageId:
+        with self.lock:
+            message_id = MessageId(self.ledger_id, self.next_entry_id)
+            self.next_entry_id += 1
+            for sub in self.subscriptions.values():
+                sub.dispatch((Message(message_id, content, partition_key),))
+        return message_id
+
+
+class Broker:
+    """Topics shared by all clients of the process."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.topics: dict[str, _Topic] = {}
+
+    def topic(self, name: str) -> _Topic:
+        with self._lock:
+            if name not in self.topics:
+                self.topics[name] = _Topic(name, len(self.topics))
+            return self.topics[name]
+
+    def create_subscription(self, topic_name: str, subscription_name: str) -> None:
+        """Declare a subscription, so that msgs are kept for it even before the consumers have connected."""
+        topic = self.topic(topic_name)
+        with topic.lock:
+            topic.subscription(subscription_name)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.topics = {}
+
+
+BROKER = Broker()
+
+
+class Consumer:
+    def __init__(self, topic: _Topic, subscription_name: str, consumer_name: str) -> None:
+        self._topic = topic
+        # Consumer names are not required to be unique, so use an internal id for the dispatching
+        self._consumer_name = f"{consumer_name}#{next(_consumer_ids)}"
+        with topic.lock:
+            self._sub = topic.subscription(subscription_name)
+            self._sub.add_consumer(self._consumer_name)
+
+    def topic(self) -> str:
+        return self._topic.name
+
+    def subscription_name(self) -> str:
+        return self._sub.name
+
+    def batch_receive(self, timeout_secs: float = BATCH_TIMEOUT_SECS) -> list[Message]:
+        """Receive the queued msgs. Raises StopIteration if the topic has been sealed and all msgs are received."""
+        with self._topic.lock:
+            queue = self._sub.queues.get(self._consumer_name)
+            if queue is None:
+                # Consumer has been closed
+                raise StopIteration()
+            if not queue:
+                if self._topic.sealed and not self._sub.backlog:
+                    raise StopIteration()
+                if timeout_secs:
+                    self._topic.lock.wait(timeout_secs)
+
+            msgs = [queue.popleft() for _ in range(min(len(queue), BATCH_MAX_MSGS))]
+            for msg in msgs:
+                self._sub.unacked[msg.message_id().entry_id()] = (self._consumer_name, msg)
+            return msgs
+
+    def receive(self) -> Message:
+        while True:
+            msgs = self.batch_receive()
+            if msgs:
+                # Return the rest to the queue
+                with self._topic.lock:
+                    for msg in reversed(msgs[1:]):
+                        del self._sub.unacked[msg.message_id().entry_id()]
+                        self._sub.queues[self._consumer_name].appendleft(msg)
+                return msgs[0]
+
+    def acknowledge(self, message) -> None:
+        message_id = message.message_id() if isinstance(message, Message) else message
+        with self._topic.lock:
+            self._sub.unacked.pop(message_id.entry_id(), None)
+
+    def negative_acknowledge(self, message) -> None:
+        message_id = message.message_id() if isinstance(message, Message) else message
+        with self._topic.lock:
+            unacked = self._sub.unacked.pop(message_id.entry_id(), None)
+            if unacked:
+                self._sub.redeliver([unacked[1]])
+
+    def redeliver_unacknowledged_messages(self) -> None:
+        with self._topic.lock:
+            msgs = [msg for owner, msg in self._sub.unacked.values() if owner == self._consumer_name]
+            for msg in msgs:
+                del self._sub.unacked[msg.message_id().entry_id()]
+            self._sub.redeliver(msgs)
+
+    def close(self) -> None:
+        with self._topic.lock:
+            if self._consumer_name in self._sub.consumers:
+                self._sub.remove_consumer(self._consumer_name)
+
+
+class MultiTopicsConsumer:
+    """Consumer of a list of topics, with a consumer of the same subscription on each topic."""
+
+    def __init__(self, consumers: list[Consumer]) -> None:
+        # Consumers by the ledger id of the topic, which is a part of the msg id
+        self._consumers = {consumer._topic.ledger_id: consumer for consumer in consumers}
+
+    def topic(self) -> str:
+        return ",".join(consumer.topic() for consumer in self._consumers.values())
+
+    def subscription_name(self) -> str:
+        return next(iter(self._consumers.values())).subscription_name()
+
+    def batch_receive(self) -> list[Message]:
+        """Receive the queued msgs of all the topics. Raises StopIteration when all the topics have ended."""
+        msgs: list[Message] = []
+        ended = 0
+        for consumer in self._consumers.values():
+            try:
+                msgs.extend(consumer.batch_receive(timeout_secs=0))
+            except StopIteration:
+                ended += 1
+        if ended == len(self._consumers):
+            raise StopIteration()
+        if not msgs:
+            time.sleep(BATCH_TIMEOUT_SECS)
+        return msgs
+
+    def _consumer_of(self, message) -> Consumer:
+        message_id = message.message_id() if isinstance(message, Message) else message
+        return self._consumers[message_id.ledger_id()]
+
+    def acknowledge(self, message) -> None:
+        self._consumer_of(message).acknowledge(message)
+
+    def negative_acknowledge(self, message) -> None:
+        self._consumer_of(message).negative_acknowledge(message)
+
+    def redeliver_unacknowledged_messages(self) -> None:
+        for consumer in self._consumers.values():
+            consumer.redeliver_unacknowledged_messages()
+
+    def close(self) -> None:
+        for consumer in self._consumers.values():
+            consumer.close()
+
+
+class Producer:
+    def __init__(self, topic: _Topic, producer_name: str) -> None:
+        self._topic = topic
+        self._producer_name = producer_name
+        self._closed = False
+        with topic.lock:
+            topic.open_producers += 1
+            topic.had_producers = True
+
+    def topic(self) -> str:
+        return self._topic.name
+
+    def producer_name(self) -> str:
+        return self._producer_name
+
+    def send(self, content: bytes, partition_key: str | None = None, **kwargs) -> MessageId:
+        return self._topic.publish(content, partition_key or "")
+
+    def send_async(
+        self,
+        content: bytes,
+        callback: Callable[[pulsar.Result, MessageId], None] | None,
+        partition_key: str | None = None,
+        **kwargs,
+    ) -> None:
+        message_id = self.send(content, partition_key)
+        if callback:
+            callback(pulsar.Result.Ok, message_id)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        with self._topic.lock:
+            self._topic.open_producers -= 1
+            self._topic.lock.notify_all()
+
+
+class Client:
+    """Drop-in for pulsar.Client. The connection string is ignored, all clients share the process-wide broker."""
+
+    def __init__(self, service_url: str = "memory://", broker: Broker = BROKER) -> None:
+        self.broker = broker
+
+    def subscribe(
+        self, topic: str | list[str], subscription_name: str, consumer_name: str | None = None, **kwargs
+    ) -> Consumer | MultiTopicsConsumer:
+        consumer_name = consumer_name or subscription_name
+        if isinstance(topic, list):
+            return MultiTopicsConsumer(
+                [Consumer(self.broker.topic(name), subscription_name, consumer_name) for name in topic]
+            )
+        return Consumer(self.broker.topic(topic), subscription_name, consumer_name)
+
+    def create_producer(self, topic: str, producer_name: str | None = None, **kwargs) -> Producer:
+        return Producer(self.broker.topic(topic), producer_name or topic)
+
+    def close(self) -> None:
+        pass
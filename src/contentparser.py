@@ -2,8 +2,13 @@
 Content parser is a bytewax app to convert binary content of messages to human readable format.
 It also combines balise messages and stores the direction, as balise messages are received in parts.
 Both input and output is Pulsar.
+
+The input can be a comma separated list of topics, when the reader routes the msg types to separate topics.
+The msgs of a vehicle are then merged back by tst in the vehicle pipeline.
 """
 
+from functools import partial
+
 import bytewax.operators as op
 from bytewax.dataflow import Dataflow
 
@@ -11,16 +16,17 @@ from .connectors.pulsar import PulsarInput, PulsarOutput, PulsarClient
 
 from .ekeparser.schemas.jkv_beacon import JKVBeaconDataSchema
 
-from .operations.balisedirection import create_directions_for_balises, create_empty_balise_cache
-from .operations.baliseparts import combine_balise_parts, create_empty_parts_cache
-
-from .operations.parsing import raw_msg_to_eke
+from .operations.parsing import is_parse_failure, raw_msg_to_eke, to_dead_letter
+from .operations.vehiclepipeline import VehiclePipelineLogic
 from .util.config import read_from_env
 
 input_topic, output_topic = read_from_env(("PULSAR_INPUT_TOPIC", "PULSAR_OUTPUT_TOPIC"))
+input_topics = input_topic.split(",")
+(dead_letter_topic,) = read_from_env(("PULSAR_DEAD_LETTER_TOPIC",), defaults=(f"{input_topics[0]}-deadletter",))
 
 input_client = PulsarClient(input_topic)
 output_client = PulsarClient(output_topic)
+dead_letter_client = PulsarClient(dead_letter_topic)
 
 BEACON_DATA_SCHEMA = JKVBeaconDataSchema()
 
@@ -28,21 +34,20 @@ BEACON_DATA_SCHEMA = JKVBeaconDataSchema()
 flow = Dataflow("contentparser")
 stream = op.input("contentparser_in", flow, PulsarInput(input_client))
 eke_stream = op.map("raw_msg_to_eke", stream, raw_msg_to_eke)
-eke_stream = op.filter_map("filter_none_raw_msg_to_eke", eke_stream, input_client.ack_filter_none)
 
-eke_stream_with_balises = op.stateful_map(
-    "combine_balises", eke_stream, lambda: create_empty_parts_cache(), combine_balise_parts
-)
-eke_stream_with_balises = op.filter_map(
-    "filter_none_combine_balises", eke_stream_with_balises, input_client.ack_filter_none
-)
+# Msgs that failed to parse go to the dead letter topic with the raw payload, and are acked after that
+parse_results = op.branch("split_parse_failures", eke_stream, is_parse_failure)
+dead_letters = op.map("to_dead_letter", parse_results.trues, to_dead_letter)
+op.output("dead_letter_out", dead_letters, PulsarOutput(dead_letter_client, acknowledger=input_client))
 
-eke_stream_complete = op.stateful_map(
-    "balise_direction", eke_stream_with_balises, lambda: create_empty_balise_cache(), create_directions_for_balises
-)
-eke_stream_with_balises_dirs = op.filter_map(
-    "filter_none_balise_direction", eke_stream_complete, input_client.ack_filter_none
+eke_stream = op.filter_map("filter_none_raw_msg_to_eke", parse_results.falses, input_client.ack_filter_none)
+
+# Timestamps, ordering and balises as in the single dataflow
+vehicle_pipeline = partial(VehiclePipelineLogic, split_input=len(input_topics) > 1)
+eke_stream_complete = op.unary("vehicle_pipeline", eke_stream, vehicle_pipeline)
+eke_stream_complete = op.filter_map(
+    "filter_none_vehicle_pipeline", eke_stream_complete, input_client.ack_filter_none
 )
 
-op.output("contentparser_out", eke_stream_with_balises_dirs, PulsarOutput(output_client))
-op.inspect("contentparser_ack", eke_stream_with_balises_dirs, input_client.ack)
+# Input msgs are acked after the output has been delivered
+op.output("contentparser_out", eke_stream_complete, PulsarOutput(output_client, acknowledger=input_client))
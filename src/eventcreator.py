@@ -10,8 +10,8 @@ from bytewax.dataflow import Dataflow
 from .connectors.pulsar import PulsarInput, PulsarOutput, PulsarClient
 
 from .operations.common import filter_none
-from .operations.events import create_events, create_empty_state
-from .operations.stationevents import create_station_events, init_vehicle_station_cache
+from .operations.events import create_events
+from .operations.stationevents import create_station_events
 
 from .util.config import read_from_env
 
@@ -23,22 +23,10 @@ output_client = PulsarClient(output_topic)
 
 flow = Dataflow("eventcreator")
 stream = op.input("eventcreator_in", flow, PulsarInput(input_client))
-event_stream = op.stateful_map(
-    "event_creator",
-    stream,
-    lambda: create_empty_state(),
-    create_events,
-)
+event_stream = op.stateful_map("event_creator", stream, create_events)
 event_stream = op.filter_map("filter_none_event_creator", event_stream, input_client.ack_filter_none)
-op.output("events_out", event_stream, PulsarOutput(output_client))
-op.inspect(
-    "eventcreator_ack", event_stream, input_client.ack
-)  # ack here, because there is no need for original msgs any more
-station_stream = op.stateful_map(
-    "station_event_creator",
-    event_stream,
-    lambda: init_vehicle_station_cache(),
-    create_station_events,
-)
+# ack here, because there is no need for original msgs any more. Acks are sent after the events have been delivered.
+op.output("events_out", event_stream, PulsarOutput(output_client, acknowledger=input_client))
+station_stream = op.stateful_map("station_event_creator", event_stream, create_station_events)
 station_stream = op.filter_map("station_combiner_filtered", station_stream, filter_none)
 op.output("stations_out", station_stream, PulsarOutput(output_client))
@@ -0,0 +1,98 @@
+"""
+Local chain runs the Pulsar microservices (reader, contentparser, eventcreator and the pg sinks) in one process.
+Pulsar is replaced by the in-memory stand-in, so no broker is needed. This is meant for end-to-end tests
+and throughput benchmarks. Services are configured the same way as in compose-with-pulsar.yml.
+
+Reader reads csv files from CSV_DATA_DIR. Pg sinks are started only if POSTGRES_CONN_STR is given.
+
+Usage (from the repository root):
+    CSV_DATA_DIR=./data python -m src.localchain -w 2
+"""
+
+import argparse
+import importlib.util
+import os
+import threading
+import time
+
+from bytewax.dataflow import Dataflow
+from bytewax.run import cli_main
+
+# Use the in-memory Pulsar before the connector is imported
+os.environ["PULSAR_CONN_STR"] = "memory://"
+
+from .connectors.pulsar_memory import BROKER
+from .util.config import logger
+
+# Service module and env, in the order of the chain
+SERVICES: list[tuple[str, dict[str, str]]] = [
+    ("contentparser", {"PULSAR_CLIENT_NAME": "contentparser", "PULSAR_INPUT_TOPIC": "raw", "PULSAR_OUTPUT_TOPIC": "parsed"}),
+    ("eventcreator", {"PULSAR_CLIENT_NAME": "eventcreator", "PULSAR_INPUT_TOPIC": "parsed", "PULSAR_OUTPUT_TOPIC": "events"}),
+    ("reader", {"PULSAR_CLIENT_NAME": "reader", "PULSAR_OUTPUT_TOPIC": "raw"}),
+]
+SINK_SERVICES: list[tuple[str, dict[str, str]]] = [
+    ("pgsink", {"PULSAR_CLIENT_NAME": "messagesink", "PULSAR_INPUT_TOPIC": "parsed", "POSTGRES_TARGET_TABLE": "messages"}),
+    ("pgsink", {"PULSAR_CLIENT_NAME": "eventsink", "PULSAR_INPUT_TOPIC": "events", "POSTGRES_TARGET_TABLE": "events"}),
+]
+# With split topics, the reader routes the msg types to their own topics, and contentparser reads all of them
+SPLIT_TOPIC_ENVS: dict[str, dict[str, str]] = {
+    "reader": {
+        "PULSAR_OUTPUT_TOPIC_UDP": "raw-udp",
+        "PULSAR_OUTPUT_TOPIC_BEACON": "raw-beacon",
+        "PULSAR_OUTPUT_TOPIC_OTHER": "raw-other",
+    },
+    "contentparser": {"PULSAR_INPUT_TOPIC": "raw-udp,raw-beacon,raw-other"},
+}
+
+
+def _load_flow(module_name: str, env: dict[str, str]) -> Dataflow:
+    """Import a fresh copy of the service module with the given env, so the same module can be used many times."""
+    os.environ.update(env)
+    if "PULSAR_INPUT_TOPIC" in env:
+        # Subscribe before any of the producers start, otherwise the first msgs would be lost.
+        for topic in env["PULSAR_INPUT_TOPIC"].split(","):
+            BROKER.create_subscription(topic, env["PULSAR_CLIENT_NAME"])
+
+    spec = importlib.util.find_spec(f".{module_name}", __package__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.flow
+
+
+def run_chain(workers: int = 1, with_sinks: bool = True, split_topics: bool = False) -> dict[str, int]:
+    """Run all services until the input is consumed. Returns the count of msgs sent to each topic."""
+    services = SERVICES + (SINK_SERVICES if with_sinks else [])
+    if split_topics:
+        services = [(module_name, {**env, **SPLIT_TOPIC_ENVS.get(module_name, {})}) for module_name, env in services]
+    flows = [(env["PULSAR_CLIENT_NAME"], _load_flow(module_name, env)) for module_name, env in services]
+
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=cli_main, args=(flow,), kwargs={"workers_per_process": workers}, name=name)
+        for name, flow in flows
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    msg_counts = {name: topic.next_entry_id for name, topic in BROKER.topics.items()}
+    logger.info(f"Local chain finished in {elapsed:.1f} s. Msgs per topic: {msg_counts}")
+    for name, count in msg_counts.items():
+        logger.info(f"Topic {name}: {count / elapsed:.0f} msgs/s")
+    return msg_counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the Pulsar microservices in one process without a broker.")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Workers per service")
+    parser.add_argument("--no-sinks", action="store_true", help="Do not start the Postgres sinks")
+    parser.add_argument("--split-topics", action="store_true", help="Route the raw msgs to a topic per msg type")
+    args = parser.parse_args()
+
+    run_chain(
+        args.workers,
+        with_sinks=not args.no_sinks and bool(os.environ.get("POSTGRES_CONN_STR")),
+        split_topics=args.split_topics,
+    )
@@ -1,22 +1,42 @@
 """
 Operations related to combine single balise messages from the same balise group as a one message with direction.
+
+A balise message waits in the cache for the other balise of the group until the stream time of the vehicle (the latest
+ntp timestamp seen) has passed it by the max time difference. Then it is released as incomplete.
 """
-from typing import TypeAlias
 
-from ..util.ajoaikadatamsg import AjoaikadataMsg, create_empty_msg, calculate_time_diff
+from datetime import datetime, timedelta
+from typing import TypedDict
+
+from prometheus_client import Gauge
+
+from ..util.ajoaikadatamsg import AjoaikadataMsg, calculate_time_diff, merge_msg_refs
 
 from ..util.config import logger
+from .streamtime import ExpiryEntry, StreamTimeLogic, first_expiry, pop_expired, push_expiry
 
 # The max difference (in seconds) for timestamps to be allowed for balise group messages to be considered in the same passage
 BALISE_GROUP_MAX_MSG_TIME_DIFF = 30
 
+CACHE_SIZE = Gauge("balise_direction_cache_size", "Balise messages waiting for the direction")
+
 
-BaliseDirectionCache: TypeAlias = dict[int, AjoaikadataMsg]
+class BaliseDirectionCache(TypedDict):
+    # Balise messages waiting for the other balise of the group, by balise id
+    balises: dict[int, AjoaikadataMsg]
+    # The balise messages by their expiry. Messages removed from `balises` are dropped from here lazily.
+    expiry: list[ExpiryEntry]
+    # Seq of the next expiry entry
+    seq: int
+    # The latest ntp timestamp seen, i.e. the stream time
+    max_tst: datetime | None
+    # The latest mqtt timestamp seen, stored to the released incomplete messages
+    last_mqtt_timestamp: datetime | None
 
 
 def create_empty_balise_cache() -> BaliseDirectionCache:
     """Create a new cache."""
-    return {}
+    return {"balises": {}, "expiry": [], "seq": 0, "max_tst": None, "last_mqtt_timestamp": None}
 
 
 def _calculate_direction(balise_msg1: AjoaikadataMsg, balise_msg2: AjoaikadataMsg) -> AjoaikadataMsg:
@@ -44,25 +64,63 @@ def _calculate_direction(balise_msg1: AjoaikadataMsg, balise_msg2: AjoaikadataMs
     del data_obj["content"]["balise_cba"]
     data_obj["content"]["direction"] = direction
 
-    combined_msg: AjoaikadataMsg = {"msgs": balise_msg1.get("msgs", []) + balise_msg2.get("msgs", []), "data": data_obj}
+    combined_msg: AjoaikadataMsg = {"msgs": merge_msg_refs(balise_msg1, balise_msg2), "data": data_obj}
 
     return combined_msg
 
 
+def _to_incomplete(msg: AjoaikadataMsg, released_mqtt_timestamp: datetime | None) -> AjoaikadataMsg:
+    logger.warning(f"Balise direction could not be resolved for msg: {msg}")
+    msg["data"]["incomplete"] = True
+    msg["data"]["released_mqtt_timestamp"] = released_mqtt_timestamp
+    return msg
+
+
+def release_expired_balises(balise_cache: BaliseDirectionCache, stream_time: datetime | None) -> list[AjoaikadataMsg]:
+    """
+    Release the messages older than the max time difference from the stream time, as incomplete.
+    If stream time is None, all the messages are released.
+    """
+    expires_until = (
+        stream_time - timedelta(seconds=BALISE_GROUP_MAX_MSG_TIME_DIFF) if stream_time is not None else None
+    )
+    return [
+        _to_incomplete(msg, balise_cache["last_mqtt_timestamp"])
+        for msg in pop_expired(balise_cache["balises"], balise_cache["expiry"], expires_until)
+    ]
+
+
+def get_time_to_expiry(balise_cache: BaliseDirectionCache) -> timedelta | None:
+    """How much the stream time must advance before the oldest message expires"""
+    oldest = first_expiry(balise_cache["balises"], balise_cache["expiry"])
+    if not oldest or not balise_cache["max_tst"]:
+        return None
+    return max(oldest + timedelta(seconds=BALISE_GROUP_MAX_MSG_TIME_DIFF) - balise_cache["max_tst"], timedelta())
+
+
 def create_directions_for_balises(
     balise_cache: BaliseDirectionCache | None, value: AjoaikadataMsg
-) -> tuple[BaliseDirectionCache, AjoaikadataMsg]:
+) -> tuple[BaliseDirectionCache, list[AjoaikadataMsg]]:
     if not balise_cache:
         balise_cache = create_empty_balise_cache()
 
     data = value["data"]
 
+    if not data:
+        return balise_cache, [value]
+
+    if not balise_cache["max_tst"] or data["ntp_timestamp"] > balise_cache["max_tst"]:
+        balise_cache["max_tst"] = data["ntp_timestamp"]
+    balise_cache["last_mqtt_timestamp"] = data["mqtt_timestamp"]
+
+    msgs = release_expired_balises(balise_cache, balise_cache["max_tst"])
+
     # No complete balise message, skip
     if data["msg_type"] != 5 or data.get("incomplete"):
-        return balise_cache, value
+        return balise_cache, msgs + [value]
 
     balise_id = data["content"]["balise_id"]
-    prev_msg_with_same_id = balise_cache.get(balise_id)
+    prev_msg_with_same_id = balise_cache["balises"].get(balise_id)
 
     if prev_msg_with_same_id:
         time_diff = calculate_time_diff(prev_msg_with_same_id, value)
@@ -70,24 +128,53 @@ def create_directions_for_balises(
         # Check the time limit
         if abs(time_diff) < BALISE_GROUP_MAX_MSG_TIME_DIFF:
             # Reset cache
-            del balise_cache[balise_id]
+            del balise_cache["balises"][balise_id]
             # Combine message with direction. Pass messages in the order based on the time diff.
             combined_msg = (
                 _calculate_direction(prev_msg_with_same_id, value)
                 if time_diff > 0
                 else _calculate_direction(value, prev_msg_with_same_id)
             )
-            return balise_cache, combined_msg
+            return balise_cache, msgs + [combined_msg]
 
         # Time diff was too big. Release the old message
-        msg_to_send = prev_msg_with_same_id
-        logger.warning(f"Balise direction could not be resolved for msg: {prev_msg_with_same_id}")
-        msg_to_send["data"]["incomplete"] = True
-        msg_to_send["data"]["released_mqtt_timestamp"] = value["data"]["mqtt_timestamp"]
-
-    else:
-        msg_to_send = create_empty_msg()
+        msgs.append(_to_incomplete(prev_msg_with_same_id, data["mqtt_timestamp"]))
 
     # Store balise data to the cache
-    balise_cache[balise_id] = value
-    return balise_cache, msg_to_send
+    balise_cache["balises"][balise_id] = value
+    push_expiry(balise_cache["expiry"], balise_cache["seq"], balise_id, value)
+    balise_cache["seq"] += 1
+    return balise_cache, msgs
+
+
+class BaliseDirectionLogic(StreamTimeLogic[BaliseDirectionCache]):
+    """
+    Bytewax logic to resolve the balise directions of a vehicle. Use with op.unary:
+        op.unary("balise_direction", stream, BaliseDirectionLogic)
+    """
+
+    def __init__(self, resume_state: BaliseDirectionCache | None, idle_advance: bool = True) -> None:
+        super().__init__(resume_state or create_empty_balise_cache(), idle_advance)
+        # Size of the cache included in the metric, which is the total of all the vehicles
+        self.reported_size = 0
+
+    def _report_size(self) -> None:
+        size = len(self.state["balises"])
+        CACHE_SIZE.inc(size - self.reported_size)
+        self.reported_size = size
+
+    def process(self, value: AjoaikadataMsg) -> list[AjoaikadataMsg]:
+        self.state, msgs = create_directions_for_balises(self.state, value)
+        self._report_size()
+        return msgs
+
+    def get_stream_time(self) -> datetime | None:
+        return self.state["max_tst"]
+
+    def release(self, stream_time: datetime | None) -> list[AjoaikadataMsg]:
+        msgs = release_expired_balises(self.state, stream_time)
+        self._report_size()
+        return msgs
+
+    def get_time_to_release(self) -> timedelta | None:
+        return get_time_to_expiry(self.state)
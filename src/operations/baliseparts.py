@@ -1,31 +1,95 @@
 """
 Operations related to combine balise message parts into one.
 # TODO: The order could be resolved already in udporder -module and the cache could be removed?
+
+A part waits in the cache for its pair until the stream time of the vehicle (the latest ntp timestamp seen) has
+passed it by the max time difference. Then it is released as incomplete.
 """
-from typing import TypeAlias
 
-from ..util.ajoaikadatamsg import AjoaikadataMsg, create_empty_msg, calculate_time_diff
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+from types import MappingProxyType
+from typing import Mapping, TypedDict
+
+from prometheus_client import Counter
+
+from ..util.ajoaikadatamsg import AjoaikadataMsg, calculate_time_diff, merge_msg_refs
 from ..ekeparser.schemas.jkv_beacon import JKVBeaconDataSchema
 
-from ..util.config import logger
+from ..util.config import logger, read_from_env
+from .streamtime import ExpiryEntry, StreamTimeLogic, first_expiry, pop_expired, push_expiry
 
 # The max difference (in seconds) for timestamps to be allowed for balise messages to be combined
 BALISE_MAX_MSG_TIME_DIFF = 5
 
+# How many decoded balise telegrams are kept in memory. Fixed balises send always the same telegrams.
+(BALISE_TELEGRAM_CACHE_SIZE,) = read_from_env(("BALISE_TELEGRAM_CACHE_SIZE",), defaults=("4096",))
+BALISE_TELEGRAM_CACHE_SIZE = int(BALISE_TELEGRAM_CACHE_SIZE)
+
+TELEGRAM_CACHE_LOOKUPS = Counter(
+    "balise_telegram_cache_lookups_total", "Lookups of decoded balise telegrams by result", ["result"]
+)
+TELEGRAM_CACHE_HITS = TELEGRAM_CACHE_LOOKUPS.labels("hit")
+TELEGRAM_CACHE_MISSES = TELEGRAM_CACHE_LOOKUPS.labels("miss")
+
 
 BEACON_DATA_SCHEMA = JKVBeaconDataSchema()
 
 
-BalisePartsCache: TypeAlias = list[AjoaikadataMsg | None]
+class TelegramCache:
+    """
+    LRU cache of decoded balise telegrams by the combined payload.
+    Shared by all the vehicles and the workers of the process.
+    The decoded content is read-only, because the same object is returned for every lookup.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._telegrams: OrderedDict[bytes, Mapping] = OrderedDict()
+
+    def decode(self, payload: bytes) -> Mapping:
+        with self._lock:
+            telegram = self._telegrams.get(payload)
+            if telegram is not None:
+                self._telegrams.move_to_end(payload)
+                TELEGRAM_CACHE_HITS.inc()
+                return telegram
+
+        TELEGRAM_CACHE_MISSES.inc()
+        telegram = MappingProxyType(BEACON_DATA_SCHEMA.parse_content(payload) or {})
+        with self._lock:
+            self._telegrams[payload] = telegram
+            if len(self._telegrams) > self.max_size:
+                self._telegrams.popitem(last=False)
+        return telegram
+
+
+TELEGRAM_CACHE = TelegramCache(BALISE_TELEGRAM_CACHE_SIZE)
+
+
+class BalisePartsCache(TypedDict):
+    # Parts waiting for the pair, by msg index
+    parts: dict[int, AjoaikadataMsg]
+    # The parts by their expiry. Parts removed from `parts` are dropped from here lazily.
+    expiry: list[ExpiryEntry]
+    # Seq of the next expiry entry
+    seq: int
+    # The latest ntp timestamp seen, i.e. the stream time
+    max_tst: datetime | None
+    # The latest mqtt timestamp seen, stored to the released incomplete parts
+    last_mqtt_timestamp: datetime | None
 
 
 def create_empty_parts_cache() -> BalisePartsCache:
-    return [None] * 256
+    return {"parts": {}, "expiry": [], "seq": 0, "max_tst": None, "last_mqtt_timestamp": None}
 
 
 def _parse_balise_msg_from_parts(msg_part1: AjoaikadataMsg, msg_part2: AjoaikadataMsg) -> AjoaikadataMsg:
     payload = msg_part1["data"]["content"]["content"] + msg_part2["data"]["content"]["content"]
-    parsed_data = BEACON_DATA_SCHEMA.parse_content(payload)
+    # Copy of the shared content, because the later steps modify the content of the msg
+    parsed_data = dict(TELEGRAM_CACHE.decode(payload))
 
     # Get the base content from the first part
     data_obj = msg_part1["data"]
@@ -34,25 +98,56 @@ def _parse_balise_msg_from_parts(msg_part1: AjoaikadataMsg, msg_part2: Ajoaikada
     # Get the last arrived timestamp, because it triggers the msg forward
     data_obj["mqtt_timestamp"] = max(msg_part1["data"]["mqtt_timestamp"], msg_part2["data"]["mqtt_timestamp"])
 
-    combined_msg: AjoaikadataMsg = {"msgs": msg_part1.get("msgs", []) + msg_part2.get("msgs", []), "data": data_obj}
+    combined_msg: AjoaikadataMsg = {"msgs": merge_msg_refs(msg_part1, msg_part2), "data": data_obj}
 
     return combined_msg
 
 
+def _to_incomplete(msg: AjoaikadataMsg, released_mqtt_timestamp: datetime | None) -> AjoaikadataMsg:
+    logger.warning(f"Single balise msg in the cache which could not be resolved: {msg}")
+    msg["data"]["released_mqtt_timestamp"] = released_mqtt_timestamp
+    msg["data"]["incomplete"] = True
+    return msg
+
+
+def release_expired_parts(parts_cache: BalisePartsCache, stream_time: datetime | None) -> list[AjoaikadataMsg]:
+    """
+    Release the parts older than the max time difference from the stream time, as incomplete.
+    If stream time is None, all the parts are released.
+    """
+    expires_until = stream_time - timedelta(seconds=BALISE_MAX_MSG_TIME_DIFF) if stream_time is not None else None
+    return [
+        _to_incomplete(msg, parts_cache["last_mqtt_timestamp"])
+        for msg in pop_expired(parts_cache["parts"], parts_cache["expiry"], expires_until)
+    ]
+
+
+def get_time_to_expiry(parts_cache: BalisePartsCache) -> timedelta | None:
+    """How much the stream time must advance before the oldest part expires"""
+    oldest = first_expiry(parts_cache["parts"], parts_cache["expiry"])
+    if not oldest or not parts_cache["max_tst"]:
+        return None
+    return max(oldest + timedelta(seconds=BALISE_MAX_MSG_TIME_DIFF) - parts_cache["max_tst"], timedelta())
+
+
 def combine_balise_parts(
     parts_cache: BalisePartsCache | None, value: AjoaikadataMsg
-) -> tuple[BalisePartsCache, AjoaikadataMsg]:
+) -> tuple[BalisePartsCache, list[AjoaikadataMsg]]:
     if not parts_cache:
         parts_cache = create_empty_parts_cache()
 
     data = value["data"]
 
     if not data:
-        return parts_cache, value
+        return parts_cache, [value]
+
+    if not parts_cache["max_tst"] or data["ntp_timestamp"] > parts_cache["max_tst"]:
+        parts_cache["max_tst"] = data["ntp_timestamp"]
+    parts_cache["last_mqtt_timestamp"] = data["mqtt_timestamp"]
 
     # No balise message, skip
     if data["msg_type"] != 5:
-        return parts_cache, value
+        return parts_cache, release_expired_parts(parts_cache, parts_cache["max_tst"]) + [value]
 
     msg_index: int = data["content"]["msg_index"]
     msg_part: int = data["content"]["transponder_msg_part"]
@@ -62,29 +157,50 @@ def combine_balise_parts(
     # Depending on the part, the next line gets either next or previous index.
     msg_index_pair = (msg_index + 1) % 256 or 1 if msg_part == 0 else (msg_index - 1) % 256 or 255
 
-    paired_data = parts_cache[msg_index_pair]
+    paired_data = parts_cache["parts"].get(msg_index_pair)
 
     # Combine messages if there was a pair and their time difference fits in the limit.
     if paired_data and abs(calculate_time_diff(value, paired_data)) < BALISE_MAX_MSG_TIME_DIFF:
         # Reset cache
-        parts_cache[msg_index_pair] = None
+        del parts_cache["parts"][msg_index_pair]
         # Combine message, pass parts in the right order
         combined_msg = (
             _parse_balise_msg_from_parts(value, paired_data)
             if msg_part == 0
             else _parse_balise_msg_from_parts(paired_data, value)
         )
-        return parts_cache, combined_msg
+        return parts_cache, release_expired_parts(parts_cache, parts_cache["max_tst"]) + [combined_msg]
 
-    # Store the message to the cache, release the old message marked with incomplete=True
-    old_cache = parts_cache[msg_index]
+    # Release the old message with the same index, and the expired ones, marked with incomplete=True
+    msgs = release_expired_parts(parts_cache, parts_cache["max_tst"])
+    old_cache = parts_cache["parts"].get(msg_index)
     if old_cache:
-        msg_to_send = old_cache
-        logger.warning(f"Single balise msg in the cache which could not be resolved: {old_cache}")
-        msg_to_send["data"]["released_mqtt_timestamp"] = value["data"]["mqtt_timestamp"]
-        msg_to_send["data"]["incomplete"] = True
-    else:
-        msg_to_send = create_empty_msg()
-    parts_cache[msg_index] = value
-
-    return parts_cache, msg_to_send
+        msgs.append(_to_incomplete(old_cache, data["mqtt_timestamp"]))
+    parts_cache["parts"][msg_index] = value
+    push_expiry(parts_cache["expiry"], parts_cache["seq"], msg_index, value)
+    parts_cache["seq"] += 1
+
+    return parts_cache, msgs
+
+
+class BalisePartsLogic(StreamTimeLogic[BalisePartsCache]):
+    """
+    Bytewax logic to combine the balise parts of a vehicle. Use with op.unary:
+        op.unary("combine_balises", stream, BalisePartsLogic)
+    """
+
+    def __init__(self, resume_state: BalisePartsCache | None, idle_advance: bool = True) -> None:
+        super().__init__(resume_state or create_empty_parts_cache(), idle_advance)
+
+    def process(self, value: AjoaikadataMsg) -> list[AjoaikadataMsg]:
+        self.state, msgs = combine_balise_parts(self.state, value)
+        return msgs
+
+    def get_stream_time(self) -> datetime | None:
+        return self.state["max_tst"]
+
+    def release(self, stream_time: datetime | None) -> list[AjoaikadataMsg]:
+        return release_expired_parts(self.state, stream_time)
+
+    def get_time_to_release(self) -> timedelta | None:
+        return get_time_to_expiry(self.state)
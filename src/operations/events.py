@@ -6,7 +6,7 @@ from datetime import datetime
 from typing import Tuple, TypeAlias, TypedDict
 
 from ..util.ajoaikadatamsg import AjoaikadataMsg, EKEMessageTypeWithMQTTDetails
-from ..util.balise_registry import balise_registry
+from ..util.balise_registry import balise_registry, registry_key
 
 from ..util.config import logger
 
@@ -142,43 +142,45 @@ def _check_station_event(last_state: StationState, data: EKEMessageTypeWithMQTTD
     tst = data["tst"]
     balise_id = data["content"]["balise_id"]
     direction = data["content"]["direction"]
-    balise_key = f"{balise_id}_{direction}"
 
-    balise_data = balise_registry.get(balise_key)
+    # Take the registry once, because it may be replaced by a reload
+    registry = balise_registry.current
+    balise_data = registry.balises.get(registry_key(balise_id, direction))
 
     if not balise_data:
         # Early return if balise didn't exist in the registry
         return last_state, None
 
     event_msg_data = {
-        "station": balise_data["station"],
-        "track": balise_data["track"],
-        "direction": balise_data["train_direction"],
-        "triggered_by": balise_key,
+        "station": balise_data.station,
+        "track": balise_data.track,
+        "direction": balise_data.train_direction,
+        "triggered_by": balise_data.key,
+        "registry_version": registry.version,
     }
 
     # check if any of the fields has changed
     if (
-        last_state["station"] != balise_data["station"]
-        or last_state["track"] != balise_data["track"]
-        or last_state["direction"] != balise_data["train_direction"]
-        or last_state["event"] != balise_data["type"].lower()
+        last_state["station"] != balise_data.station
+        or last_state["track"] != balise_data.track
+        or last_state["direction"] != balise_data.train_direction
+        or last_state["event"] != balise_data.event_type
     ):
         if last_state["last_updated"] and tst < last_state["last_updated"]:
             logger.warning(f"Tried to trigger balise event, but the message was old. Discarding {data}")
             return last_state, None
 
         # if changed, update last_station_event data and send event
-        last_state["station"] = balise_data["station"]
-        last_state["track"] = balise_data["track"]
-        last_state["direction"] = balise_data["train_direction"]
-        last_state["event"] = balise_data["type"].lower()
+        last_state["station"] = balise_data.station
+        last_state["track"] = balise_data.track
+        last_state["direction"] = balise_data.train_direction
+        last_state["event"] = balise_data.event_type
         last_state["last_updated"] = tst
 
-        return last_state, _create_event(data, balise_data["type"].lower(), event_msg_data)
+        return last_state, _create_event(data, balise_data.event_type, event_msg_data)
 
     # Balise found but nothing needed to be updated. Send event for debuggin purposes.
-    return last_state, _create_event(data, f"{balise_data['type'].lower()}_debug", event_msg_data)
+    return last_state, _create_event(data, f"{balise_data.event_type}_debug", event_msg_data)
 
 
 def create_events(state: VehicleState | None, value: AjoaikadataMsg) -> tuple[VehicleState, AjoaikadataMsg]:
@@ -4,15 +4,26 @@ Operations related to parsing messages.
 
 from datetime import datetime
 
+from prometheus_client import Counter
+
 from ..ekeparser.ekeparser import parse_topic, parse_eke_data
+from ..ekeparser.schemas.eke_message import header_parser
 from ..util.ajoaikadatamsg import (
     AjoaikadataMsgWithKey,
     AjoaikadataRawMsgWithKey,
     EKEMessageTypeWithMQTTDetails,
     CSVRawMessage,
+    DeadLetter,
 )
 
-from ..util.config import logger
+from ..util.config import RateLimitedLogger, read_from_env
+
+(PARSE_ERROR_LOG_INTERVAL_SECS,) = read_from_env(("PARSE_ERROR_LOG_INTERVAL_SECS",), defaults=("60",))
+
+PARSE_FAILURES = Counter("eke_parse_failures_total", "Raw messages that could not be parsed", ["msg_type", "msg_version"])
+
+# A broken schema fails every message of the type, so log only once in a while per type and version
+parse_error_logger = RateLimitedLogger(float(PARSE_ERROR_LOG_INTERVAL_SECS))
 
 
 def csv_to_bytewax_msg(value: dict) -> AjoaikadataRawMsgWithKey:
@@ -28,28 +39,85 @@ def csv_to_bytewax_msg(value: dict) -> AjoaikadataRawMsgWithKey:
     return vehicle, {"data": data}
 
 
+def _parse_raw_header(raw: str) -> tuple[int, int] | None:
+    """Read the msg type and version from the first two bytes of the hex encoded raw message."""
+    if len(raw) < 4:
+        return None
+
+    try:
+        msg_type, _, msg_version, _ = header_parser(bytes.fromhex(raw[:4]))
+        return msg_type, msg_version
+    except ValueError:
+        return None
+
+
+def get_raw_msg_type(msg: AjoaikadataRawMsgWithKey) -> int | None:
+    """Read the msg type from the header of the raw message without parsing the whole content."""
+    key, value = msg
+    data = value["data"]
+    if not data:
+        return None
+
+    header = _parse_raw_header(data["raw"])
+    return header[0] if header else None
+
+
+def create_dead_letter(data: CSVRawMessage, error: Exception) -> DeadLetter:
+    """Describe the failed message for the dead letter sink. Counts the failure and logs it, rate limited."""
+    msg_type, msg_version = _parse_raw_header(data["raw"]) or (None, None)
+    PARSE_FAILURES.labels(str(msg_type), str(msg_version)).inc()
+    parse_error_logger.log(
+        (msg_type, msg_version),
+        f"Failed to parse eke data of msg type {msg_type} version {msg_version}: {type(error).__name__}: {error}",
+    )
+
+    return {
+        "raw": data["raw"],
+        "topic": data["topic"],
+        "mqtt_timestamp": str(data["mqtt_timestamp"]),
+        "msg_type": msg_type,
+        "msg_version": msg_version,
+        "error_class": type(error).__name__,
+        "error": str(error),
+    }
+
+
+def is_parse_failure(msg: AjoaikadataMsgWithKey) -> bool:
+    key, value = msg
+    return "dead_letter" in value
+
+
+def to_dead_letter(msg: AjoaikadataMsgWithKey) -> tuple[str, dict]:
+    """Make the dead letter the content of the message, so that it can be written to a sink."""
+    key, value = msg
+    return key, {"data": value["dead_letter"], "msgs": value.get("msgs", [])}
+
+
 def raw_msg_to_eke(msg: AjoaikadataRawMsgWithKey) -> AjoaikadataMsgWithKey:
     key, value = msg
     data = value["data"]
+    # Pass the pulsar msg refs on, so that the source msg can be acked
+    refs = value.get("msgs", [])
 
     if not data:
-        return (key, {"data": None})
+        return (key, {"data": None, "msgs": refs})
 
-    mqtt_timestamp = datetime.fromisoformat(data["mqtt_timestamp"])
+    mqtt_timestamp = data["mqtt_timestamp"]
+    if isinstance(mqtt_timestamp, str):
+        mqtt_timestamp = datetime.fromisoformat(mqtt_timestamp)
     vehicle, msg_type = parse_topic(data["topic"])
 
     # Filter special case away. The message content should not be parsed.
     if msg_type == "connectionStatus":
-        return (key, {"data": None})
+        return (key, {"data": None, "msgs": refs})
 
     try:
         parsed = parse_eke_data(data["raw"])
         if parsed:
             result: EKEMessageTypeWithMQTTDetails = {**parsed, "mqtt_timestamp": mqtt_timestamp, "vehicle": int(vehicle)}
-            return (key, {"data": result})
+            return (key, {"data": result, "msgs": refs})
 
-        return (key, {"data": None})
+        return (key, {"data": None, "msgs": refs})
 
     except Exception as e:
-        logger.error(f"Failed to parse eke data.\n{e}\nValue was: {value}")
-        return (key, {"data": None})
+        return (key, {"data": None, "msgs": refs, "dead_letter": create_dead_letter(data, e)})
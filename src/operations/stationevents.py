@@ -22,6 +22,8 @@ class StationStateCache(TypedDict):
     time_doors_last_closed: datetime | None
     time_departed: datetime | None
     arrival_vehicle_state: VehicleState | None
+    # Version of the balise registry which gave the station
+    registry_version: str | None
 
 
 class StationEvent(TypedDict):
@@ -68,7 +70,8 @@ def _create_event(data: Event, station_state: StationStateCache, trigger_time: d
         | {
             k: station_state[k]
             for k in station_state.keys() & {"time_arrived", "time_doors_last_closed", "time_departed"}
-        },
+        }
+        | {"registry_version": station_state.get("registry_version")},
     }
 
 
@@ -82,6 +85,7 @@ def create_empty_stationstate_cache() -> StationStateCache:
         "time_doors_last_closed": None,
         "time_departed": None,
         "arrival_vehicle_state": None,
+        "registry_version": None,
     }
 
 
@@ -114,6 +118,7 @@ def create_station_events(
             last_station_state["station"] = data["data"]["station"]
             last_station_state["track"] = data["data"]["track"]
             last_station_state["direction"] = data["data"]["direction"]
+            last_station_state["registry_version"] = data["data"].get("registry_version")
 
             # Override the values that are earlier than the event.
             for tst_field in ("time_arrived", "time_doors_last_closed", "time_departed"):
@@ -149,6 +154,7 @@ def create_station_events(
                 last_station_state["station"] = data["data"]["station"]
                 last_station_state["track"] = data["data"]["track"]
                 last_station_state["direction"] = data["data"]["direction"]
+                last_station_state["registry_version"] = data["data"].get("registry_version")
 
             if not last_station_state["arrival_vehicle_state"]:
                 last_station_state["arrival_vehicle_state"] = vehicle_state
@@ -0,0 +1,115 @@
+"""
+Base logic for the operations that hold the messages of a vehicle in a cache until the stream time has passed them.
+
+The stream time of a vehicle is the latest event time seen. If the vehicle stops sending, the stream time is advanced
+by the wall clock time since it last advanced, so that the cache is released also without new messages.
+At the end of the input, the whole cache is released.
+
+Cached messages which expire by the stream time are kept in a heap by their timestamp, so that the expired ones are
+popped from the front instead of scanning the whole cache on every message.
+
+The idle advance depends on the processing speed, so it is turned off when replaying stored data, e.g. from Azure.
+Then the results depend only on the input, and the cache of an idle vehicle is released at the end of the input.
+"""
+
+import copy
+from datetime import datetime, timedelta, timezone
+import heapq
+from typing import Iterable, TypeAlias, TypeVar
+
+from bytewax.operators import UnaryLogic
+
+from ..util.ajoaikadatamsg import AjoaikadataMsg
+
+S = TypeVar("S")
+
+# Cached msg in the expiry heap: (ntp timestamp, seq, key in the cache, msg). The seq orders the msgs with the same
+# timestamp, so that the msg dicts are never compared.
+ExpiryEntry: TypeAlias = tuple[datetime, int, int, AjoaikadataMsg]
+
+
+def push_expiry(expiry: list[ExpiryEntry], seq: int, key: int, msg: AjoaikadataMsg) -> None:
+    heapq.heappush(expiry, (msg["data"]["ntp_timestamp"], seq, key, msg))
+
+
+def _drop_removed(cached: dict[int, AjoaikadataMsg], expiry: list[ExpiryEntry]) -> None:
+    """Drop the entries from the front of the heap whose msgs have already been removed from the cache"""
+    while expiry and cached.get(expiry[0][2]) is not expiry[0][3]:
+        heapq.heappop(expiry)
+
+
+def pop_expired(
+    cached: dict[int, AjoaikadataMsg], expiry: list[ExpiryEntry], expires_until: datetime | None
+) -> list[AjoaikadataMsg]:
+    """
+    Remove the msgs with the timestamp at or before `expires_until` from the cache, in timestamp order.
+    If it is None, all the msgs are removed.
+    """
+    msgs: list[AjoaikadataMsg] = []
+    _drop_removed(cached, expiry)
+    while expiry and (expires_until is None or expiry[0][0] <= expires_until):
+        _, _, key, msg = heapq.heappop(expiry)
+        msgs.append(cached.pop(key))
+        _drop_removed(cached, expiry)
+    return msgs
+
+
+def first_expiry(cached: dict[int, AjoaikadataMsg], expiry: list[ExpiryEntry]) -> datetime | None:
+    """Timestamp of the oldest msg in the cache"""
+    _drop_removed(cached, expiry)
+    return expiry[0][0] if expiry else None
+
+
+class StreamTimeLogic(UnaryLogic[AjoaikadataMsg, AjoaikadataMsg, S]):
+    """
+    Bytewax logic with the cache of a vehicle in `state`. Subclasses implement the hooks with the functions of their
+    module: process a message, read the stream time, release the cache by the stream time and tell how much the stream
+    time must advance before the next release.
+    """
+
+    def __init__(self, state: S, idle_advance: bool = True) -> None:
+        self.state = state
+        self.idle_advance = idle_advance
+        # Wall clock time when the stream time was last advanced
+        self.advanced_at = datetime.now(timezone.utc)
+
+    def process(self, value: AjoaikadataMsg) -> list[AjoaikadataMsg]:
+        raise NotImplementedError
+
+    def get_stream_time(self) -> datetime | None:
+        raise NotImplementedError
+
+    def release(self, stream_time: datetime | None) -> list[AjoaikadataMsg]:
+        """Release the messages passed by the stream time. If stream time is None, all the messages are released."""
+        raise NotImplementedError
+
+    def get_time_to_release(self) -> timedelta | None:
+        raise NotImplementedError
+
+    def on_item(self, value: AjoaikadataMsg) -> tuple[Iterable[AjoaikadataMsg], bool]:
+        stream_time = self.get_stream_time()
+        msgs = self.process(value)
+        if self.get_stream_time() != stream_time:
+            self.advanced_at = datetime.now(timezone.utc)
+        return msgs, UnaryLogic.RETAIN
+
+    def on_notify(self) -> tuple[Iterable[AjoaikadataMsg], bool]:
+        stream_time = self.get_stream_time()
+        if stream_time is None:
+            return [], UnaryLogic.RETAIN
+        idle_time = datetime.now(timezone.utc) - self.advanced_at
+        return self.release(stream_time + idle_time), UnaryLogic.RETAIN
+
+    def on_eof(self) -> tuple[Iterable[AjoaikadataMsg], bool]:
+        return self.release(None), UnaryLogic.RETAIN
+
+    def notify_at(self) -> datetime | None:
+        if not self.idle_advance:
+            return None
+        time_to_release = self.get_time_to_release()
+        if time_to_release is None:
+            return None
+        return self.advanced_at + time_to_release
+
+    def snapshot(self) -> S:
+        return copy.deepcopy(self.state)
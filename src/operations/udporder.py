@@ -1,77 +1,146 @@
 """
 Operations to order UDP messages.
+
+UDP messages are ordered by timestamp, and held in a cache while waiting for the missing ones. The packet_no is used
+only to detect the missing messages: the next message is released immediately if it has the next packet_no.
+The release is driven by a watermark in event time: the latest timestamp seen for the vehicle minus the max lateness.
+When the watermark passes a cached message, the missing messages before it are not waited anymore, and the cache is
+released up to the next gap. So a lost packet delays the following messages at most by the max lateness.
+
+Other message types have no sequence numbers to wait for. They wait only while a UDP message with an earlier timestamp
+is in the cache, and are released merged by timestamp with the UDP messages. So the output of a vehicle is ordered by
+timestamp, except for the messages arriving after later ones have already been released: too old UDP messages, which
+are marked as discarded, and other messages older than the last released message. These are released on arrival.
+Because of the ordering, a lost UDP packet delays the later balise messages too, at most by the max lateness.
+
+Both caches are limited to the max size. Over it, the oldest messages are released without waiting.
+
+When the message types are read from separate topics (see the reader), a message can be overtaken by an earlier
+message of another type. Then the input is split, and all the messages wait until the watermark has passed them, so
+that the topics are merged back by timestamp. The messages later than the max lateness are handled as above.
+
+The watermark follows the stream time of the vehicle, see the streamtime module.
 """
 
 from datetime import datetime, timedelta
 import heapq
-from typing import TypedDict
+from typing import TypeAlias, TypedDict
 
 from ..util.ajoaikadatamsg import AjoaikadataMsg
-from ..util.config import logger
+from ..util.config import logger, read_from_env
+from .streamtime import StreamTimeLogic
 
-# How many messages can be stored in the cache.
+# How long (in seconds of event time) a message waits for the missing messages before it.
+(UDP_REORDER_MAX_LATENESS_SECS,) = read_from_env(("UDP_REORDER_MAX_LATENESS_SECS",), defaults=("5",))
+MAX_LATENESS = timedelta(seconds=float(UDP_REORDER_MAX_LATENESS_SECS))
+# Hard limit for the size of both caches, in case the timestamps are not reliable.
 CACHE_MAX_SIZE = 1000
 # If last message was more than this amount of seconds late, do not release the message immidiately.
 UNEXPECTED_TIME_DIFF = 30
 
 
-# Tuple structure for Ajoaikadata msg comparison
-# Needed, because tuples can't be compared, if timestamps are the same. (Dicts are not comparable.)
-class UDPCacheItem(tuple):
-    def __new__(cls, item: tuple[datetime, AjoaikadataMsg]):
-        return tuple.__new__(UDPCacheItem, item)
-
-    def __lt__(self, other):  # To override > operator
-        return self[0] < other[0]
-
-    def __gt__(self, other):  # To override < operator
-        return self[0] > other[0]
+# Cache entry: (tst, seq, packet_no, msg). The seq is a running counter, so that tuples with the same
+# timestamp are ordered by arrival and the msg dicts are never compared.
+UDPCacheEntry: TypeAlias = tuple[datetime, int, int, AjoaikadataMsg]
+# Cache entry of other message types: (tst, seq, msg)
+OtherCacheEntry: TypeAlias = tuple[datetime, int, AjoaikadataMsg]
 
 
 class UDPMsgCache(TypedDict):
-    msgs: list[UDPCacheItem]
+    msgs: list[UDPCacheEntry]
+    # Other messages waiting for the earlier UDP messages
+    others: list[OtherCacheEntry]
+    # Seq of the next cache entry
+    seq: int
     waiting_for_no: int
     last_released_tst: datetime
+    # The latest event time seen. The watermark is this minus the max lateness.
+    max_tst: datetime
 
 
 def create_empty_udp_cache() -> UDPMsgCache:
-    return {"msgs": [], "waiting_for_no": -1, "last_released_tst": datetime.fromtimestamp(0)}
+    return {
+        "msgs": [],
+        "others": [],
+        "seq": 0,
+        "waiting_for_no": -1,
+        "last_released_tst": datetime.fromtimestamp(0),
+        "max_tst": datetime.fromtimestamp(0),
+    }
 
 
 def _get_next_id(packet_no: int) -> int:
     return (packet_no + 1) % 255
 
 
-def _get_pattern_from_cache(cache: UDPMsgCache) -> list[AjoaikadataMsg]:
+def _push_to_cache(cache: UDPMsgCache, tst: datetime, packet_no: int, msg: AjoaikadataMsg) -> None:
+    heapq.heappush(cache["msgs"], (tst, cache["seq"], packet_no, msg))
+    cache["seq"] += 1
+
+
+def _release_from_cache(cache: UDPMsgCache, watermark: datetime | None, split_input: bool) -> list[AjoaikadataMsg]:
+    """
+    Release the udp messages in order until the next missing one, which is still waited for.
+    Messages older than the watermark are not waiting for the missing messages anymore.
+    If the input is split, also the messages in order wait for the watermark.
+    If watermark is None, all the messages are released.
+    """
     msgs: list[AjoaikadataMsg] = []
-    while len(cache["msgs"]) > 0:
-        if cache["msgs"][0][1]["data"]["msg_type"] != 1:
-            msg = heapq.heappop(cache["msgs"])[1]
-            msgs.append(msg)
-            continue
-        if cache["msgs"][0][1]["data"]["content"]["packet_no"] != cache["waiting_for_no"]:
+    heap = cache["msgs"]
+    while heap:
+        tst, _, packet_no, msg = heap[0]
+
+        in_sequence = (
+            packet_no == cache["waiting_for_no"]
+            and (tst - cache["last_released_tst"]).total_seconds() <= UNEXPECTED_TIME_DIFF
+        )
+        passed = watermark is None or tst <= watermark or len(heap) > CACHE_MAX_SIZE
+        if not passed and (split_input or not in_sequence):
             break
+        if not in_sequence:
+            logger.debug(f"Stopped waiting udp message {cache['waiting_for_no']}, releasing {packet_no}")
+
+        cache["waiting_for_no"] = _get_next_id(packet_no)
+        cache["last_released_tst"] = tst
 
-        msg = heapq.heappop(cache["msgs"])[1]
-        cache["waiting_for_no"] = _get_next_id(cache["waiting_for_no"])
-        if msg and msg["data"] is not None:
-            cache["last_released_tst"] = msg["data"]["tst"]
+        heapq.heappop(heap)
         msgs.append(msg)
 
     return msgs
 
 
-def _add_to_cache(cache: UDPMsgCache, item: UDPCacheItem) -> list[AjoaikadataMsg]:
-    heapq.heappush(cache["msgs"], item)
-
-    if len(cache["msgs"]) > CACHE_MAX_SIZE:
-        if cache["msgs"][0][1]["data"]["msg_type"] == 1:
-            cache["waiting_for_no"] = cache["msgs"][0][1]["data"]["content"]["packet_no"]
-        return _get_pattern_from_cache(cache)
-    return []
+def _merge_by_tst(msgs: list[AjoaikadataMsg], other_msgs: list[AjoaikadataMsg]) -> list[AjoaikadataMsg]:
+    """Merge the ordered msgs of other types to the ordered udp msgs"""
+    if not msgs or not other_msgs:
+        return msgs or other_msgs
+    return list(heapq.merge(msgs, other_msgs, key=lambda msg: msg["data"]["tst"]))
+
+
+def _release(cache: UDPMsgCache, watermark: datetime | None, split_input: bool = False) -> list[AjoaikadataMsg]:
+    """
+    Release the udp messages, and the other messages which are earlier than the first udp message still waiting.
+    If the input is split, the other messages wait also for the watermark.
+    If watermark is None, all the messages are released.
+    """
+    udp_msgs = _release_from_cache(cache, watermark, split_input)
+    others = cache["others"]
+    waiting_tst = cache["msgs"][0][0] if cache["msgs"] else None
+    other_msgs: list[AjoaikadataMsg] = []
+    while others:
+        tst = others[0][0]
+        waiting = (waiting_tst is not None and tst >= waiting_tst) or (
+            split_input and watermark is not None and tst > watermark
+        )
+        if waiting and len(others) <= CACHE_MAX_SIZE:
+            break
+        other_msgs.append(heapq.heappop(others)[2])
+    return _merge_by_tst(udp_msgs, other_msgs)
 
 
-def reorder_messages(udp_cache: UDPMsgCache | None, value: AjoaikadataMsg) -> tuple[UDPMsgCache, list[AjoaikadataMsg]]:
+def reorder_messages(
+    udp_cache: UDPMsgCache | None, value: AjoaikadataMsg, split_input: bool = False
+) -> tuple[UDPMsgCache, list[AjoaikadataMsg]]:
+    """Reorder the message. If split_input is True, the msg types are read from separate topics."""
     if not udp_cache:
         udp_cache = create_empty_udp_cache()
 
@@ -85,43 +154,77 @@ def reorder_messages(udp_cache: UDPMsgCache | None, value: AjoaikadataMsg) -> tu
     if not tst:
         return udp_cache, [value]
 
-    # No udp message, add to the cache if there were items.
-    if data["msg_type"] != 1:
-        if len(udp_cache["msgs"]) > 0 and tst > udp_cache["msgs"][0][0]:
-            msgs = _add_to_cache(udp_cache, UDPCacheItem((tst, value)))
-            return udp_cache, msgs
+    udp_cache["max_tst"] = max(udp_cache["max_tst"], tst)
+    watermark = udp_cache["max_tst"] - MAX_LATENESS
 
-        return udp_cache, [value]
+    msg_type: int = data["msg_type"]
+
+    # No udp message, wait only for the earlier udp messages.
+    if msg_type != 1:
+        heapq.heappush(udp_cache["others"], (tst, udp_cache["seq"], value))
+        udp_cache["seq"] += 1
+        return udp_cache, _release(udp_cache, watermark, split_input)
 
     packet_no: int = data["content"]["packet_no"]
 
     if udp_cache["waiting_for_no"] == -1:
-        # first message, init metadata and return msg
-        udp_cache["waiting_for_no"] = _get_next_id(packet_no)
+        # first message, init metadata so that the msg is the one waited for
+        udp_cache["waiting_for_no"] = packet_no
         udp_cache["last_released_tst"] = tst
-        return udp_cache, [value]
 
     if tst < udp_cache["last_released_tst"]:
         # Too old message, mark as discarded - we are not waiting anymore for this.
         value["data"]["discard"] = True
         logger.debug(f"Discarded udp message, because it was too old: {value}")
-        return udp_cache, [value]
-
-    if (
-        udp_cache["waiting_for_no"] != packet_no
-        or (tst - udp_cache["last_released_tst"]).total_seconds() > UNEXPECTED_TIME_DIFF
-        or (len(udp_cache["msgs"]) > 0 and tst > udp_cache["msgs"][0][0])
-    ):
-        # Not the message we are waiting for. Store to the cache.
-        msgs = _add_to_cache(udp_cache, UDPCacheItem((tst, value)))
-        return udp_cache, msgs
-
-    # The message is okay and should be returned
-    # check the cache if there are something to release
-
-    msgs = [value]
-    udp_cache["last_released_tst"] = tst
-    udp_cache["waiting_for_no"] = _get_next_id(packet_no)
-
-    msgs += _get_pattern_from_cache(udp_cache)
-    return udp_cache, msgs
+        return udp_cache, _merge_by_tst(_release(udp_cache, watermark, split_input), [value])
+
+    # Store to the cache, and release everything that is in order or passed by the watermark.
+    # If this is the message we were waiting for, it is released immediately.
+    _push_to_cache(udp_cache, tst, packet_no, value)
+    return udp_cache, _release(udp_cache, watermark, split_input)
+
+
+def release_udp_cache(
+    udp_cache: UDPMsgCache, stream_time: datetime | None, split_input: bool = False
+) -> list[AjoaikadataMsg]:
+    """
+    Release the cached messages passed by the watermark of the stream time, and the ones in order after them.
+    If stream time is None, all the messages are released in order.
+    """
+    return _release(udp_cache, stream_time - MAX_LATENESS if stream_time is not None else None, split_input)
+
+
+def get_time_to_release(udp_cache: UDPMsgCache, split_input: bool = False) -> timedelta | None:
+    """How much the event time must advance before the first message of the cache is released"""
+    first_tsts = [udp_cache["msgs"][0][0]] if udp_cache["msgs"] else []
+    if split_input and udp_cache["others"]:
+        first_tsts.append(udp_cache["others"][0][0])
+    if not first_tsts:
+        return None
+    return max(min(first_tsts) - (udp_cache["max_tst"] - MAX_LATENESS), timedelta())
+
+
+class UDPReorderLogic(StreamTimeLogic[UDPMsgCache]):
+    """
+    Bytewax logic to reorder the messages of a vehicle. Use with op.unary:
+        op.unary("reorder_upd", stream, UDPReorderLogic)
+    If the msg types are read from separate topics, merge them by tst:
+        op.unary("reorder_upd", stream, partial(UDPReorderLogic, split_input=True))
+    """
+
+    def __init__(self, resume_state: UDPMsgCache | None, idle_advance: bool = True, split_input: bool = False) -> None:
+        super().__init__(resume_state or create_empty_udp_cache(), idle_advance)
+        self.split_input = split_input
+
+    def process(self, value: AjoaikadataMsg) -> list[AjoaikadataMsg]:
+        self.state, msgs = reorder_messages(self.state, value, self.split_input)
+        return msgs
+
+    def get_stream_time(self) -> datetime | None:
+        return self.state["max_tst"]
+
+    def release(self, stream_time: datetime | None) -> list[AjoaikadataMsg]:
+        return release_udp_cache(self.state, stream_time, self.split_input)
+
+    def get_time_to_release(self) -> timedelta | None:
+        return get_time_to_release(self.state, self.split_input)
@@ -0,0 +1,88 @@
+"""
+Operations to run the per vehicle stages of the message processing as one operator: timestamp validation, UDP
+ordering, combining balise parts and resolving balise directions. A message passes all the stages at once, and the
+state of a vehicle is a single object, instead of a separate operator and state for every stage.
+
+The stages are still defined in their own modules, and can be used and tested separately.
+"""
+
+from datetime import datetime, timedelta
+from typing import Iterable, TypedDict
+
+from bytewax.operators import UnaryLogic
+
+from ..util.ajoaikadatamsg import AjoaikadataMsg
+from .balisedirection import BaliseDirectionCache, BaliseDirectionLogic
+from .baliseparts import BalisePartsCache, BalisePartsLogic
+from .tstvalidator import validate_tst
+from .udporder import UDPMsgCache, UDPReorderLogic
+
+
+class VehiclePipelineState(TypedDict):
+    tst_correction: timedelta | None
+    udp_cache: UDPMsgCache
+    parts_cache: BalisePartsCache
+    balise_cache: BaliseDirectionCache
+
+
+class VehiclePipelineLogic(UnaryLogic[AjoaikadataMsg, AjoaikadataMsg, VehiclePipelineState]):
+    """
+    Bytewax logic to run the per vehicle stages. Use with op.unary:
+        op.unary("vehicle_pipeline", stream, VehiclePipelineLogic)
+    When replaying stored data, turn off the idle advance of the stream time (see the streamtime module):
+        op.unary("vehicle_pipeline", stream, partial(VehiclePipelineLogic, idle_advance=False))
+    When the msg types are read from separate topics, set split_input to merge them by tst (see the udporder module).
+    """
+
+    def __init__(
+        self, resume_state: VehiclePipelineState | None, idle_advance: bool = True, split_input: bool = False
+    ) -> None:
+        self.tst_correction = resume_state["tst_correction"] if resume_state else None
+        self.reorder = UDPReorderLogic(resume_state["udp_cache"] if resume_state else None, idle_advance, split_input)
+        self.parts = BalisePartsLogic(resume_state["parts_cache"] if resume_state else None, idle_advance)
+        self.directions = BaliseDirectionLogic(resume_state["balise_cache"] if resume_state else None, idle_advance)
+
+    def _to_directions(self, msgs: Iterable[AjoaikadataMsg]) -> list[AjoaikadataMsg]:
+        released: list[AjoaikadataMsg] = []
+        for msg in msgs:
+            released.extend(self.directions.on_item(msg)[0])
+        return released
+
+    def _to_parts(self, msgs: Iterable[AjoaikadataMsg]) -> list[AjoaikadataMsg]:
+        released: list[AjoaikadataMsg] = []
+        for msg in msgs:
+            released.extend(self._to_directions(self.parts.on_item(msg)[0]))
+        return released
+
+    def on_item(self, value: AjoaikadataMsg) -> tuple[Iterable[AjoaikadataMsg], bool]:
+        self.tst_correction, value = validate_tst(self.tst_correction, value)
+        return self._to_parts(self.reorder.on_item(value)[0]), UnaryLogic.RETAIN
+
+    def on_notify(self) -> tuple[Iterable[AjoaikadataMsg], bool]:
+        # The timers of all the stages are checked. Released msgs go through the later stages.
+        msgs = self._to_parts(self.reorder.on_notify()[0])
+        msgs += self._to_directions(self.parts.on_notify()[0])
+        msgs += self.directions.on_notify()[0]
+        return msgs, UnaryLogic.RETAIN
+
+    def on_eof(self) -> tuple[Iterable[AjoaikadataMsg], bool]:
+        msgs = self._to_parts(self.reorder.on_eof()[0])
+        msgs += self._to_directions(self.parts.on_eof()[0])
+        msgs += self.directions.on_eof()[0]
+        return msgs, UnaryLogic.RETAIN
+
+    def notify_at(self) -> datetime | None:
+        notify_times = [
+            notify_at
+            for notify_at in (self.reorder.notify_at(), self.parts.notify_at(), self.directions.notify_at())
+            if notify_at is not None
+        ]
+        return min(notify_times, default=None)
+
+    def snapshot(self) -> VehiclePipelineState:
+        return {
+            "tst_correction": self.tst_correction,
+            "udp_cache": self.reorder.snapshot(),
+            "parts_cache": self.parts.snapshot(),
+            "balise_cache": self.directions.snapshot(),
+        }
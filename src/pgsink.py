@@ -5,12 +5,15 @@ import bytewax.operators as op
 from bytewax.dataflow import Dataflow
 
 from .connectors.pulsar import PulsarInput, PulsarClient
-from .connectors.postgres import PostgresOutput, PostgresClient
+from .connectors.postgres import PG_TARGET_TABLE, PostgresOutput, PostgresClient, TYPED_MESSAGE_TABLES, is_message_for
 
 from .util.config import read_from_env
 
 
 input_topic, target = read_from_env(("PULSAR_INPUT_TOPIC", "POSTGRES_TARGET_TABLE"))
+if "msg_types" in PG_TARGET_TABLE[target] and target not in TYPED_MESSAGE_TABLES:
+    # Otherwise all the parsed msgs would be written to the typed table
+    raise ValueError(f"Typed table {target} is not listed in POSTGRES_TYPED_MESSAGE_TABLES")
 
 pulsar_client = PulsarClient(input_topic)
 postgres_client = PostgresClient(target)
@@ -18,5 +21,12 @@ postgres_client = PostgresClient(target)
 
 flow = Dataflow("pgsink")
 stream = op.input("pgsink_in", flow, PulsarInput(pulsar_client))
-op.output("pgsink_out", stream, PostgresOutput(postgres_client, identifier=input_topic))
-op.inspect("pgsink_ack", stream, pulsar_client.ack)
+
+if TYPED_MESSAGE_TABLES and target in ("messages", *TYPED_MESSAGE_TABLES):
+    # Parsed msgs are split between the message tables. Msgs of the other tables are only acked.
+    split = op.branch("split_message_tables", stream, is_message_for(target))
+    op.inspect("pgsink_ack_other_tables", split.falses, pulsar_client.ack)
+    stream = split.trues
+
+# Input msgs are acked after the rows have been written
+op.output("pgsink_out", stream, PostgresOutput(postgres_client, identifier=input_topic, acknowledger=pulsar_client))
@@ -1,22 +1,62 @@
 """
 Reader reads messages from Azure Storage and sends them to Pulsar.
+If CSV_DATA_DIR is given, messages are read from the csv files of the directory instead.
+
+Messages can be routed to different topics by the msg type of the header (UDP, beacon and other), so that consumers
+can subscribe only to the types they need. By default, all the messages are sent to PULSAR_OUTPUT_TOPIC.
+Vehicle is the partition key on every topic, so the messages of a vehicle stay in order within each topic.
+Contentparser merges the topics back by tst, see the udporder module.
 """
 
+from functools import partial
+
 import bytewax.operators as op
 from bytewax.dataflow import Dataflow
 
-from .connectors.azure_storage import AzureStorageInput
 from .connectors.pulsar import PulsarOutput, PulsarClient
 
-from .operations.parsing import csv_to_bytewax_msg
+from .operations.parsing import csv_to_bytewax_msg, get_raw_msg_type
 
+from .util.ajoaikadatamsg import AjoaikadataRawMsgWithKey
 from .util.config import read_from_env
 
 (output_topic,) = read_from_env(("PULSAR_OUTPUT_TOPIC",))
-output_client = PulsarClient(output_topic)
+udp_topic, beacon_topic, other_topic, csv_data_dir = read_from_env(
+    ("PULSAR_OUTPUT_TOPIC_UDP", "PULSAR_OUTPUT_TOPIC_BEACON", "PULSAR_OUTPUT_TOPIC_OTHER", "CSV_DATA_DIR"),
+    defaults=(output_topic, output_topic, output_topic),
+    required=False,
+)
+
+# Msg type -> topic
+TOPIC_ROUTES = {1: udp_topic, 5: beacon_topic}
+
+
+def _route_to_topic(msg: AjoaikadataRawMsgWithKey) -> str:
+    return TOPIC_ROUTES.get(get_raw_msg_type(msg), other_topic)
+
+
+def _is_routed_to(topic: str, msg: AjoaikadataRawMsgWithKey) -> bool:
+    return _route_to_topic(msg) == topic
+
+
+if csv_data_dir:
+    from .connectors.csv_directory import CSVDirInput
+
+    source = CSVDirInput(csv_data_dir)
+else:
+    from .connectors.azure_storage import AzureStorageInput
+
+    source = AzureStorageInput()
 
 
 flow = Dataflow("reader")
-stream = op.input("reader_in", flow, AzureStorageInput())
+stream = op.input("reader_in", flow, source)
 pulsar_msg_stream = op.map("csv_to_bytewax_msg", stream, csv_to_bytewax_msg)
-op.output("reader_out", pulsar_msg_stream, PulsarOutput(output_client))
+
+output_topics = sorted({udp_topic, beacon_topic, other_topic})
+if len(output_topics) == 1:
+    op.output("reader_out", pulsar_msg_stream, PulsarOutput(PulsarClient(output_topics[0])))
+else:
+    for i, topic in enumerate(output_topics):
+        topic_stream = op.filter(f"route_{i}", pulsar_msg_stream, partial(_is_routed_to, topic))
+        op.output(f"reader_out_{i}", topic_stream, PulsarOutput(PulsarClient(topic)))
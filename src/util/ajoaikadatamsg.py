@@ -3,7 +3,7 @@ Module to contain type definitions and helper functions for the messages that ar
 """
 
 from datetime import datetime, timedelta
-from typing import NotRequired, TypedDict
+from typing import NotRequired, TypeAlias, TypedDict
 
 from ..ekeparser.ekeparser import EKEMessageType
 
@@ -25,9 +25,24 @@ class EKEMessageTypeWithMQTTDetails(EKEMessageType):
     discard: NotRequired[bool]
 
 
+# Pulsar msg ref as (ledger_id, entry_id, partition, batch_index)
+MsgRef: TypeAlias = tuple[int, int, int, int]
+
+
+class DeadLetter(TypedDict):
+    raw: str
+    topic: str
+    mqtt_timestamp: str
+    msg_type: int | None
+    msg_version: int | None
+    error_class: str
+    error: str
+
+
 class AjoaikadataMsg(TypedDict):
     data: EKEMessageTypeWithMQTTDetails | None
-    msgs: NotRequired[list[str]]  # For Pulsar msg refs
+    msgs: NotRequired[list[MsgRef]]  # For Pulsar msg refs
+    dead_letter: NotRequired[DeadLetter]  # Set if the raw message could not be parsed
 
 
 class AjoaikadataRawMsg(TypedDict):
@@ -46,6 +61,14 @@ def create_empty_raw_msg(with_refs: list = []) -> AjoaikadataRawMsg:
     return {"data": None}
 
 
+def merge_msg_refs(*msgs: AjoaikadataMsg) -> list[MsgRef]:
+    """Combine Pulsar msg refs of multiple messages into one list."""
+    refs: list[MsgRef] = []
+    for msg in msgs:
+        refs.extend(msg.get("msgs", ()))
+    return refs
+
+
 def calculate_time_diff(msg1: AjoaikadataMsg, msg2: AjoaikadataMsg) -> float:
     """Compare ntp_timestamps of two messages."""
     tst1: datetime = msg1["data"]["ntp_timestamp"] if msg1["data"] else datetime.fromtimestamp(0)
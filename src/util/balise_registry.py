@@ -1,46 +1,219 @@
-""" Module to read balise registry """
+"""
+Module to read balise registry
 
+The registry is compiled from the csv file into a dict keyed by an integer of balise id and direction
+(see registry_key). The values are immutable tuples with interned strings, and the generated opposite direction
+entries are included.
+
+The compiled registry can be stored as a prebuilt artifact, which loads faster than the csv:
+    python -m src.util.balise_registry src/util/balise_registry.csv balise_registry.pickle
+BALISE_DATA_FILE can point either to a csv or to an artifact (.pickle). Load artifacts only from trusted sources.
+
+The registry is versioned by a hash of its content. If BALISE_REGISTRY_RELOAD_SECS is set, the file is checked for
+changes with that interval, and a changed registry replaces the current one without restarting the dataflow.
+"""
+
+import argparse
 import csv
-from typing import Dict
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+from typing import NamedTuple
+
+from prometheus_client import Counter
+
+from .config import logger, read_from_env
+
+(BALISE_DATA_FILE, BALISE_REGISTRY_RELOAD_SECS) = read_from_env(
+    ("BALISE_DATA_FILE", "BALISE_REGISTRY_RELOAD_SECS"), defaults=("./src/util/balise_registry.csv", "0")
+)
+BALISE_REGISTRY_RELOAD_SECS = float(BALISE_REGISTRY_RELOAD_SECS)
+
+REGISTRY_RELOADS = Counter("balise_registry_reloads_total", "Reloads of the balise registry by result", ["result"])
+
+# Version of the artifact format. Artifacts of other versions have to be rebuilt.
+ARTIFACT_VERSION = 1
+
+
+class BaliseInfo(NamedTuple):
+    station: str
+    track: str
+    # Event type in lower case, e.g. "arrival"
+    event_type: str
+    train_direction: str
+    # Balise id and direction as a string, e.g. "61730_2"
+    key: str
+
 
-from .config import read_from_env
+BaliseRegistry = dict[int, BaliseInfo]
 
-(BALISE_DATA_FILE,) = read_from_env(("BALISE_DATA_FILE",), defaults=("./src/util/balise_registry.csv",))
+CSV_COLUMNS = ("balise", "direction", "station", "track", "type", "train_direction")
 
-# open csv file balise_registry.csv and read it into a dict using csv.DictReader
-# dict key is balise, value is dict with other data
-balise_registry: Dict[str, dict] = {}
 
-# TODO: Parametrize csv location!
-with open(BALISE_DATA_FILE, "r", newline="") as f:
-    reader = csv.DictReader(f, delimiter=",")
-    for row in reader:
-        # Store to dict
-        balise_registry[f"{row['balise']}_{row['direction']}"] = row
+def registry_key(balise_id: int, direction: int) -> int:
+    """Registry key of the balise id and the direction (1 or 2)"""
+    return balise_id << 2 | direction
 
-# Get balise data as keys to set. This is used to check if the certain station-track-type-direction combination exists.
-balise_data_set = {
-    f"{val['station']}_{val['track']}_{val['type']}_{val['train_direction']}" for val in balise_registry.values()
-}
 
-# Iterate over registry to generate missing station-track -directions
-for val in list(balise_registry.values()):
-    val = val.copy()
+def _create_info(balise: str, direction: str, station: str, track: str, type: str, train_direction: str) -> BaliseInfo:
+    return BaliseInfo(
+        station=sys.intern(station),
+        track=sys.intern(track),
+        event_type=sys.intern(type.lower()),
+        train_direction=sys.intern(train_direction),
+        key=f"{balise}_{direction}",
+    )
 
-    # Check the key from the balise, if the content is already there
-    opposite_dir = "2" if val["direction"] == "1" else "1"
-    key = f"{val['balise']}_{opposite_dir}"
 
-    if not key in balise_registry:
+def compile_registry(csv_file: str) -> BaliseRegistry:
+    """Read the registry from the csv file, and generate the missing opposite directions"""
+    with open(csv_file, "r", newline="") as f:
+        reader = csv.DictReader(f, delimiter=",")
+        missing_columns = set(CSV_COLUMNS) - set(reader.fieldnames or ())
+        if missing_columns:
+            raise ValueError(f"Balise registry {csv_file} is missing columns {sorted(missing_columns)}")
+        rows = list(reader)
+
+    # Rows by the balise and direction. Later rows override the earlier ones.
+    rows_by_key = {(row["balise"], row["direction"]): row for row in rows}
+
+    # Get balise data as keys to set. This is used to check if the certain station-track-type-direction combination exists.
+    balise_data_set = {
+        (row["station"], row["track"], row["type"], row["train_direction"]) for row in rows_by_key.values()
+    }
+
+    # Iterate over registry to generate missing station-track -directions
+    for row in list(rows_by_key.values()):
+        opposite_dir = "2" if row["direction"] == "1" else "1"
+        if (row["balise"], opposite_dir) in rows_by_key:
+            continue
+
         # Create an opposite station event. Directions and types are flipped.
-        val["direction"] = "2" if val["direction"] == "1" else "1"
-        val["type"] = "ARRIVAL" if val["type"] == "DEPARTURE" else "DEPARTURE"
-        val["train_direction"] = "2" if val["train_direction"] == "1" else "1"
+        opposite = {
+            **row,
+            "direction": opposite_dir,
+            "type": "ARRIVAL" if row["type"] == "DEPARTURE" else "DEPARTURE",
+            "train_direction": "2" if row["train_direction"] == "1" else "1",
+        }
 
         # Still check if the new combination is already in registry. (We prefer the existing information)
-        data_key = f"{val['station']}_{val['track']}_{val['type']}_{val['train_direction']}"
-
-        if not data_key in balise_data_set:
+        data_key = (opposite["station"], opposite["track"], opposite["type"], opposite["train_direction"])
+        if data_key not in balise_data_set:
             # Add suffix to recognize the generated one.
-            val["train_direction"] += "_g"
-            balise_registry[key] = val
+            opposite["train_direction"] += "_g"
+            rows_by_key[(row["balise"], opposite_dir)] = opposite
+
+    return {
+        registry_key(int(balise), int(direction)): _create_info(**row)
+        for (balise, direction), row in rows_by_key.items()
+    }
+
+
+def save_registry(registry: BaliseRegistry, artifact_file: str) -> None:
+    with open(artifact_file, "wb") as f:
+        pickle.dump((ARTIFACT_VERSION, registry), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_registry(data_file: str) -> BaliseRegistry:
+    """Load the registry from a prebuilt artifact (.pickle) or compile it from a csv file"""
+    if not data_file.endswith(".pickle"):
+        return compile_registry(data_file)
+
+    with open(data_file, "rb") as f:
+        version, registry = pickle.load(f)
+    if version != ARTIFACT_VERSION:
+        raise ValueError(f"Balise registry artifact {data_file} has version {version}, expected {ARTIFACT_VERSION}")
+    return registry
+
+
+def registry_version(registry: BaliseRegistry) -> str:
+    """Version of the registry content. The same content has the same version, whether read from csv or artifact."""
+    content = repr(sorted(registry.items())).encode()
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+class VersionedRegistry(NamedTuple):
+    version: str
+    balises: BaliseRegistry
+
+
+class RegistryHolder:
+    """
+    Holds the current registry of the data file. A reload replaces the registry as a whole, so a reader that takes
+    `current` once sees either the old or the new registry, never a mix of them.
+    If the reload fails, e.g. because of a broken file, the old registry is kept.
+    """
+
+    def __init__(self, data_file: str) -> None:
+        self.data_file = data_file
+        self._lock = threading.Lock()
+        self._mtime_ns = os.stat(data_file).st_mtime_ns
+        registry = load_registry(data_file)
+        self.current = VersionedRegistry(registry_version(registry), registry)
+        logger.info(f"Loaded {len(registry)} balises from {data_file}, version {self.current.version}")
+
+    def reload(self) -> bool:
+        """Reload the registry from the data file. Returns True if the registry changed."""
+        with self._lock:
+            try:
+                # Read mtime before the load, so that a change during the load is reloaded on the next check
+                mtime_ns = os.stat(self.data_file).st_mtime_ns
+                registry = load_registry(self.data_file)
+                if not registry:
+                    raise ValueError("Registry is empty")
+            except Exception as e:
+                REGISTRY_RELOADS.labels("failed").inc()
+                logger.error(f"Failed to reload balise registry from {self.data_file}, keeping the old one: {e}")
+                return False
+
+            self._mtime_ns = mtime_ns
+            version = registry_version(registry)
+            if version == self.current.version:
+                REGISTRY_RELOADS.labels("unchanged").inc()
+                return False
+
+            old_version = self.current.version
+            self.current = VersionedRegistry(version, registry)
+            REGISTRY_RELOADS.labels("changed").inc()
+            logger.info(f"Reloaded {len(registry)} balises from {self.data_file}, version {old_version} -> {version}")
+            return True
+
+    def reload_if_modified(self) -> bool:
+        """Reload the registry if the data file has been modified since the last load"""
+        try:
+            modified = os.stat(self.data_file).st_mtime_ns != self._mtime_ns
+        except OSError as e:
+            logger.error(f"Failed to check balise registry file {self.data_file}: {e}")
+            return False
+        return modified and self.reload()
+
+    def watch(self, interval_secs: float) -> threading.Thread:
+        """Start a thread that checks the data file for changes with the given interval"""
+
+        def _run() -> None:
+            while True:
+                time.sleep(interval_secs)
+                self.reload_if_modified()
+
+        thread = threading.Thread(target=_run, name="balise-registry-watcher", daemon=True)
+        thread.start()
+        return thread
+
+
+balise_registry = RegistryHolder(BALISE_DATA_FILE)
+if BALISE_REGISTRY_RELOAD_SECS > 0:
+    balise_registry.watch(BALISE_REGISTRY_RELOAD_SECS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the balise registry artifact from the csv file.")
+    parser.add_argument("csv_file")
+    parser.add_argument("artifact_file")
+    args = parser.parse_args()
+
+    registry = compile_registry(args.csv_file)
+    save_registry(registry, args.artifact_file)
+    logger.info(f"Saved {len(registry)} balises to {args.artifact_file}")
@@ -3,7 +3,9 @@
 from itertools import zip_longest
 import logging
 import os
-from typing import Iterable, Tuple
+import threading
+import time
+from typing import Hashable, Iterable, Tuple
 
 # Init logging
 log_level = os.environ.get("LOG_LEVEL", logging.INFO)  # Use INFO as default.
@@ -22,3 +24,30 @@ def read_from_env(env_names: Iterable[str], defaults: Iterable[str] = (), requir
     env_str = "\n".join([f"{name}={value}" for (name, value) in zip(env_names, envs)])
     logging.info(f"Read the following env variables:\n{env_str}")
     return envs
+
+
+class RateLimitedLogger:
+    """
+    Log at most once per interval for each key. Records in between are only counted,
+    and the count is added to the next logged record.
+    """
+
+    def __init__(self, interval_secs: float, level: int = logging.ERROR) -> None:
+        self.interval_secs = interval_secs
+        self.level = level
+        self._lock = threading.Lock()
+        # Key -> (last logged at, suppressed since)
+        self._state: dict[Hashable, tuple[float, int]] = {}
+
+    def log(self, key: Hashable, msg: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            logged_at, suppressed = self._state.get(key, (None, 0))
+            if logged_at is not None and now - logged_at < self.interval_secs:
+                self._state[key] = (logged_at, suppressed + 1)
+                return
+            self._state[key] = (now, 0)
+
+        if suppressed:
+            msg = f"{msg} ({suppressed} similar records suppressed)"
+        logger.log(self.level, msg)
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+import bytewax.operators as op
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSource, run_main
+import pyarrow.dataset as ds
+
+from ...src.connectors.parquet import ParquetOutput, ParquetSinkPartition
+from ...src.util.ajoaikadatamsg import AjoaikadataMsgWithKey
+
+
+def get_msgs(vehicle: int, count: int) -> list[AjoaikadataMsgWithKey]:
+    start = datetime(2024, 1, 10, 23, 59, 50, tzinfo=timezone.utc)
+    msgs = []
+    for i in range(count):
+        tst = start + timedelta(seconds=i)
+        data = {
+            "tst": tst,
+            "ntp_timestamp": tst,
+            "eke_timestamp": tst.replace(tzinfo=None),
+            "mqtt_timestamp": tst,
+            "tst_source": "ntp",
+            "msg_type": 1 if i % 2 else 3,
+            "vehicle": vehicle,
+            "content": {"packet_no": i},
+        }
+        msgs.append((str(vehicle), {"data": data}))
+    return msgs
+
+
+def test_partitioned_files(tmp_path):
+    """Rows are written to files partitioned by date, vehicle and msg type"""
+    msgs = get_msgs(53, 20) + get_msgs(54, 20)
+    flow = Dataflow("test_flow")
+    stream = op.input("test_input", flow, TestingSource(msgs))
+    op.output("test_output", stream, ParquetOutput("messages", tmp_path, partitions=2, row_group_rows=3))
+    run_main(flow)
+
+    files = sorted(str(file.relative_to(tmp_path)) for file in tmp_path.glob("**/*.parquet*"))
+    assert all(file.endswith(".parquet") for file in files)
+    assert {file.rsplit("/", 1)[0] for file in files} == {
+        f"messages/date={date}/vehicle_id={vehicle}/msg_type={msg_type}"
+        for date in ("2024-01-10", "2024-01-11")
+        for vehicle in (53, 54)
+        for msg_type in (1, 3)
+    }
+
+    table = ds.dataset(tmp_path / "messages", format="parquet", partitioning="hive").to_table()
+    assert table.num_rows == 40
+    assert sorted(table.column("tst").to_pylist()) == sorted(msg["data"]["tst"] for key, msg in msgs)
+
+
+def test_resume_removes_files_after_snapshot(tmp_path):
+    """Files written after the snapshot are removed on resume"""
+    sink = ParquetSinkPartition("messages", tmp_path, "0", "run1", None, row_group_rows=100)
+    sink.write_batch([msg for key, msg in get_msgs(53, 2)])
+    state = sink.snapshot()
+    sink.write_batch([msg for key, msg in get_msgs(54, 2)])
+    sink.close()
+    assert len(list(tmp_path.glob("**/*.parquet"))) == 4
+
+    ParquetSinkPartition("messages", tmp_path, "0", "run2", state, row_group_rows=100)
+
+    assert sorted(file.parent.parent.name for file in tmp_path.glob("**/*.parquet")) == ["vehicle_id=53"] * 2
+
+
+def test_new_run_keeps_earlier_files(tmp_path):
+    """A new run writes its own files next to the files of the earlier runs"""
+    for run_id in ("run1", "run2"):
+        sink = ParquetSinkPartition("messages", tmp_path, "0", run_id, None, row_group_rows=100)
+        sink.write_batch([msg for key, msg in get_msgs(53, 2)])
+        sink.close()
+
+    assert len(list(tmp_path.glob("**/part-run1-0-*.parquet"))) == 2
+    assert len(list(tmp_path.glob("**/part-run2-0-*.parquet"))) == 2
@@ -0,0 +1,105 @@
+import pytest
+
+from ...src.connectors.pulsar_memory import Broker, Client
+
+
+def get_client() -> Client:
+    """Client with its own broker, so that tests do not share topics"""
+    return Client(broker=Broker())
+
+
+def test_key_shared_dispatch():
+    """All msgs with the same key go to the same consumer in order"""
+    client = get_client()
+    consumers = [client.subscribe("topic", "sub", consumer_name=f"c{i}") for i in range(3)]
+    producer = client.create_producer("topic")
+
+    for i in range(30):
+        producer.send(str(i).encode(), partition_key=str(i % 5))
+
+    received = {i: [msg for msg in consumer.batch_receive()] for i, consumer in enumerate(consumers)}
+
+    assert sum(len(msgs) for msgs in received.values()) == 30
+    for msgs in received.values():
+        for key in {msg.partition_key() for msg in msgs}:
+            # Key is not found from other consumers
+            assert all(key not in {m.partition_key() for m in other} for other in received.values() if other is not msgs)
+            key_msgs = [int(msg.data()) for msg in msgs if msg.partition_key() == key]
+            assert key_msgs == sorted(key_msgs)
+
+
+def test_subscriptions_get_all_msgs():
+    """Every subscription receives its own copy of the msgs"""
+    client = get_client()
+    consumer1 = client.subscribe("topic", "sub1")
+    consumer2 = client.subscribe("topic", "sub2")
+    client.create_producer("topic").send(b"msg", partition_key="1")
+
+    assert [msg.data() for msg in consumer1.batch_receive()] == [b"msg"]
+    assert [msg.data() for msg in consumer2.batch_receive()] == [b"msg"]
+
+
+def test_negative_ack_redelivers():
+    """Nacked msg is redelivered, acked is not"""
+    client = get_client()
+    consumer = client.subscribe("topic", "sub")
+    producer = client.create_producer("topic")
+    producer.send(b"1", partition_key="1")
+    producer.send(b"2", partition_key="1")
+
+    msg1, msg2 = consumer.batch_receive()
+    consumer.acknowledge(msg1)
+    consumer.negative_acknowledge(msg2)
+
+    redelivered = consumer.batch_receive()
+    assert [msg.data() for msg in redelivered] == [b"2"]
+    assert redelivered[0].redelivery_count == 1
+
+
+def test_closed_consumer_msgs_are_redelivered():
+    """Unacked msgs of a closed consumer go to the remaining consumer"""
+    client = get_client()
+    consumer1 = client.subscribe("topic", "sub")
+    producer = client.create_producer("topic")
+    producer.send(b"1", partition_key="1")
+
+    assert len(consumer1.batch_receive()) == 1
+    consumer2 = client.subscribe("topic", "sub")
+    consumer1.close()
+
+    assert [msg.data() for msg in consumer2.batch_receive()] == [b"1"]
+
+
+def test_end_of_stream():
+    """Consumer stops after all the producers are closed and the queue is empty"""
+    client = get_client()
+    consumer = client.subscribe("topic", "sub")
+    producer = client.create_producer("topic")
+    producer.send(b"1", partition_key="1")
+    producer.close()
+
+    assert len(consumer.batch_receive()) == 1
+    with pytest.raises(StopIteration):
+        consumer.batch_receive()
+
+
+def test_subscribe_to_topic_list():
+    """Consumer of many topics receives the msgs of all of them in order per topic, and acks them to their topics"""
+    client = get_client()
+    consumer = client.subscribe(["topic1", "topic2"], "sub")
+    producers = [client.create_producer("topic1"), client.create_producer("topic2")]
+    for i in range(4):
+        producers[i % 2].send(str(i).encode(), partition_key="1")
+
+    msgs = consumer.batch_receive()
+    assert sorted(int(msg.data()) for msg in msgs) == [0, 1, 2, 3]
+    assert [int(msg.data()) for msg in msgs if int(msg.data()) % 2 == 0] == [0, 2]
+    for msg in msgs[1:]:
+        consumer.acknowledge(msg.message_id())
+    consumer.redeliver_unacknowledged_messages()
+    assert [msg.data() for msg in consumer.batch_receive()] == [msgs[0].data()]
+
+    for producer in producers:
+        producer.close()
+    with pytest.raises(StopIteration):
+        consumer.batch_receive()
@@ -0,0 +1,90 @@
+import threading
+import time
+
+from ...src.connectors import pulsar as pulsar_connector
+from ...src.connectors.pulsar import PulsarClient
+
+
+class SlowClient:
+    """Creates placeholder producers slowly, so that concurrent callers overlap"""
+
+    def __init__(self) -> None:
+        self.producers: list["FakeProducer"] = []
+
+    def create_producer(self, topic_name: str, **kwargs) -> "FakeProducer":
+        time.sleep(0.01)
+        producer = FakeProducer()
+        self.producers.append(producer)
+        return producer
+
+
+class FakeProducer:
+    def __init__(self) -> None:
+        self.closed = False
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def get_client(monkeypatch) -> PulsarClient:
+    monkeypatch.setenv("PULSAR_CLIENT_NAME", "test")
+    monkeypatch.setattr(pulsar_connector, "create_client", SlowClient)
+    return PulsarClient("test-topic")
+
+
+def test_producer_shared_by_concurrent_users(monkeypatch):
+    """Workers starting at the same time share one producer, which is closed by the last one"""
+    client = get_client(monkeypatch)
+    threads = [threading.Thread(target=client.get_producer, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(client.client.producers) == 1
+    producer = client.producer
+    assert producer and producer.users == 8
+
+    for _ in range(7):
+        producer.close()
+    assert not client.client.producers[0].closed
+    producer.close()
+    assert client.client.producers[0].closed
+
+
+class FakeMessageId:
+    def __init__(self, entry_id: int) -> None:
+        self.entry = entry_id
+
+    def ledger_id(self) -> int:
+        return 1
+
+    def entry_id(self) -> int:
+        return self.entry
+
+    def partition(self) -> int:
+        return -1
+
+    def batch_index(self) -> int:
+        return -1
+
+
+class FakeMessage:
+    def __init__(self, entry_id: int) -> None:
+        self.id = FakeMessageId(entry_id)
+
+    def message_id(self) -> FakeMessageId:
+        return self.id
+
+
+def test_unacked_ids_bounded(monkeypatch):
+    """Ids of msgs that are never acked do not accumulate"""
+    client = get_client(monkeypatch)
+    client.max_unacked_ids = 3
+
+    refs = [client.track_msg(FakeMessage(i)) for i in range(5)]  # type: ignore
+
+    assert list(client.unacked) == refs[2:]
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+
+from prometheus_client import REGISTRY
+
+from ...src.operations.balisedirection import (
+    BALISE_GROUP_MAX_MSG_TIME_DIFF,
+    BaliseDirectionLogic,
+    create_directions_for_balises,
+)
+from ...src.util.ajoaikadatamsg import AjoaikadataMsg
+
+
+def get_msg(second: int, balise_id: int | None = None, balise_cba: str = "1(2)") -> AjoaikadataMsg:
+    tst = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=second)
+    data = {"ntp_timestamp": tst, "mqtt_timestamp": tst, "vehicle": 53, "msg_type": 1, "content": {}}
+    if balise_id is not None:
+        data["msg_type"] = 5
+        data["content"] = {"balise_id": balise_id, "balise_cba": balise_cba}
+    return {"data": data, "msgs": []}
+
+
+def test_direction_from_balise_group():
+    """Two balises with the same id within the time limit are combined with the direction"""
+    cache, msgs = create_directions_for_balises(None, get_msg(0, balise_id=100, balise_cba="1(2)"))
+    assert msgs == []
+
+    cache, msgs = create_directions_for_balises(cache, get_msg(1, balise_id=100, balise_cba="2(2)"))
+    assert [msg["data"]["content"]["direction"] for msg in msgs] == [1]
+    assert cache["balises"] == {}
+
+
+def test_balise_expires_when_stream_time_passes():
+    """Balise without the pair is released as incomplete when the stream time has passed it by the max time diff"""
+    balise = get_msg(0, balise_id=100)
+    cache, msgs = create_directions_for_balises(None, balise)
+
+    cache, msgs = create_directions_for_balises(cache, get_msg(BALISE_GROUP_MAX_MSG_TIME_DIFF - 1))
+    assert len(msgs) == 1 and msgs[0]["data"]["msg_type"] == 1
+
+    cache, msgs = create_directions_for_balises(cache, get_msg(BALISE_GROUP_MAX_MSG_TIME_DIFF))
+    assert msgs[0] is balise
+    assert balise["data"]["incomplete"]
+    assert cache["balises"] == {}
+
+
+def test_cache_size_reported():
+    """Total size of the caches of all the vehicles is reported when balises are cached and released"""
+    size_before = REGISTRY.get_sample_value("balise_direction_cache_size")
+    logics = [BaliseDirectionLogic(None), BaliseDirectionLogic(None)]
+    logics[0].on_item(get_msg(0, balise_id=100))
+    logics[1].on_item(get_msg(0, balise_id=100))
+    logics[1].on_item(get_msg(1, balise_id=101))
+    assert REGISTRY.get_sample_value("balise_direction_cache_size") == size_before + 3
+
+    logics[1].on_eof()
+    assert REGISTRY.get_sample_value("balise_direction_cache_size") == size_before + 1
@@ -0,0 +1,93 @@
+from datetime import datetime, timedelta, timezone
+
+import bytewax.operators as op
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSink, TestingSource, run_main
+
+import pytest
+
+from ...src.operations.baliseparts import (
+    BALISE_MAX_MSG_TIME_DIFF,
+    BalisePartsLogic,
+    TelegramCache,
+    combine_balise_parts,
+)
+from ...src.util.ajoaikadatamsg import AjoaikadataMsg, AjoaikadataMsgWithKey
+
+
+def get_msg(second: int, msg_type: int = 1, msg_index: int = 0) -> AjoaikadataMsg:
+    tst = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=second)
+    content = {"msg_index": msg_index, "transponder_msg_part": 0} if msg_type == 5 else {}
+    return {"data": {"ntp_timestamp": tst, "mqtt_timestamp": tst, "msg_type": msg_type, "content": content}}
+
+
+def test_part_expires_when_stream_time_passes():
+    """Unpaired part is released as incomplete when the stream time has passed it by the max time diff"""
+    part = get_msg(0, msg_type=5, msg_index=10)
+    cache, msgs = combine_balise_parts(None, part)
+    assert msgs == []
+
+    cache, msgs = combine_balise_parts(cache, get_msg(BALISE_MAX_MSG_TIME_DIFF - 1))
+    assert len(msgs) == 1 and msgs[0]["data"]["msg_type"] == 1
+
+    cache, msgs = combine_balise_parts(cache, get_msg(BALISE_MAX_MSG_TIME_DIFF))
+    assert msgs[0] is part
+    assert part["data"]["incomplete"]
+    assert cache["parts"] == {}
+
+
+def test_parts_released_on_eof():
+    """Parts left in the cache are released as incomplete at the end of the input"""
+    input_msgs: list[AjoaikadataMsgWithKey] = [("12", get_msg(0, msg_type=5, msg_index=10)), ("12", get_msg(1))]
+    result: list[AjoaikadataMsgWithKey] = []
+    flow = Dataflow("test_flow")
+    (
+        op.input("test_input", flow, TestingSource(input_msgs))
+        .then(op.unary, "combine_balises", BalisePartsLogic)
+        .then(op.output, "test_output", TestingSink(result))
+    )
+    run_main(flow)
+
+    assert [(v["data"]["msg_type"], v["data"].get("incomplete")) for k, v in result] == [(1, None), (5, True)]
+
+
+def test_telegram_cache():
+    """Telegram is decoded once, the decoded content is read-only, and the least recently used one is evicted"""
+    cache = TelegramCache(max_size=2)
+    payload1 = bytes([0x32, 0x11, 1, 2, 3, 4, 5, 0])
+    payload2 = bytes([0x21, 0x11, 1, 2, 3, 4, 5, 0])
+
+    telegram = cache.decode(payload1)
+    assert telegram == {
+        "balise_cba": "2(2)",
+        "balise_cbb": "Double",
+        "balise_msg_type": "Signal",
+        "balise_id": telegram["balise_id"],
+        "balise_id_next": telegram["balise_id_next"],
+    }
+    assert cache.decode(payload1) is telegram
+    with pytest.raises(TypeError):
+        telegram["balise_cba"] = "1(2)"  # type: ignore
+
+    cache.decode(payload2)
+    cache.decode(payload1)
+    cache.decode(bytes([0x22, 0x11, 1, 2, 3, 4, 5, 0]))  # Evicts payload2
+    assert cache.decode(payload1) is telegram
+    assert list(cache._telegrams) == [bytes([0x22, 0x11, 1, 2, 3, 4, 5, 0]), payload1]
+
+
+def test_expired_parts_released_oldest_first():
+    """Expired parts are released in timestamp order, and the combined parts are not released again"""
+    cache, msgs = combine_balise_parts(None, get_msg(1, msg_type=5, msg_index=20))
+    cache, msgs = combine_balise_parts(cache, get_msg(0, msg_type=5, msg_index=10))
+    pair = get_msg(2, msg_type=5, msg_index=30)
+    pair["data"]["content"] |= {"transponder_msg_part": 0, "content": bytes([0x32, 0x11, 1, 2])}
+    cache, msgs = combine_balise_parts(cache, pair)
+    pair = get_msg(2, msg_type=5, msg_index=31)
+    pair["data"]["content"] |= {"transponder_msg_part": 1, "content": bytes([3, 4, 5, 0])}
+    cache, msgs = combine_balise_parts(cache, pair)
+    assert len(msgs) == 1 and not msgs[0]["data"].get("incomplete")
+
+    cache, msgs = combine_balise_parts(cache, get_msg(BALISE_MAX_MSG_TIME_DIFF + 2))
+    assert [msg["data"]["content"].get("msg_index") for msg in msgs] == [10, 20, None]
+    assert cache["parts"] == {} and cache["expiry"] == []
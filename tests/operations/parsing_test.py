@@ -0,0 +1,48 @@
+from ...src.operations.parsing import get_raw_msg_type, is_parse_failure, raw_msg_to_eke, to_dead_letter
+from ...src.util.ajoaikadatamsg import AjoaikadataRawMsgWithKey
+
+UDP_RAW = (
+    "8021659e4e8000659e4e8000000000000000204164" + "00" * 140 + "02010201350000000000000000d2040000000000000000000000000000"
+)
+
+
+def get_raw_msg(raw: str) -> AjoaikadataRawMsgWithKey:
+    data = {
+        "raw": raw,
+        "topic": "eke/v1/sm5/53/A/UDP",
+        "vehicle": "53",
+        "mqtt_timestamp": "2024-01-10T08:00:00.200000+00:00",
+    }
+    return "53", {"data": data, "msgs": [(1, 2, -1, -1)]}
+
+
+def test_parsed_msg_keeps_refs():
+    """Pulsar msg refs are passed on with the parsed message"""
+    key, msg = raw_msg_to_eke(get_raw_msg(UDP_RAW))
+
+    assert not is_parse_failure((key, msg))
+    assert msg["data"]["msg_type"] == 1
+    assert msg["msgs"] == [(1, 2, -1, -1)]
+
+
+def test_parse_failure_to_dead_letter():
+    """Truncated message is turned into a dead letter with the raw payload and the error class"""
+    failed = raw_msg_to_eke(get_raw_msg(UDP_RAW[:20]))
+
+    assert is_parse_failure(failed)
+    key, dead_letter = to_dead_letter(failed)
+    assert key == "53"
+    assert dead_letter["msgs"] == [(1, 2, -1, -1)]
+    assert dead_letter["data"]["raw"] == UDP_RAW[:20]
+    assert dead_letter["data"]["topic"] == "eke/v1/sm5/53/A/UDP"
+    assert dead_letter["data"]["msg_type"] == 1
+    assert dead_letter["data"]["msg_version"] == 1
+    assert dead_letter["data"]["error_class"]
+
+
+def test_raw_msg_type_from_header():
+    """Msg type is read from the header, also when the rest of the msg cannot be parsed"""
+    assert get_raw_msg_type(get_raw_msg(UDP_RAW)) == 1
+    assert get_raw_msg_type(get_raw_msg(UDP_RAW[:20])) == 1
+    assert get_raw_msg_type(get_raw_msg("zz")) is None
+    assert get_raw_msg_type(("53", {"data": None})) is None
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+import pytest
+
+from ...src.operations.balisedirection import BALISE_GROUP_MAX_MSG_TIME_DIFF, BaliseDirectionLogic
+from ...src.operations.baliseparts import BALISE_MAX_MSG_TIME_DIFF, BalisePartsLogic
+from ...src.operations.streamtime import StreamTimeLogic
+from ...src.operations.udporder import MAX_LATENESS, UDPReorderLogic
+from ...src.util.ajoaikadatamsg import AjoaikadataMsg
+
+
+def get_msg(second: int, msg_type: int, content: dict) -> AjoaikadataMsg:
+    tst = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=second)
+    data = {"tst": tst.replace(tzinfo=None), "ntp_timestamp": tst, "mqtt_timestamp": tst, "vehicle": 53, "msg_type": msg_type}
+    return {"data": data | {"content": content}, "msgs": []}
+
+
+# Logic, msgs of which the last one is held in the cache, and the time it waits
+CACHED_MSGS: list[tuple[Callable[[None], StreamTimeLogic], Callable[[], list[AjoaikadataMsg]], timedelta]] = [
+    (
+        UDPReorderLogic,
+        lambda: [get_msg(0, 1, {"packet_no": 0}), get_msg(2, 1, {"packet_no": 2})],  # Packet 1 is lost
+        MAX_LATENESS,
+    ),
+    (
+        BalisePartsLogic,
+        lambda: [get_msg(0, 5, {"msg_index": 10, "transponder_msg_part": 0})],
+        timedelta(seconds=BALISE_MAX_MSG_TIME_DIFF),
+    ),
+    (
+        BaliseDirectionLogic,
+        lambda: [get_msg(0, 5, {"balise_id": 100, "balise_cba": "1(2)"})],
+        timedelta(seconds=BALISE_GROUP_MAX_MSG_TIME_DIFF),
+    ),
+]
+
+
+@pytest.mark.parametrize("create_logic, create_msgs, wait_time", CACHED_MSGS)
+def test_idle_vehicle_released_by_timer(create_logic, create_msgs, wait_time):
+    """Cached msg is released on notify, when the vehicle has been idle for the time the msg waits"""
+    logic = create_logic(None)
+    for msg in create_msgs():
+        released, _ = logic.on_item(msg)
+    assert released == []
+
+    assert logic.notify_at() == logic.advanced_at + wait_time
+    msgs, _ = logic.on_notify()
+    assert msgs == []
+
+    logic.advanced_at -= wait_time  # Wait the time
+    msgs, _ = logic.on_notify()
+    assert len(msgs) == 1
+    assert logic.notify_at() is None
+
+
+@pytest.mark.parametrize("create_logic, create_msgs, wait_time", CACHED_MSGS)
+def test_cache_released_on_eof(create_logic, create_msgs, wait_time):
+    """Cached msg is released at the end of the input, and the state is in the snapshot"""
+    logic = create_logic(None)
+    for msg in create_msgs():
+        logic.on_item(msg)
+
+    resumed = create_logic(logic.snapshot())
+    msgs, _ = resumed.on_eof()
+    assert len(msgs) == 1
+    assert resumed.notify_at() is None
+
+
+@pytest.mark.parametrize("create_logic, create_msgs, wait_time", CACHED_MSGS)
+def test_no_idle_advance_in_replay(create_logic, create_msgs, wait_time):
+    """Without the idle advance, the cached msg waits for the end of the input regardless of the wall clock time"""
+    logic = create_logic(None, idle_advance=False)
+    for msg in create_msgs():
+        logic.on_item(msg)
+
+    assert logic.notify_at() is None
+    msgs, _ = logic.on_eof()
+    assert len(msgs) == 1
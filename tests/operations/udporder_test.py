@@ -4,8 +4,16 @@ import bytewax.operators as op
 from bytewax.dataflow import Dataflow
 from bytewax.testing import TestingSink, TestingSource, run_main
 
-from ...src.operations.udporder import reorder_messages, create_empty_udp_cache
-from ...src.util.ajoaikadatamsg import AjoaikadataMsgWithKey
+from ...src.benchmarks.trafficsim import TrafficConfig, simulate_traffic
+from ...src.operations.udporder import (
+    CACHE_MAX_SIZE,
+    MAX_LATENESS,
+    UDPReorderLogic,
+    create_empty_udp_cache,
+    release_udp_cache,
+    reorder_messages,
+)
+from ...src.util.ajoaikadatamsg import AjoaikadataMsg, AjoaikadataMsgWithKey
 
 
 def get_test_flow(test_input: list[AjoaikadataMsgWithKey], output: list[AjoaikadataMsgWithKey]) -> Dataflow:
@@ -13,8 +21,7 @@ def get_test_flow(test_input: list[AjoaikadataMsgWithKey], output: list[Ajoaikad
     flow = Dataflow("test_flow")
     (
         op.input("test_input", flow, TestingSource(test_input))
-        .then(op.stateful_map, "udp_order", lambda: create_empty_udp_cache(), reorder_messages)
-        .then(op.flat_map_value, "flat_ordered_msgs", lambda x: x)
+        .then(op.unary, "udp_order", UDPReorderLogic)
         .then(op.output, "test_output", TestingSink(output))
     )
     return flow
@@ -23,10 +30,10 @@ def get_test_flow(test_input: list[AjoaikadataMsgWithKey], output: list[Ajoaikad
 def test_normal_event_order():
     """Ordering works on the normal simple case"""
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
     ]
     input_msgs: list[AjoaikadataMsgWithKey] = [("12", {"data": d}) for d in input_data]
     result: list[AjoaikadataMsgWithKey] = []
@@ -36,24 +43,24 @@ def test_normal_event_order():
     test_result = [v["data"] for k, v in result]
 
     assert test_result == [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
     ]
 
 
 def test_simple_order():
     """Ordering works on small data."""
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 1}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 3}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 4}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 6}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 5}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 7}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 2}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 8}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 1}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 3}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 4}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 6}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 5}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 7}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 2}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 8}},
     ]
     input_msgs: list[AjoaikadataMsgWithKey] = [("12", {"data": d}) for d in input_data]
     result: list[AjoaikadataMsgWithKey] = []
@@ -63,28 +70,28 @@ def test_simple_order():
     test_result = [v["data"] for k, v in result]
 
     assert test_result == [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 1}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 2}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 3}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 4}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 5}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 6}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 7}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 8}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 1}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 2}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 3}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 4}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 5}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 6}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 7}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 8}},
     ]
 
 
 def test_loop_restart():
     """Ordering works if the packet_no goes to 0"""
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 252}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 0}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 254}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 253}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 252}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 0}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 254}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 253}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
     ]
     input_msgs: list[AjoaikadataMsgWithKey] = [("12", {"data": d}) for d in input_data]
     result: list[AjoaikadataMsgWithKey] = []
@@ -94,14 +101,14 @@ def test_loop_restart():
     test_result = [v["data"] for k, v in result]
 
     assert test_result == [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 252}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 253}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 254}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 0}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 1), "msg_type": 1, "content": {"packet_no": 252}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 2), "msg_type": 1, "content": {"packet_no": 253}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 3), "msg_type": 1, "content": {"packet_no": 254}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 4), "msg_type": 1, "content": {"packet_no": 0}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 5), "msg_type": 1, "content": {"packet_no": 1}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 6), "msg_type": 1, "content": {"packet_no": 2}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 7), "msg_type": 1, "content": {"packet_no": 3}},
+        {"tst": datetime(2024, 1, 1, 0, 0, 8), "msg_type": 1, "content": {"packet_no": 4}},
     ]
 
 
@@ -109,7 +116,7 @@ def test_handle_late_msg():
     """Too late msgs as discarded."""
     # more messages than cache size
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 1000)
     ]
 
@@ -123,7 +130,7 @@ def test_handle_late_msg():
     test_result = [v["data"] for k, v in result]
 
     expected = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 1000)
     ]
 
@@ -135,13 +142,13 @@ def test_handle_late_msg():
 
 
 def test_swapped_msgs():
-    """Ordering works with swap of two items with the same packet_no"""
+    """Ordering works with swap of two items within the max lateness"""
     # Two loops
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 510)
     ]
-    input_data[5], input_data[300] = input_data[300], input_data[5]
+    input_data[5], input_data[8] = input_data[8], input_data[5]
 
     input_msgs: list[AjoaikadataMsgWithKey] = [("12", {"data": d}) for d in input_data]
     result: list[AjoaikadataMsgWithKey] = []
@@ -151,17 +158,17 @@ def test_swapped_msgs():
     test_result = [v["data"] for k, v in result]
 
     expected = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 510)
     ]
     assert test_result == expected
 
 
 def test_swapped_msgs_same_packet_no():
-    """Ordering works with swap of two items with the same packet_no"""
+    """Swap of two items with the same packet_no: the early one is ordered, and the late one is discarded"""
     # Two loops
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 510)
     ]
     input_data[4], input_data[4 + 255] = input_data[4 + 255], input_data[4]
@@ -174,9 +181,14 @@ def test_swapped_msgs_same_packet_no():
     test_result = [v["data"] for k, v in result]
 
     expected = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 510)
     ]
+
+    late_msg = expected.pop(4)
+    late_msg["discard"] = True
+    expected.insert(4 + 255, late_msg)
+
     assert test_result == expected
 
 
@@ -184,10 +196,9 @@ def test_swapped_msgs_same_packet_too_big_for_cache():
     """Ordering works with swap of two items with the same packet_no with cache running to max size."""
     # Two loops
     input_data = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 1000)
     ]
-    print(input_data[4 + 765], input_data[4])
     input_data[4], input_data[4 + 765] = input_data[4 + 765], input_data[4]
 
     input_msgs: list[AjoaikadataMsgWithKey] = [("12", {"data": d}) for d in input_data]
@@ -198,7 +209,7 @@ def test_swapped_msgs_same_packet_too_big_for_cache():
     test_result = [v["data"] for k, v in result]
 
     expected = [
-        {"ntp_timestamp": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
+        {"tst": datetime(2024, 1, 1, 0, i // 60, i % 60), "msg_type": 1, "content": {"packet_no": i % 255}}
         for i in range(0, 1000)
     ]
 
@@ -207,3 +218,149 @@ def test_swapped_msgs_same_packet_too_big_for_cache():
     expected.insert(4 + 765, late_msg)
 
     assert test_result == expected
+
+
+def get_udp_msg(second: int, packet_no: int) -> AjoaikadataMsg:
+    return {"data": {"tst": datetime(2024, 1, 1, 0, 0, second), "msg_type": 1, "content": {"packet_no": packet_no}}}
+
+
+def test_released_when_watermark_passes():
+    """Messages after a lost packet are released when the event time has advanced by the max lateness"""
+    cache = create_empty_udp_cache()
+    lateness = int(MAX_LATENESS.total_seconds())
+
+    cache, msgs = reorder_messages(cache, get_udp_msg(0, 0))
+    assert len(msgs) == 1
+    # Packet 1 is lost
+    cache, msgs = reorder_messages(cache, get_udp_msg(2, 2))
+    assert msgs == []
+    for i in range(3, 2 + lateness):
+        cache, msgs = reorder_messages(cache, get_udp_msg(i, i))
+        assert msgs == []
+
+    cache, msgs = reorder_messages(cache, get_udp_msg(2 + lateness, 2 + lateness))
+    assert [msg["data"]["content"]["packet_no"] for msg in msgs] == list(range(2, 3 + lateness))
+    assert cache["msgs"] == []
+
+
+def get_beacon_msg(second: int) -> AjoaikadataMsg:
+    return {"data": {"tst": datetime(2024, 1, 1, 0, 0, second), "msg_type": 5, "content": {}}}
+
+
+def test_other_msgs_wait_for_earlier_udp_msgs():
+    """Beacon msgs wait only for the earlier udp msgs, and are released in tst order with them"""
+    cache = create_empty_udp_cache()
+    lateness = int(MAX_LATENESS.total_seconds())
+
+    cache, msgs = reorder_messages(cache, get_udp_msg(0, 0))
+    # Packet 1 is lost
+    cache, msgs = reorder_messages(cache, get_udp_msg(3, 2))
+    assert msgs == []
+
+    early_beacon = get_beacon_msg(1)
+    cache, msgs = reorder_messages(cache, early_beacon)
+    assert msgs == [early_beacon]
+
+    cache, msgs = reorder_messages(cache, get_beacon_msg(4))
+    assert msgs == []
+    cache, msgs = reorder_messages(cache, get_udp_msg(5, 3))
+    assert msgs == []
+
+    # Packet 4 is lost too
+    cache, msgs = reorder_messages(cache, get_udp_msg(3 + lateness, 5))
+    assert [(msg["data"]["msg_type"], msg["data"]["tst"].second) for msg in msgs] == [(1, 3), (5, 4), (1, 5)]
+    assert cache["others"] == []
+
+    late_beacon = get_beacon_msg(4 + lateness)
+    cache, msgs = reorder_messages(cache, late_beacon)
+    assert msgs == []
+    msgs = release_udp_cache(cache, None)
+    assert [msg["data"]["msg_type"] for msg in msgs] == [1, 5]
+    assert [msg["data"]["tst"].second for msg in msgs] == [3 + lateness, 4 + lateness]
+
+
+def test_other_msgs_limited_by_cache_size():
+    """Over the max size, the oldest other msgs are released without waiting for the earlier udp msgs"""
+    cache = create_empty_udp_cache()
+    cache, msgs = reorder_messages(cache, get_udp_msg(0, 0))
+    # Packet 1 is lost, and the event time stays within the max lateness
+    cache, msgs = reorder_messages(cache, get_udp_msg(1, 2))
+    beacons = [get_beacon_msg(2) for _ in range(CACHE_MAX_SIZE + 1)]
+    released: list[AjoaikadataMsg] = []
+    for beacon in beacons:
+        cache, msgs = reorder_messages(cache, beacon)
+        released.extend(msgs)
+
+    assert released == beacons[:1]
+    assert len(cache["others"]) == CACHE_MAX_SIZE
+
+
+def test_output_ordered_by_tst():
+    """Msgs of all types are released in tst order, when they arrive before later msgs have been released"""
+    input_data = [get_udp_msg(0, 0), get_udp_msg(2, 2), get_beacon_msg(3), get_udp_msg(4, 4), get_beacon_msg(1)]
+    input_data += [get_udp_msg(1, 1), get_udp_msg(3, 3), get_beacon_msg(5), get_udp_msg(6, 5)]
+    input_msgs: list[AjoaikadataMsgWithKey] = [("12", msg) for msg in input_data]
+    result: list[AjoaikadataMsgWithKey] = []
+    run_main(get_test_flow(input_msgs, result))
+
+    tsts = [v["data"]["tst"].second for k, v in result]
+    assert tsts == [0, 1, 1, 2, 3, 3, 4, 5, 6]
+
+
+def test_split_input_merged_by_tst():
+    """When the msg types come from separate topics, a lagging topic is merged by tst within the max lateness"""
+    lateness = int(MAX_LATENESS.total_seconds())
+    # The udp topic is ahead of the beacon topic
+    input_data = [get_udp_msg(i, i) for i in range(lateness)] + [get_beacon_msg(1), get_beacon_msg(lateness - 1)]
+    input_data += [get_udp_msg(lateness + i, lateness + i) for i in range(lateness)]
+    cache = create_empty_udp_cache()
+    released: list[AjoaikadataMsg] = []
+    for msg in input_data:
+        cache, msgs = reorder_messages(cache, msg, split_input=True)
+        released.extend(msgs)
+    released.extend(release_udp_cache(cache, None, split_input=True))
+
+    assert [msg["data"]["tst"].second for msg in released] == sorted(msg["data"]["tst"].second for msg in input_data)
+    assert [msg["data"]["msg_type"] for msg in released[:3]] == [1, 1, 5]
+
+
+def test_cache_flushed_on_eof():
+    """Cached messages are released at the end of the input"""
+    input_msgs: list[AjoaikadataMsgWithKey] = [("12", get_udp_msg(i, i)) for i in (1, 2, 4, 5)]
+    result: list[AjoaikadataMsgWithKey] = []
+    run_main(get_test_flow(input_msgs, result))
+
+    assert [v["data"]["content"]["packet_no"] for k, v in result] == [1, 2, 4, 5]
+
+
+def test_simulated_jitter_ordered():
+    """Msgs delayed less than the max lateness are released in order without discards"""
+    config = TrafficConfig(vehicles=3, duration_secs=600, jitter_secs=3, loss_rate=0, duplicate_rate=0)
+    input_msgs = [msg for arrival, msg in simulate_traffic(config)]
+    result: list[AjoaikadataMsgWithKey] = []
+    run_main(get_test_flow(input_msgs, result))
+
+    assert len(result) == len(input_msgs)
+    for vehicle in ("1", "2", "3"):
+        tsts = [v["data"]["tst"] for k, v in result if k == vehicle and v["data"]["msg_type"] == 1]
+        assert tsts == sorted(tsts)
+    assert not any(v["data"].get("discard") for k, v in result)
+
+
+def test_simulated_loss_duplicates_and_clock_jumps():
+    """Every msg is released once, and the udp msgs not discarded are in order"""
+    config = TrafficConfig(
+        vehicles=3, duration_secs=600, jitter_secs=3, loss_rate=0.05, duplicate_rate=0.05, clock_jump_rate=0.01
+    )
+    input_msgs = [msg for arrival, msg in simulate_traffic(config)]
+    result: list[AjoaikadataMsgWithKey] = []
+    run_main(get_test_flow(input_msgs, result))
+
+    assert sorted(id(v) for k, v in result) == sorted(id(v) for k, v in input_msgs)
+    for vehicle in ("1", "2", "3"):
+        tsts = [
+            v["data"]["tst"]
+            for k, v in result
+            if k == vehicle and v["data"]["msg_type"] == 1 and not v["data"].get("discard")
+        ]
+        assert tsts == sorted(tsts)
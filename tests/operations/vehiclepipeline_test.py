@@ -0,0 +1,90 @@
+import copy
+from datetime import datetime, timedelta, timezone
+
+import bytewax.operators as op
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSink, TestingSource, run_main
+
+from ...src.operations.balisedirection import BaliseDirectionLogic
+from ...src.operations.baliseparts import BalisePartsLogic
+from ...src.operations.tstvalidator import validate_tst
+from ...src.operations.udporder import UDPReorderLogic
+from ...src.operations.vehiclepipeline import VehiclePipelineLogic
+from ...src.util.ajoaikadatamsg import AjoaikadataMsgWithKey
+
+START = datetime(2024, 1, 1, 8, tzinfo=timezone.utc)
+
+
+def get_msg(second: float, msg_type: int, content: dict) -> AjoaikadataMsgWithKey:
+    tst = START + timedelta(seconds=second)
+    data = {
+        "msg_type": msg_type,
+        "vehicle": 53,
+        "ntp_time_valid": True,
+        "ntp_timestamp": tst,
+        "eke_timestamp": tst.replace(tzinfo=None),
+        "mqtt_timestamp": tst + timedelta(milliseconds=200),
+        "content": content,
+    }
+    return "53", {"data": data, "msgs": [(0, int(second * 10), -1, -1)]}
+
+
+def get_balise_parts(second: float, msg_index: int, cba: int) -> list[AjoaikadataMsgWithKey]:
+    payload = bytes([cba << 4 | 0x2, 0x11, 1, 2, 3, 4, 5, 0])
+    return [
+        get_msg(second, 5, {"msg_index": msg_index, "transponder_msg_part": 0, "content": payload[:4]}),
+        get_msg(second + 0.1, 5, {"msg_index": msg_index + 1, "transponder_msg_part": 1, "content": payload[4:]}),
+    ]
+
+
+def get_input() -> list[AjoaikadataMsgWithKey]:
+    udp = [get_msg(i, 1, {"packet_no": i}) for i in range(60)]
+    udp[10], udp[11] = udp[11], udp[10]
+    del udp[30]  # Lost packet
+    balises = get_balise_parts(5.5, 1, 0x2) + get_balise_parts(6.5, 3, 0x3) + get_balise_parts(20.5, 5, 0x2)
+    return sorted(udp + balises, key=lambda item: item[1]["data"]["mqtt_timestamp"])
+
+
+def run_flow(input_msgs: list[AjoaikadataMsgWithKey], fused: bool) -> list[AjoaikadataMsgWithKey]:
+    result: list[AjoaikadataMsgWithKey] = []
+    flow = Dataflow("test_flow")
+    stream = op.input("test_input", flow, TestingSource(input_msgs))
+    if fused:
+        stream = op.unary("vehicle_pipeline", stream, VehiclePipelineLogic)
+    else:
+        stream = op.stateful_map("validate_tst", stream, validate_tst)
+        stream = op.unary("reorder_upd", stream, UDPReorderLogic)
+        stream = op.unary("combine_balises", stream, BalisePartsLogic)
+        stream = op.unary("balise_direction", stream, BaliseDirectionLogic)
+    op.output("test_output", stream, TestingSink(result))
+    run_main(flow)
+    return result
+
+
+def test_same_output_as_separate_stages():
+    """Fused operator gives the same msgs as the stages as separate operators"""
+    input_msgs = get_input()
+    fused = run_flow(copy.deepcopy(input_msgs), fused=True)
+    separate = run_flow(copy.deepcopy(input_msgs), fused=False)
+
+    assert fused == separate
+    packet_nos = [v["data"]["content"]["packet_no"] for k, v in fused if v["data"]["msg_type"] == 1]
+    assert packet_nos == [i for i in range(60) if i != 30]
+    balises = [v["data"] for k, v in fused if v["data"]["msg_type"] == 5]
+    assert [(data["content"].get("direction"), bool(data.get("incomplete"))) for data in balises] == [
+        (1, False),
+        (None, True),
+    ]
+
+
+def test_snapshot_and_resume():
+    """State of all the stages is in the snapshot, and the logic can be resumed from it"""
+    logic = VehiclePipelineLogic(None)
+    for key, msg in get_input()[:20]:
+        logic.on_item(msg)
+
+    state = logic.snapshot()
+    resumed = VehiclePipelineLogic(state)
+
+    assert resumed.snapshot() == state
+    assert state["tst_correction"] == timedelta()
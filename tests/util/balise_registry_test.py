@@ -0,0 +1,77 @@
+import os
+
+from ...src.util.balise_registry import (
+    BaliseInfo,
+    RegistryHolder,
+    compile_registry,
+    load_registry,
+    registry_key,
+    registry_version,
+    save_registry,
+)
+
+REGISTRY_CSV = """"balise","direction","station","track","type","train_direction"
+61730,2,Aviapolis,1,ARRIVAL,1
+61033,1,Aviapolis,1,DEPARTURE,1
+61033,2,Aviapolis,1,ARRIVAL,2
+"""
+
+
+def test_compile_registry(tmp_path):
+    """Registry is keyed by balise id and direction, and the missing opposite directions are generated"""
+    csv_file = tmp_path / "balise_registry.csv"
+    csv_file.write_text(REGISTRY_CSV)
+
+    registry = compile_registry(str(csv_file))
+
+    assert registry == {
+        registry_key(61730, 2): BaliseInfo("Aviapolis", "1", "arrival", "1", "61730_2"),
+        registry_key(61730, 1): BaliseInfo("Aviapolis", "1", "departure", "2_g", "61730_1"),
+        registry_key(61033, 1): BaliseInfo("Aviapolis", "1", "departure", "1", "61033_1"),
+        registry_key(61033, 2): BaliseInfo("Aviapolis", "1", "arrival", "2", "61033_2"),
+    }
+
+
+def test_artifact_round_trip(tmp_path):
+    """Registry loaded from the artifact is the same as compiled from the csv"""
+    csv_file = tmp_path / "balise_registry.csv"
+    csv_file.write_text(REGISTRY_CSV)
+    artifact_file = str(tmp_path / "balise_registry.pickle")
+
+    save_registry(compile_registry(str(csv_file)), artifact_file)
+
+    assert load_registry(artifact_file) == load_registry(str(csv_file))
+
+
+def test_artifact_has_same_version(tmp_path):
+    """Version depends only on the registry content"""
+    csv_file = tmp_path / "balise_registry.csv"
+    csv_file.write_text(REGISTRY_CSV)
+    artifact_file = str(tmp_path / "balise_registry.pickle")
+    save_registry(compile_registry(str(csv_file)), artifact_file)
+
+    assert registry_version(load_registry(artifact_file)) == registry_version(load_registry(str(csv_file)))
+
+
+def test_reload_modified_registry(tmp_path):
+    """Modified file replaces the registry with a new version, and a broken file keeps the old one"""
+    csv_file = tmp_path / "balise_registry.csv"
+    csv_file.write_text(REGISTRY_CSV)
+    holder = RegistryHolder(str(csv_file))
+    old = holder.current
+
+    assert not holder.reload_if_modified()
+
+    csv_file.write_text(REGISTRY_CSV.replace("61033,1,Aviapolis", "61033,1,Kivistö"))
+    os.utime(csv_file, ns=(0, 0))  # Ensure mtime changes also with a coarse clock
+    assert holder.reload_if_modified()
+    assert holder.current.version != old.version
+    assert holder.current.balises[registry_key(61033, 1)].station == "Kivistö"
+    # The old registry is not modified, so readers holding it see consistent data
+    assert old.balises[registry_key(61033, 1)].station == "Aviapolis"
+
+    new = holder.current
+    csv_file.write_text("broken")
+    os.utime(csv_file, ns=(1, 1))
+    assert not holder.reload_if_modified()
+    assert holder.current is new